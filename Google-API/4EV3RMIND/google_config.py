@@ -4,6 +4,13 @@
 # Google Gemini API настройки
 GEMINI_API_KEY = "your-google-api-key"
 GEMINI_MODEL = "gemma-3-27b-it"  # Модель Gemma 3 27B
+PRIMARY_PROVIDER = "gemini"  # Основной провайдер: openrouter, gemini или algion
+
+# Ключи остальных провайдеров (нужны только для хеджирования, можно оставить пустыми)
+OPENROUTER_API_KEY = ""
+OPENROUTER_MODEL = "nousresearch/hermes-3-llama-3.1-405b:free"
+ALGION_API_KEY = ""
+ALGION_MODEL = "gpt-5.1"
 
 # Настройки оборудования
 USE_GYRO = True
@@ -29,4 +36,171 @@ MAX_SEQUENCE_ACTIONS = 5  # Максимальное количество дей
 
 # Настройки лимитов запросов
 DAILY_REQUEST_LIMIT = 14400
-ENABLE_REQUEST_LIMIT = True
\ No newline at end of file
+ENABLE_REQUEST_LIMIT = True
+
+# Настройки HTTP-соединения
+HTTP_POOL_SIZE = 4          # Размер пула соединений с API
+HTTP_KEEPALIVE_IDLE = 45    # Через сколько секунд простоя соединение прогревается заново
+HTTP_PREWARM = True         # Прогревать соединение в паузах автономного режима
+
+# Хеджирование запросов
+HEDGE_PROVIDERS = []        # Резервные провайдеры по порядку, например ["gemini", "algion"]
+HEDGE_PERCENTILE = 90       # Дубль уходит, если основной провайдер медлит дольше этого перцентиля задержки
+HEDGE_DEFAULT_DELAY = 8.0   # Задержка до дубля (сек), пока статистики задержек мало
+
+# Потоковые ответы
+STREAM_RESPONSES = True     # Выполнять действия по мере генерации ответа (SSE)
+
+# Кэш рефлексов на препятствия
+REFLEX_CACHE_ENABLED = True
+REFLEX_DISTANCE_STEP = 5    # Шаг квантования расстояния ИК датчика
+REFLEX_HEADING_STEP = 45    # Шаг квантования курса по гироскопу (градусы)
+REFLEX_CACHE_TTL = 1800     # Максимальный возраст реакции в кэше (сек)
+REFLEX_REFRESH_AGE = 300    # С какого возраста реакция обновляется в фоне (сек)
+REFLEX_MIN_SUCCESS = 0.5    # Реакция удаляется, если помогает реже (после 3 применений)
+
+# Локальные рефлексы: выполняются сразу, без ожидания сети (формат как у ответа нейросети)
+REFLEX_RULES = {
+    "obstacle": [
+        {"action": "move_backward", "speed": 40, "duration": 1.0, "angle": 0, "speech": "Препятствие! Отступаю."},
+        {"action": "turn_left", "speed": 30, "duration": 0, "angle": 60, "speech": ""}
+    ],
+    "safety": [
+        {"action": "stop", "speed": 0, "duration": 0, "angle": 0, "speech": "Слишком близко, сначала объеду препятствие."},
+        {"action": "move_backward", "speed": 40, "duration": 1.0, "angle": 0, "speech": ""}
+    ],
+    "button": [
+        {"action": "speak", "speed": 0, "duration": 0, "angle": 0, "speech": "Ой! Кто здесь?"}
+    ],
+    "offline": [
+        {"action": "speak", "speed": 0, "duration": 0, "angle": 0, "speech": "Нет связи с нейросетью. Действую самостоятельно."},
+        {"action": "turn_right", "speed": 30, "duration": 0, "angle": 45, "speech": ""}
+    ]
+}
+REFLEX_LLM_DEADLINE = 6.0   # Сколько секунд после события ждать уточненный план нейросети
+REFLEX_LLM_MODE = "extend"  # extend — план нейросети после рефлекса, replace — вместо оставшейся части рефлекса
+
+# Предварительный запрос плана в автономном режиме
+PREFETCH_ENABLED = True
+PREFETCH_LEAD_DEFAULT = 8.0         # За сколько секунд до конца паузы запрашивать план, пока статистики мало
+PREFETCH_MAX_AGE = 60               # Максимальный возраст заранее полученного плана (сек)
+PREFETCH_MAX_DISTANCE_CHANGE = 15   # Допустимое изменение расстояния ИК датчика к моменту выполнения
+PREFETCH_MAX_HEADING_CHANGE = 30    # Допустимое изменение курса (градусы)
+
+# Кэширование статичной части промпта на стороне провайдера
+PROMPT_CACHE_ENABLED = True
+PROMPT_CACHE_TTL = 3600     # Время жизни кэша Gemini cachedContents (сек)
+
+# Статистика запросов к нейросети
+STATS_FILE = "llm_stats.jsonl"  # Файл статистики (рядом со скриптом)
+STATS_MAX_RECORDS = 2000        # Сколько последних запросов хранить
+TOKEN_PRICES = {}               # Цена за миллион токенов, например {"openrouter": (0.5, 1.5)}; пусто - бесплатно
+
+# Устойчивость запросов к нейросети
+TIMEOUT_CONNECT = 5             # Таймаут установки соединения (сек)
+TIMEOUT_DEFAULT = 30            # Таймаут ответа, пока статистики задержек мало (сек)
+TIMEOUT_MIN = 5                 # Границы адаптивного таймаута ответа (сек)
+TIMEOUT_MAX = 45
+TIMEOUT_PERCENTILE = 99         # Таймаут = перцентиль задержек провайдера * множитель
+TIMEOUT_MULTIPLIER = 2.0
+RETRY_MAX_ATTEMPTS = 2          # Повторы при сетевых ошибках, 429 и 5xx
+RETRY_BASE_DELAY = 1.0          # Пауза перед первым повтором (сек), удваивается с каждой попыткой
+RETRY_MAX_DELAY = 20            # Дольше этого Retry-After не ждем: провайдер отключается на указанное время
+CIRCUIT_FAILURE_THRESHOLD = 3   # Неудачных запросов подряд до отключения провайдера
+CIRCUIT_OPEN_TIME = 60          # Через сколько секунд пробовать снова; удваивается при неудачной пробе
+CIRCUIT_OPEN_TIME_MAX = 600
+
+# Распределение дневного лимита между типами запросов
+BUDGET_SHARES = {               # Гарантированная доля лимита каждого типа запросов
+    "obstacle": 0.15,
+    "button": 0.15,
+    "terminal": 0.3,
+    "autonomous": 0.4
+}
+BUDGET_PRIORITY = ["obstacle", "terminal", "button", "autonomous"]  # Сверх своей доли тип не трогает резерв более важных
+BUDGET_AUTONOMOUS_PACING = True # Растягивать автономные запросы на остаток дня
+BUDGET_FILE = "budget_ledger.json"  # Журнал расхода лимита (рядом со скриптом)
+
+# Объединение команд терминала в один запрос
+TERMINAL_BATCH_WINDOW = 0.5   # Сколько секунд тишины ждать после последней команды перед запросом
+TERMINAL_BATCH_MAX = 4        # Максимум команд в одном запросе
+
+# Структурированный ответ: провайдер сам соблюдает JSON-схему действий
+STRUCTURED_OUTPUT = True
+
+# Локальная нейросеть в сети (любой OpenAI-совместимый сервер: llama.cpp, vLLM, Ollama)
+LOCAL_LLM_ENABLED = False
+LOCAL_BASE_URL = "http://192.168.1.50:8080/v1"  # Адрес сервера, для проверки можно запустить local_stub_server.py
+LOCAL_MODEL = "qwen2.5-3b-instruct"
+LOCAL_API_KEY = ""              # Большинству локальных серверов ключ не нужен
+LOCAL_TIMEOUT = 10              # Таймаут ответа локального сервера (сек)
+LOCAL_HEALTH_INTERVAL = 30      # Как часто проверять доступность сервера (сек)
+
+# Кэш планов для повторяющихся команд терминала
+PLAN_CACHE_ENABLED = True
+PLAN_CACHE_FILE = "plan_cache.json"  # Файл кэша (рядом со скриптом)
+PLAN_CACHE_SIZE = 100           # Максимум планов; вытесняются давно не использованные
+PLAN_CACHE_TTL = 86400          # Максимальный возраст плана (сек)
+PLAN_CACHE_SIMILARITY = 0.6     # Минимальное сходство формулировок по триграммам (0..1)
+PLAN_CACHE_DISTANCE_STEP = 25   # Шаг расстояния ИК датчика в сигнатуре ситуации (см)
+PLAN_CACHE_SKIP = ["шутк", "анекдот", "стих", "истори", "придумай", "случайн"]  # Такие команды всегда идут к нейросети
+PLAN_CACHE_KEY_WORDS = ["не", "нет", "без", "налево", "направо", "влево", "вправо", "слева", "справа", "левый", "правый", "левой", "правой",
+                        "вперед", "назад", "вверх", "вниз"]  # Отрицание и направления должны совпадать дословно, как числа
+PLAN_CACHE_STOP_WORDS = ["и", "а", "на", "ну", "пожалуйста", "давай", "теперь", "потом", "затем", "робот"]  # Не учитываются при сравнении
+PLAN_CACHE_WORD_SIMILARITY = 0.5  # Минимальное сходство слов по триграммам: поглощает опечатки и словоформы
+PLAN_CACHE_SAVE_INTERVAL = 300  # Попадания и порядок использования записываются в файл не чаще раза в столько секунд (и при выходе)
+
+# Быстрый разбор простых команд без нейросети ("вперед 2 секунды", "налево 90", "стоп")
+FAST_COMMANDS_ENABLED = True
+FAST_COMMAND_SPEED = 50         # Скорость движения и поворота
+FAST_COMMAND_FAST_SPEED = 75    # Скорость со словом "быстро"
+FAST_COMMAND_SLOW_SPEED = 25    # Скорость со словом "медленно"
+FAST_COMMAND_DURATION = 1.0     # Длительность движения, если время не указано (сек)
+FAST_COMMAND_ANGLE = 90         # Угол поворота, если градусы не указаны
+
+# Диспетчер запросов к нейросети (приоритет запроса - место его типа в BUDGET_PRIORITY)
+REQUEST_CANCELLABLE = ["button", "autonomous"]  # Такие запросы отменяются более важными запросами и новыми командами пользователя
+REQUEST_SITUATION_CHECK = ["autonomous"]        # Ответ на такие запросы отбрасывается, если обстановка успела измениться
+
+# Память разговора: последние реплики дословно, более старые - в краткой сводке
+MEMORY_RECENT_TURNS = 6         # Сколько последних реплик хранить дословно
+MEMORY_FOLD_TURNS = 4           # Сколько старых реплик сворачивать в сводку за раз
+MEMORY_TOKEN_BUDGET = 250       # Максимум токенов памяти в промпте (оценка: 3 символа на токен)
+MEMORY_SUMMARY_TOKENS = 80      # Из них на сводку старых реплик
+MEMORY_SUMMARY_MODE = "local"   # local - сводка без запросов, llm - один короткий запрос к нейросети на каждую свертку
+
+# Тест разбора JSON (служебная команда "тест разбора")
+PARSER_FUZZ_SAMPLES = 200  # Сколько случайных искажений образцов ответов добавить к набору
+PARSER_BENCHMARK_ROUNDS = 5  # Сколько раз прогнать набор при замере скорости
+
+# Действия
+ACTION_DEFAULT_SPEED = 50     # Скорость, если нейросеть ее не указала
+OBSTACLE_ACTION_SPEED = 40    # То же для реакции на препятствие: рядом с ним едем медленнее
+ACTION_BENCHMARK_ROUNDS = 2000  # Повторы замеров в служебной команде "тест действий"
+
+# Исполнитель планов (служебная команда "исполнитель")
+PLAN_PRIORITIES = {"emergency": 0, "obstacle": 1, "safety": 1, "terminal": 2, "button": 2, "autonomous": 3}  # Меньше - важнее; emergency - команда "стоп" в терминале
+PLAN_RESUME = ["terminal"]    # Прерванные планы этих источников продолжаются со следующего действия, остальные отбрасываются
+PLAN_LATENCY_WINDOW = 200     # Сколько последних задержек очереди и вытеснения хранить для отчета
+
+# Компилятор планов (служебная команда "компилятор")
+PLAN_COMPILER_ENABLED = True  # Объединять соседние движения, гасить встречные повороты, убирать действия без эффекта
+PLAN_ACTION_PAUSE = 0.5       # Пауза между действиями плана (сек)
+PLAN_STREAM_LOOKAHEAD = 0.6   # Сколько реплика из потока ждет следующее действие, чтобы прозвучать вместе с ним (сек)
+PLAN_SPEECH_SECONDS_PER_CHAR = 0.085  # Длительность речи espeak (-s 100) на символ для оценки времени плана
+
+# Дорожки исполнителя: речь, ходовые моторы, лезвие и подсветка работают одновременно
+PLAN_TRACKS_ENABLED = True    # Речь звучит во время движения, действия с parallel/after не ждут окончания остальных; False - все строго по очереди
+
+# Трассировка (служебная команда "трассировка" выгружает ее в файл Chrome trace)
+TRACE_ENABLED = False         # Записывать интервалы работы; выключенная трассировка ничего не стоит, включается до запуска
+TRACE_BUFFER_SIZE = 20000     # Сколько последних интервалов хранить в кольцевом буфере
+TRACE_FILE = "trace.json"     # Файл трассировки (рядом со скриптом)
+
+# Симулятор планов (служебная команда "симулятор"): план проверяется на столкновения до движения моторов
+SIM_ENABLED = True            # Укорачивать или убирать движения, которые подведут робота к препятствию ближе OBSTACLE_DISTANCE
+SIM_FULL_SPEED_CM = 30.0      # Скорость робота при скорости моторов 100 (см/с); подберите под своего робота
+SIM_OBSTACLE_RADIUS = 15      # Размер препятствия в модели (см): ИК датчик видит только ближайшую точку
+SIM_IR_RANGE = 70             # Показания ИК датчика от этого значения считаются свободным путем
+SIM_OBSTACLE_MEMORY = 8       # Сколько замеченных препятствий помнить
+SIM_OBSTACLE_TTL = 60         # Сколько секунд помнить препятствие: поза по счислению пути со временем уплывает
\ No newline at end of file
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# local_stub_server.py
+# Заглушка локального OpenAI-совместимого сервера для проверки 4EV3RMIND без интернета
+#
+# Запуск на компьютере в той же сети, что и робот:
+#   python3 local_stub_server.py --port 8080
+# В файле конфигурации робота:
+#   LOCAL_LLM_ENABLED = True
+#   LOCAL_BASE_URL = "http://<ip-компьютера>:8080/v1"
+
+import argparse
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Ответы по ключевым словам последнего сообщения пользователя
+REPLIES = [
+    (("препятствие",), [
+        {"action": "move_backward", "speed": 40, "duration": 1.0, "angle": 0, "speech": "Вижу препятствие, отступаю."},
+        {"action": "turn_left", "speed": 30, "duration": 0, "angle": 60, "speech": ""}
+    ]),
+    (("вперед", "поехали"), [
+        {"action": "speak", "speed": 0, "duration": 0, "angle": 0, "speech": "Еду вперед!"},
+        {"action": "move_forward", "speed": 50, "duration": 2.0, "angle": 0, "speech": ""}
+    ]),
+    (("назад",), [
+        {"action": "move_backward", "speed": 40, "duration": 1.5, "angle": 0, "speech": "Отъезжаю назад."}
+    ]),
+    (("налево", "влево"), [
+        {"action": "turn_left", "speed": 30, "duration": 0, "angle": 90, "speech": "Поворачиваю налево."}
+    ]),
+    (("направо", "вправо"), [
+        {"action": "turn_right", "speed": 30, "duration": 0, "angle": 90, "speech": "Поворачиваю направо."}
+    ]),
+    (("атак", "нож", "лезви"), [
+        {"action": "attack", "speed": 80, "duration": 1.0, "angle": 0, "speech": "В атаку!"}
+    ])
+]
+DEFAULT_REPLY = [
+    {"action": "speak", "speed": 0, "duration": 0, "angle": 0, "speech": "Локальная нейросеть на связи."}
+]
+
+def get_message_text(message):
+    """Текст сообщения: строка или список частей с полем text"""
+    content = message.get("content", "")
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+def choose_actions(text):
+    """Подбирает заготовленный план по ключевым словам"""
+    text = text.lower()
+    for keywords, actions in REPLIES:
+        if any(keyword in text for keyword in keywords):
+            return actions
+    return DEFAULT_REPLY
+
+def build_content(request):
+    """Текст ответа в том формате, который запросил робот"""
+    user_messages = [get_message_text(message) for message in request.get("messages", []) if message.get("role") == "user"]
+    text = user_messages[-1] if user_messages else ""
+
+    # Пакетный запрос: пронумерованные команды, по плану на каждую
+    commands = re.findall(r"^\d+\. (.*)$", text, re.MULTILINE)
+    schema = request.get("response_format", {}).get("json_schema", {}).get("schema", {})
+
+    if commands:
+        plans = [choose_actions(command) for command in commands]
+        if "plans" in schema.get("properties", {}):
+            return json.dumps({"plans": plans}, ensure_ascii=False)
+        return json.dumps(plans, ensure_ascii=False)
+
+    # В обычном запросе смотрим только на контекст и сам запрос, а не на историю действий
+    request_lines = re.findall(r"^(?:Контекст|Запрос): (.*)$", text, re.MULTILINE)
+    actions = choose_actions(" ".join(request_lines) or text)
+    if "actions" in schema.get("properties", {}):
+        return json.dumps({"actions": actions}, ensure_ascii=False)
+    return json.dumps(actions, ensure_ascii=False)
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Обработчик OpenAI-совместимых запросов: /v1/models и /v1/chat/completions"""
+
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.rstrip("/") in ("/v1/models", "/models", "/health"):
+            self.send_json(200, {"object": "list", "data": [{"id": self.server.model, "object": "model"}]})
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "not found"}})
+            return
+
+        if self.server.fail:
+            self.send_json(503, {"error": {"message": "stub server is configured to fail"}})
+            return
+
+        time.sleep(self.server.delay)
+        content = build_content(request)
+        prompt_text = " ".join(get_message_text(message) for message in request.get("messages", []))
+        usage = {
+            "prompt_tokens": len(prompt_text) // 4,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": (len(prompt_text) + len(content)) // 4
+        }
+
+        if request.get("stream"):
+            self.send_stream(content, usage, request.get("stream_options", {}).get("include_usage", False))
+            return
+
+        self.send_json(200, {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.server.model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": usage
+        })
+
+    def send_stream(self, content, usage, include_usage):
+        """Отдает ответ SSE-потоком небольшими фрагментами"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        for start in range(0, len(content), 16):
+            event = {"choices": [{"index": 0, "delta": {"content": content[start:start + 16]}}]}
+            self.wfile.write(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n\n")
+            self.wfile.flush()
+            time.sleep(self.server.chunk_delay)
+
+        if include_usage:
+            self.wfile.write(b"data: " + json.dumps({"choices": [], "usage": usage}).encode("utf-8") + b"\n\n")
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        print("[stub] " + self.address_string() + " " + (format % args))
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка локальной нейросети для 4EV3RMIND")
+    parser.add_argument("--host", default="0.0.0.0", help="Адрес для прослушивания")
+    parser.add_argument("--port", type=int, default=8080, help="Порт")
+    parser.add_argument("--model", default="local-stub", help="Имя модели в ответах")
+    parser.add_argument("--delay", type=float, default=0.2, help="Задержка перед ответом (сек)")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="Пауза между фрагментами потока (сек)")
+    parser.add_argument("--fail", action="store_true", help="Отвечать 503, чтобы проверить переход в облако")
+    args = parser.parse_args()
+
+    server = StubServer((args.host, args.port), StubHandler)
+    server.model = args.model
+    server.delay = args.delay
+    server.chunk_delay = args.chunk_delay
+    server.fail = args.fail
+
+    print("Заглушка локальной нейросети: http://" + args.host + ":" + str(args.port) + "/v1 (модель " + args.model + ")")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
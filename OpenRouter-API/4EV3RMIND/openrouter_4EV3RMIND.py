@@ -2,14 +2,23 @@
 
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import subprocess
 import time
 import random
 import threading
+import queue
 import sys
 import select
 import os
+import re
+import math
+import functools
+import itertools
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 from ev3dev2.motor import LargeMotor, MediumMotor, OUTPUT_A, OUTPUT_B, OUTPUT_C
 from ev3dev2.sensor import INPUT_1, INPUT_2, INPUT_3, INPUT_4
 from ev3dev2.sensor.lego import TouchSensor, InfraredSensor, ColorSensor, GyroSensor
@@ -19,6 +28,9 @@ from ev3dev2.led import Leds
 # Настройки из config.py
 from openrouter_config import *
 
+# Каталог скрипта: здесь хранятся файлы статистики
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
 # Инициализация моторов
 left_motor = LargeMotor(OUTPUT_B)
 right_motor = LargeMotor(OUTPUT_C)
@@ -62,12 +74,18 @@ leds = Leds()
 leds.all_off()
 
 # Глобальные переменные для управления
-daily_requests = 0
-daily_reset_time = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+# Журнал расхода дневного лимита по типам запросов, сохраняется между перезапусками
+budget_lock = threading.Lock()
+budget_ledger = {
+    'date': datetime.now().strftime("%Y-%m-%d"),
+    'spent': {}
+}
+budget_last_spent = {}  # Тип запроса -> время последнего облачного запроса (не сохраняется)
 is_performing_action = False
 terminal_input_queue = []
+terminal_last_input = 0
+terminal_event = threading.Event()
 last_action_time = time.time()
-action_history = []
 obstacle_detected = False
 last_obstacle_time = 0
 
@@ -83,6 +101,121 @@ sensor_cache = {
 # Время жизни кэша (секунды)
 CACHE_TTL = 0.1
 
+# Трассировка: интервалы работы (датчики, промпт, запросы, разбор, речь, движения) в кольцевом буфере.
+# Выгружается в формате Chrome trace: файл открывается в chrome://tracing или ui.perfetto.dev
+trace_counter = itertools.count()
+trace_buffer = [None] * TRACE_BUFFER_SIZE if TRACE_ENABLED else []
+trace_threads = {}
+trace_origin = time.perf_counter()
+
+def record_span(name, category, started, args=None):
+    """Записывает интервал в кольцевой буфер без блокировок: самые старые интервалы затираются"""
+    ended = time.perf_counter()
+    thread = threading.current_thread()
+    trace_threads[thread.ident] = thread.name
+    trace_buffer[next(trace_counter) % TRACE_BUFFER_SIZE] = (name, category, started, ended - started, thread.ident, args)
+
+class TraceSpan:
+    """Интервал для блока with"""
+
+    __slots__ = ("name", "category", "args", "started")
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_span(self.name, self.category, self.started, self.args)
+        return False
+
+class NullSpan:
+    """Интервал выключенной трассировки: ничего не измеряет"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def trace_span(name, category, args=None):
+    """Интервал вокруг участка кода: with trace_span("pause", "plan"): ..."""
+    if not TRACE_ENABLED:
+        return NULL_SPAN
+    return TraceSpan(name, category, args)
+
+def traced(category):
+    """Декоратор: каждый вызов функции записывается интервалом с ее именем.
+    
+    При выключенной трассировке функция не оборачивается вовсе и вызывается
+    без лишних затрат.
+    """
+    def decorate(function):
+        if not TRACE_ENABLED:
+            return function
+        name = function.__name__
+        
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_span(name, category, started)
+        
+        return wrapper
+    return decorate
+
+def get_trace_spans():
+    """Интервалы из буфера в порядке начала"""
+    return sorted((span for span in list(trace_buffer) if span is not None), key=lambda span: span[2])
+
+def build_trace_events(spans):
+    """События Chrome trace: имена потоков (ph M) и интервалы (ph X) с временем в микросекундах"""
+    pid = os.getpid()
+    events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+              for tid, name in list(trace_threads.items())]
+    for name, category, started, duration, tid, args in spans:
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((started - trace_origin) * 1000000, 1),
+            "dur": round(duration * 1000000, 1),
+            "pid": pid,
+            "tid": tid
+        }
+        if args:
+            event["args"] = args
+        events.append(event)
+    return events
+
+def get_trace_path():
+    """Путь к файлу трассировки"""
+    return os.path.join(SCRIPT_DIR, TRACE_FILE)
+
+def save_trace():
+    """Атомарно выгружает буфер трассировки в TRACE_FILE; возвращает число интервалов"""
+    spans = get_trace_spans()
+    path = get_trace_path()
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as trace_file:
+            json.dump({"traceEvents": build_trace_events(spans), "displayTimeUnit": "ms"}, trace_file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except (IOError, OSError) as e:
+        print("Не удалось сохранить трассировку: " + str(e))
+    return len(spans)
+
 def safe_get_ir_distance():
     """Безопасное получение расстояния с ИК датчика с кэшированием"""
     global sensor_cache
@@ -172,6 +305,7 @@ color_descriptions = {
     'Brown': 'коричневый'
 }
 
+@traced("speech")
 def speak(text):
     """Озвучивание текста через espeak без вывода ALSA ошибок"""
     try:
@@ -186,6 +320,7 @@ def speak(text):
     except Exception as e:
         print("Ошибка озвучивания: " + str(e))
 
+@traced("sensors")
 def get_sensor_data():
     """Получение данных с датчиков (потокобезопасное)"""
     global obstacle_detected, sensor_cache
@@ -226,65 +361,857 @@ def get_sensor_data():
     
     return sensor_data
 
+# Кэш рефлексов: проверенные реакции на препятствия по квантованному состоянию датчиков
+reflex_lock = threading.Lock()
+reflex_cache = {}
+reflex_stats = {
+    'hits': 0,
+    'misses': 0,
+    'refreshes': 0,
+    'refreshing': False
+}
+
+def get_reflex_key(sensor_data):
+    """Ключ кэша: квантованное расстояние, цвет и сектор курса"""
+    distance_bucket = int(sensor_data['ir_distance']) // REFLEX_DISTANCE_STEP
+    heading_bucket = -1
+    if "gyro_angle" in sensor_data:
+        heading_bucket = int(sensor_data["gyro_angle"]) % 360 // REFLEX_HEADING_STEP
+    return (distance_bucket, sensor_data.get('color', 'NoColor'), heading_bucket)
+
+def store_reflex(sensor_data, actions_data):
+    """Сохраняет проверенную реакцию нейросети на препятствие"""
+    if not REFLEX_CACHE_ENABLED or not actions_data:
+        return
+    
+    with reflex_lock:
+        reflex_cache[get_reflex_key(sensor_data)] = {
+            'actions': [action_data.copy() for action_data in actions_data],
+            'created': time.time(),
+            'uses': 0,
+            'successes': 0
+        }
+
+def get_cached_reflex(sensor_data):
+    """Возвращает реакцию из кэша или None; устаревшие и неудачные реакции удаляются"""
+    if not REFLEX_CACHE_ENABLED:
+        return None
+    
+    key = get_reflex_key(sensor_data)
+    now = time.time()
+    
+    with reflex_lock:
+        entry = reflex_cache.get(key)
+        
+        if entry is not None:
+            expired = now - entry['created'] > REFLEX_CACHE_TTL
+            failing = entry['uses'] >= 3 and entry['successes'] < entry['uses'] * REFLEX_MIN_SUCCESS
+            if expired or failing:
+                print("Кэш рефлексов: реакция удалена (" + ("устарела" if expired else "не помогает") + ")")
+                del reflex_cache[key]
+                entry = None
+        
+        if entry is None:
+            reflex_stats['misses'] += 1
+            return None
+        
+        reflex_stats['hits'] += 1
+        entry['uses'] += 1
+        actions_data = [action_data.copy() for action_data in entry['actions']]
+        needs_refresh = now - entry['created'] > REFLEX_REFRESH_AGE
+    
+    if needs_refresh:
+        refresh_reflex(sensor_data)
+    
+    return actions_data
+
+def record_reflex_outcome(sensor_data):
+    """Отмечает, помогла ли реакция: после нее путь должен быть свободен"""
+    success = safe_get_ir_distance() >= SAFETY_DISTANCE
+    
+    with reflex_lock:
+        entry = reflex_cache.get(get_reflex_key(sensor_data))
+        if entry is not None and entry['uses'] > 0:
+            if success:
+                entry['successes'] += 1
+            print("Кэш рефлексов: реакция " + ("помогла" if success else "не помогла") + " (" + str(entry['successes']) + "/" + str(entry['uses']) + ")")
+
+def refresh_worker(sensor_data):
+    """Фоновое обновление реакции: новый ответ сам попадает в кэш"""
+    try:
+        query_openrouter_obstacle(sensor_data)
+    finally:
+        reflex_stats['refreshing'] = False
+
+def refresh_reflex(sensor_data):
+    """Запускает фоновое обновление реакции, если позволяет лимит запросов"""
+    with reflex_lock:
+        if reflex_stats['refreshing'] or not llm_request_allowed("obstacle"):
+            return
+        reflex_stats['refreshing'] = True
+        reflex_stats['refreshes'] += 1
+    
+    print("Кэш рефлексов: обновляю реакцию в фоне")
+    threading.Thread(target=refresh_worker, args=(dict(sensor_data),), daemon=True).start()
+
+def get_reflex_actions(event):
+    """Локальная реакция на событие из REFLEX_RULES (проверяется как ответ нейросети)"""
+    return [validate_action(action_data) for action_data in REFLEX_RULES.get(event, [])]
+
+def react_with_reflex(event, query_function, *args):
+    """Мгновенная локальная реакция и параллельный запрос плана у нейросети.
+    
+    Рефлекс начинает выполняться сразу. План нейросети дополняет его
+    (REFLEX_LLM_MODE = "extend") или прерывает оставшуюся часть ("replace"),
+    но только если пришел не позже REFLEX_LLM_DEADLINE секунд после события.
+    """
+    started = time.time()
+    outcome = {}
+    arrived = threading.Event()
+    
+    def worker():
+        try:
+            outcome['actions'] = query_function(*args)
+        except Exception as e:
+            print("Ошибка запроса уточненного плана: " + str(e))
+        finally:
+            arrived.set()
+    
+    threading.Thread(target=worker, daemon=True).start()
+    
+    def in_time():
+        return arrived.is_set() and time.time() - started <= REFLEX_LLM_DEADLINE
+    
+    # Рефлекс и план нейросети - один план исполнителя: между ними не вклинится вытесненный план
+    plan = begin_plan(event)
+    try:
+        reflex_actions = get_reflex_actions(event)
+        if reflex_actions:
+            print("Рефлекс '" + event + "': " + str(len(reflex_actions)) + " действий, запуск через " + str(round((time.time() - started) * 1000, 1)) + " мс")
+            execute_action_sequence(reflex_actions, should_stop=in_time if REFLEX_LLM_MODE == "replace" else None, source=event)
+        
+        # План нейросети ждем короткими шагами: более важный план (например, "стоп") не ждет конца срока
+        deadline = started + REFLEX_LLM_DEADLINE
+        while not arrived.is_set() and not plan['preempt'].is_set() and time.time() < deadline:
+            arrived.wait(min(0.05, max(0.0, deadline - time.time())))
+        
+        if plan['preempt'].is_set():
+            print("Реакция '" + event + "' прервана более важным планом, план нейросети не выполняется")
+            return reflex_actions
+        
+        if in_time() and outcome.get('actions'):
+            print("План нейросети получен через " + str(round(time.time() - started, 2)) + " сек")
+            execute_action_sequence(outcome['actions'], source=event)
+            return outcome['actions']
+        
+        print("План нейросети не успел к сроку, остаюсь на рефлексе")
+        return reflex_actions
+    finally:
+        end_plan(plan)
+
+# Эпизод реакции на препятствие: одна реакция на всех, кто заметил препятствие
+obstacle_lock = threading.Lock()
+obstacle_flight = None
+obstacle_stats = {
+    'episodes': 0,
+    'suppressed': 0
+}
+
+def note_obstacle_duplicate(flight):
+    """Учитывает поток, заметивший препятствие во время идущей реакции (один раз на поток, под obstacle_lock)"""
+    thread_id = threading.current_thread().ident
+    if thread_id not in flight['threads']:
+        flight['threads'].add(thread_id)
+        obstacle_stats['suppressed'] += 1
+
+def begin_obstacle_flight(event):
+    """Начинает эпизод реакции или присоединяет к идущему (вызывается под obstacle_lock).
+    
+    Возвращает описание эпизода и True, если реакцию выполняет этот поток.
+    """
+    global obstacle_flight
+    
+    if obstacle_flight is not None:
+        note_obstacle_duplicate(obstacle_flight)
+        return obstacle_flight, False
+    
+    obstacle_flight = {
+        'event': event,
+        'started': time.time(),
+        'done': threading.Event(),
+        'actions': None,
+        'threads': set([threading.current_thread().ident])
+    }
+    obstacle_stats['episodes'] += 1
+    return obstacle_flight, True
+
+def finish_obstacle_flight(flight, actions_data):
+    """Завершает эпизод и будит потоки, ожидающие общую реакцию"""
+    global obstacle_flight
+    
+    with obstacle_lock:
+        flight['actions'] = actions_data
+        if obstacle_flight is flight:
+            obstacle_flight = None
+    flight['done'].set()
+
+def react_to_obstacle(sensor_data, event="obstacle", flight=None):
+    """Реакция на препятствие: из кэша рефлексов, иначе локальный рефлекс и параллельный запрос к нейросети.
+    
+    Одновременные вызовы из разных потоков объединяются в один эпизод:
+    реакцию выполняет первый поток, остальные ждут ее окончания и получают
+    тот же результат. flight передает check_obstacle, уже начавший эпизод.
+    """
+    if flight is None:
+        with obstacle_lock:
+            flight, leader = begin_obstacle_flight(event)
+        if not leader:
+            print("Препятствие уже обрабатывается (" + flight['event'] + "), жду общей реакции")
+            flight['done'].wait()
+            return flight['actions']
+    
+    actions_data = None
+    plan = None
+    try:
+        plan = begin_plan(event)
+        started = time.time()
+        cached_actions = get_cached_reflex(sensor_data)
+        
+        if cached_actions is not None:
+            print("Кэш рефлексов: реакция найдена за " + str(round((time.time() - started) * 1000, 1)) + " мс")
+            execute_action_sequence(cached_actions, source=event)
+            actions_data = cached_actions
+        else:
+            actions_data = react_with_reflex(event, query_openrouter_obstacle, sensor_data)
+        
+        record_reflex_outcome(sensor_data)
+    finally:
+        if plan is not None:
+            end_plan(plan)
+        finish_obstacle_flight(flight, actions_data)
+    
+    return actions_data
+
+def print_obstacle_report():
+    """Отчет по препятствиям: эпизоды, подавленные повторные реакции и кэш рефлексов"""
+    with obstacle_lock:
+        stats = dict(obstacle_stats)
+        flight = obstacle_flight
+    
+    print("\n" + "="*50)
+    print("ПРЕПЯТСТВИЯ")
+    print("="*50)
+    print("Эпизодов: " + str(stats['episodes']) + ", подавлено повторных реакций: " + str(stats['suppressed']))
+    print("Кэш рефлексов: попаданий " + str(reflex_stats['hits']) + ", промахов " + str(reflex_stats['misses']) +
+          ", обновлений " + str(reflex_stats['refreshes']))
+    if flight is not None:
+        print("Сейчас выполняется реакция '" + flight['event'] + "' (" + str(round(time.time() - flight['started'], 1)) + " сек)")
+
 def check_obstacle():
     """Проверка наличия препятствия и реакция на него"""
-    global obstacle_detected, last_obstacle_time, is_performing_action
+    global obstacle_detected, last_obstacle_time
     
     current_distance = safe_get_ir_distance()
     current_time = time.time()
     
     # Если обнаружено препятствие близко и прошло достаточно времени с последней реакции
-    if (current_distance < OBSTACLE_DISTANCE and 
-        not is_performing_action and
-        current_time - last_obstacle_time > 10):
+    with obstacle_lock:
+        # Препятствие уже обрабатывается другим вызовом: вторая реакция не запускается
+        if current_distance < OBSTACLE_DISTANCE and obstacle_flight is not None:
+            note_obstacle_duplicate(obstacle_flight)
+            return True
         
+        # Проверка и отметка времени под одной блокировкой: эпизод начинает только один поток
+        flight = None
+        if current_distance < OBSTACLE_DISTANCE and current_time - last_obstacle_time > 10:
+            last_obstacle_time = current_time
+            flight, leader = begin_obstacle_flight("obstacle")
+    
+    if flight is not None:
         obstacle_detected = True
-        last_obstacle_time = current_time
-        
-        # Останавливаем все моторы
-        stop_all()
         
-        print("\n" + "!"*50)
-        print("ОБНАРУЖЕНО ПРЕПЯТСТВИЕ!")
-        print("Расстояние: " + str(current_distance) + " см")
-        print("!"*50)
-        
-        # Запрашиваем реакцию у нейросети
-        sensor_data = get_sensor_data()
-        reaction_data = query_openrouter_obstacle(sensor_data)
+        # Если остановка или чтение датчиков не удались, эпизод закрывается, иначе ждущие потоки зависнут
+        try:
+            # Выполняемый план уступает реакции в ближайшей безопасной точке, моторы останавливаются сразу
+            request_preemption("obstacle")
+            stop_all()
+            remember_obstacle(current_distance)
+            
+            print("\n" + "!"*50)
+            print("ОБНАРУЖЕНО ПРЕПЯТСТВИЕ!")
+            print("Расстояние: " + str(current_distance) + " см")
+            print("!"*50)
+            
+            # Запрашиваем реакцию у нейросети
+            sensor_data = get_sensor_data()
+        except Exception:
+            finish_obstacle_flight(flight, None)
+            raise
         
-        if reaction_data:
-            is_performing_action = True
-            execute_action_sequence(reaction_data)
-            is_performing_action = False
+        react_to_obstacle(sensor_data, flight=flight)
         
         return True
     
     obstacle_detected = False
     return False
 
-def check_daily_limit():
-    """Проверка дневного лимита запросов"""
-    global daily_requests, daily_reset_time
+# Кэш планов для команд терминала: похожая команда в похожей ситуации выполняется без запроса
+plan_cache_lock = threading.Lock()
+plan_cache = OrderedDict()
+plan_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'skipped': 0,
+    'saved': 0.0
+}
+plan_cache_sync = {
+    'saved': 0.0,   # Когда кэш последний раз записан в файл
+    'dirty': False  # Есть изменения, не записанные в файл
+}
+
+def normalize_command(command):
+    """Нижний регистр, ё -> е, без знаков препинания и лишних пробелов"""
+    text = command.lower().replace("ё", "е")
+    return " ".join("".join(char if char.isalnum() else " " for char in text).split())
+
+def get_trigrams(text):
+    """Множество символьных триграмм строки с пробелами по краям"""
+    padded = " " + text + " "
+    return set(padded[index:index + 3] for index in range(len(padded) - 2))
+
+def trigram_similarity(first, second):
+    """Сходство двух множеств триграмм (коэффициент Жаккара)"""
+    if not first or not second:
+        return 0.0
+    return len(first & second) / float(len(first | second))
+
+def get_plan_signature(sensor_data):
+    """Грубая сигнатура ситуации: сектор расстояния, цвет и период суток"""
+    distance_bucket = int(sensor_data['ir_distance']) // PLAN_CACHE_DISTANCE_STEP
+    return str(distance_bucket) + "|" + str(sensor_data.get('color', 'NoColor')) + "|" + get_day_period(sensor_data['timestamp'])
+
+def plan_cache_allowed(normalized):
+    """Команды с ключевыми словами из PLAN_CACHE_SKIP (шутки и т.п.) всегда идут к нейросети"""
+    return PLAN_CACHE_ENABLED and bool(normalized) and not any(word in normalized for word in PLAN_CACHE_SKIP)
+
+def get_command_keys(normalized):
+    """Числа, отрицания и направления в команде по порядку: 'вперед на 10' и 'вперед на 50',
+    'атакуй кота' и 'не атакуй кота' не должны делить один план"""
+    return [word for word in normalized.split() if word.isdigit() or word in PLAN_CACHE_KEY_WORDS]
+
+def get_content_words(normalized):
+    """Значимые слова команды: без чисел, ключевых и служебных слов"""
+    return [word for word in normalized.split() if not word.isdigit() and word not in PLAN_CACHE_KEY_WORDS and word not in PLAN_CACHE_STOP_WORDS]
+
+def get_command_trigrams(normalized):
+    """Триграммы команды без служебных слов: 'скажи привет' и 'скажи привет пожалуйста' - одна команда"""
+    return get_trigrams(" ".join(word for word in normalized.split() if word not in PLAN_CACHE_STOP_WORDS))
+
+def content_words_match(first, second):
+    """Каждому значимому слову одной команды есть близкое по триграммам слово в другой (и наоборот)"""
+    first = [get_trigrams(word) for word in get_content_words(first)]
+    second = [get_trigrams(word) for word in get_content_words(second)]
+    
+    def covered(words, others):
+        return all(any(trigram_similarity(word, other) >= PLAN_CACHE_WORD_SIMILARITY for other in others) for word in words)
+    
+    return covered(first, second) and covered(second, first)
+
+def get_plan_cache_path():
+    """Путь к файлу кэша планов"""
+    return os.path.join(SCRIPT_DIR, PLAN_CACHE_FILE)
+
+def load_plan_cache():
+    """Загружает кэш планов при запуске; устаревшие записи отбрасываются, действия проверяются заново"""
+    path = get_plan_cache_path()
+    if not PLAN_CACHE_ENABLED or not os.path.exists(path):
+        return
+    
+    try:
+        with open(path, encoding='utf-8') as cache_file:
+            data = json.load(cache_file)
+    except (IOError, OSError, ValueError) as e:
+        print("Не удалось загрузить кэш планов: " + str(e))
+        return
+    
+    now = time.time()
+    with plan_cache_lock:
+        plan_cache.clear()
+        for entry in data.get('entries', []):
+            if now - entry.get('created', 0) > PLAN_CACHE_TTL or not entry.get('actions'):
+                continue
+            entry['actions'] = [validate_action(action_data) for action_data in entry['actions'] if isinstance(action_data, dict)]
+            entry['trigrams'] = get_command_trigrams(entry['command'])
+            plan_cache[entry['signature'] + "|" + entry['command']] = entry
+        while len(plan_cache) > PLAN_CACHE_SIZE:
+            plan_cache.popitem(last=False)
+        for key in plan_cache_stats:
+            plan_cache_stats[key] = data.get('stats', {}).get(key, plan_cache_stats[key])
+        plan_cache_sync['saved'] = now
+    
+    print("Загружен кэш планов: " + str(len(plan_cache)) + " команд")
+
+def save_plan_cache():
+    """Атомарно сохраняет кэш планов в порядке использования (вызывается под plan_cache_lock)"""
+    path = get_plan_cache_path()
+    tmp_path = path + ".tmp"
+    entries = []
+    for entry in plan_cache.values():
+        item = dict((key, value) for key, value in entry.items() if key != 'trigrams')
+        item['actions'] = [action_data.to_dict() for action_data in entry['actions']]
+        entries.append(item)
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+            json.dump({'stats': plan_cache_stats, 'entries': entries}, cache_file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        plan_cache_sync['saved'] = time.time()
+        plan_cache_sync['dirty'] = False
+    except (IOError, OSError) as e:
+        print("Не удалось сохранить кэш планов: " + str(e))
+
+def get_cached_plan(command, sensor_data):
+    """Ищет план для команды среди записей с той же сигнатурой ситуации.
+    
+    Числа, отрицания и направления должны совпадать дословно, значимые
+    слова - с точностью до опечаток и словоформ, а вся строка - по
+    сходству триграмм не ниже PLAN_CACHE_SIMILARITY. Возвращает копию
+    действий или None.
+    """
+    normalized = normalize_command(command)
+    if not PLAN_CACHE_ENABLED or not normalized:
+        return None
+    
+    if not plan_cache_allowed(normalized):
+        with plan_cache_lock:
+            plan_cache_stats['skipped'] += 1
+        return None
+    
+    signature = get_plan_signature(sensor_data)
+    trigrams = get_command_trigrams(normalized)
+    keys = get_command_keys(normalized)
+    now = time.time()
+    
+    with plan_cache_lock:
+        best_key = None
+        best_score = PLAN_CACHE_SIMILARITY
+        for key, entry in list(plan_cache.items()):
+            if now - entry['created'] > PLAN_CACHE_TTL:
+                del plan_cache[key]
+                plan_cache_sync['dirty'] = True
+                continue
+            if entry['signature'] != signature or get_command_keys(entry['command']) != keys:
+                continue
+            if entry['command'] == normalized:
+                score = 1.0
+            else:
+                score = trigram_similarity(trigrams, entry['trigrams'])
+                # Сходство всей строки не замечает подмену одного слова ('скажи привет' и 'скажи пока')
+                if score < best_score or not content_words_match(normalized, entry['command']):
+                    continue
+            if score >= best_score:
+                best_key = key
+                best_score = score
+        
+        if best_key is None:
+            plan_cache_stats['misses'] += 1
+            return None
+        
+        entry = plan_cache[best_key]
+        plan_cache.move_to_end(best_key)
+        entry['hits'] += 1
+        entry['used'] = now
+        plan_cache_stats['hits'] += 1
+        plan_cache_stats['saved'] += entry['latency']
+        actions_data = [action_data.copy() for action_data in entry['actions']]
+        matched = entry['command']
+        # Попадание меняет только счетчики и порядок: файл переписывается не чаще PLAN_CACHE_SAVE_INTERVAL
+        plan_cache_sync['dirty'] = True
+        if now - plan_cache_sync['saved'] >= PLAN_CACHE_SAVE_INTERVAL:
+            save_plan_cache()
+    
+    print("Кэш планов: '" + command + "' -> '" + matched + "' (сходство " + str(round(best_score, 2)) + ")")
+    return actions_data
+
+def store_plan(command, sensor_data, actions_data, latency):
+    """Сохраняет план нейросети для команды; при переполнении вытесняется давно не использованный"""
+    normalized = normalize_command(command)
+    if not actions_data or not plan_cache_allowed(normalized):
+        return
+    
+    signature = get_plan_signature(sensor_data)
+    key = signature + "|" + normalized
+    now = time.time()
+    
+    with plan_cache_lock:
+        plan_cache[key] = {
+            'command': normalized,
+            'signature': signature,
+            'actions': [action_data.copy() for action_data in actions_data],
+            'created': now,
+            'used': now,
+            'hits': 0,
+            'latency': round(latency, 3),
+            'trigrams': get_command_trigrams(normalized)
+        }
+        plan_cache.move_to_end(key)
+        while len(plan_cache) > PLAN_CACHE_SIZE:
+            plan_cache.popitem(last=False)
+        save_plan_cache()
+
+def flush_plan_cache():
+    """Записывает отложенные изменения кэша планов (при выходе)"""
+    with plan_cache_lock:
+        if plan_cache_sync['dirty']:
+            save_plan_cache()
+
+def print_plan_cache_report():
+    """Отчет кэша планов: доля попаданий, сэкономленное время и частые команды"""
+    with plan_cache_lock:
+        stats = dict(plan_cache_stats)
+        entries = sorted(plan_cache.values(), key=lambda entry: entry['hits'], reverse=True)
+    
+    print("\n" + "="*50)
+    print("КЭШ ПЛАНОВ")
+    print("="*50)
+    
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = int(100.0 * stats['hits'] / lookups) if lookups else 0
+    print("Записей: " + str(len(entries)) + " из " + str(PLAN_CACHE_SIZE))
+    print("Попаданий: " + str(stats['hits']) + " из " + str(lookups) + " (" + str(hit_rate) + "%), без кэша: " + str(stats['skipped']))
+    print("Сэкономлено ожидания: " + str(round(stats['saved'], 1)) + " сек")
+    
+    for entry in entries[:5]:
+        if entry['hits'] == 0:
+            break
+        print("- '" + entry['command'] + "': " + str(entry['hits']) + " раз, ответ нейросети " + str(entry['latency']) + " сек")
+
+# Быстрый разбор простых команд терминала ("вперед 2 секунды", "налево 90", "стоп") без нейросети
+NUMBER_WORDS = {
+    "ноль": 0, "пол": 0.5, "половину": 0.5, "один": 1, "одна": 1, "одну": 1, "полтора": 1.5, "полторы": 1.5,
+    "два": 2, "две": 2, "три": 3, "четыре": 4, "пять": 5, "шесть": 6, "семь": 7, "восемь": 8, "девять": 9,
+    "десять": 10, "одиннадцать": 11, "двенадцать": 12, "тринадцать": 13, "четырнадцать": 14, "пятнадцать": 15,
+    "шестнадцать": 16, "семнадцать": 17, "восемнадцать": 18, "девятнадцать": 19, "двадцать": 20,
+    "тридцать": 30, "сорок": 40, "пятьдесят": 50, "шестьдесят": 60, "семьдесят": 70, "восемьдесят": 80,
+    "девяносто": 90, "сто": 100, "двести": 200, "триста": 300
+}
+FAST_DIRECTIONS = {
+    "вперед": "move_forward", "прямо": "move_forward",
+    "назад": "move_backward",
+    "налево": "turn_left", "влево": "turn_left",
+    "направо": "turn_right", "вправо": "turn_right",
+    "разворот": "turn_around", "развернись": "turn_around", "кругом": "turn_around",
+    "стоп": "stop", "стой": "stop", "остановись": "stop", "хватит": "stop", "замри": "stop",
+    "атакуй": "attack", "атака": "attack", "атаку": "attack", "руби": "attack"
+}
+FAST_NUMBER = re.compile(r'[0-9]+(\.[0-9]+)?$')  # Только цифры: float() принял бы и "nan", "inf", "1e2"
+FAST_FILLERS = set([
+    "поехали", "едь", "езжай", "поезжай", "двигайся", "иди", "поверни", "повернись", "поворачивай",
+    "поворот", "на", "в", "давай", "пожалуйста", "робот", "еще", "ножом", "лезвием"
+])
+FAST_SEPARATORS = set(["и", "потом", "затем", "после"])
+FAST_SPEEDS = {"быстро": FAST_COMMAND_FAST_SPEED, "медленно": FAST_COMMAND_SLOW_SPEED}
+fast_command_stats = {
+    'parsed': 0,
+    'fallbacks': 0,
+    'times': []
+}
+
+def tokenize_fast_command(command):
+    """Слова команды: нижний регистр, ё -> е, десятичная запятая -> точка"""
+    text = command.lower().replace("ё", "е").replace(",", ".")
+    tokens = "".join(char if char.isalnum() or char == "." else " " for char in text).split()
+    return [token.strip(".") for token in tokens if token.strip(".")]
+
+def parse_number(token):
+    """Число из цифр или числительного; None, если это не число"""
+    if FAST_NUMBER.match(token):
+        return float(token)
+    return NUMBER_WORDS.get(token)
+
+def get_unit(token):
+    """Единица измерения: seconds, degrees или None"""
+    if token == "с" or token.startswith("сек"):
+        return "seconds"
+    if token.startswith("градус"):
+        return "degrees"
+    return None
+
+def parse_fast_segment(tokens):
+    """Одно действие из части команды или None, если в ней есть непонятное слово"""
+    action = None
+    value = None
+    unit = None
+    speed = None
+    previous = None  # Предыдущее числительное: "сто восемьдесят", "двадцать пять"
+    
+    for token in tokens:
+        if token in FAST_DIRECTIONS and action is None:
+            action = FAST_DIRECTIONS[token]
+            previous = None
+            continue
+        
+        number = parse_number(token)
+        if number is not None:
+            if value is None:
+                value = number
+            elif previous is not None and token in NUMBER_WORDS and previous >= 20 and previous % 10 == 0 and number < (100 if previous >= 100 else 10):
+                value += number
+            else:
+                return None
+            previous = number
+            continue
+        previous = None
+        
+        # "полсекунды" пишется одним словом
+        if token.startswith("пол") and get_unit(token[3:]) == "seconds" and value is None and unit is None:
+            value = 0.5
+            unit = "seconds"
+        elif get_unit(token) is not None and value is not None and unit is None:
+            unit = get_unit(token)
+        elif token in FAST_SPEEDS and speed is None:
+            speed = FAST_SPEEDS[token]
+        elif token not in FAST_FILLERS:
+            return None
+    
+    if action is None or value == 0:
+        return None
+    
+    if action == "stop":
+        if value is not None or speed is not None:
+            return None
+        return {"action": "stop", "speed": 0, "duration": 0.1, "angle": 0, "speech": ""}
+    
+    if action in ("turn_left", "turn_right", "turn_around"):
+        if unit == "seconds" or (action == "turn_around" and value is not None):
+            return None
+        angle = 180 if action == "turn_around" else (value if value is not None else FAST_COMMAND_ANGLE)
+        if angle > MAX_TURN_ANGLE:
+            return None
+        return {"action": "turn_left" if action == "turn_around" else action, "speed": speed or FAST_COMMAND_SPEED, "duration": 0, "angle": angle, "speech": ""}
+    
+    # Движение и атака: число без единиц - секунды; больше допустимого - пусть решает нейросеть
+    if unit == "degrees":
+        return None
+    duration = value if value is not None else FAST_COMMAND_DURATION
+    if duration > (MAX_ATTACK_DURATION if action == "attack" else MAX_MOVE_DURATION):
+        return None
+    if action == "attack":
+        return {"action": "attack", "speed": speed or MAX_BLADE_SPEED, "duration": duration, "angle": 0, "speech": ""}
+    return {"action": action, "speed": speed or FAST_COMMAND_SPEED, "duration": duration, "angle": 0, "speech": ""}
+
+def parse_fast_command(command):
+    """План для простой команды или None, если ее должна разобрать нейросеть.
+    
+    Команда делится на части союзами "и", "потом", "затем"; в каждой части
+    должно быть одно направление и только понятные разбору слова.
+    """
+    if not FAST_COMMANDS_ENABLED:
+        return None
+    
+    segments = [[]]
+    for token in tokenize_fast_command(command):
+        if token in FAST_SEPARATORS:
+            segments.append([])
+        else:
+            segments[-1].append(token)
+    
+    actions_data = []
+    for segment in segments:
+        if not segment:
+            continue
+        action_data = parse_fast_segment(segment)
+        if action_data is None:
+            return None
+        actions_data.append(validate_action(action_data))
+    
+    if not actions_data or len(actions_data) > MAX_SEQUENCE_ACTIONS:
+        return None
+    return actions_data
+
+def get_local_plan(command, sensor_data):
+    """План без запроса к нейросети: быстрый разбор простой команды, затем кэш планов"""
+    started = time.time()
+    actions_data = parse_fast_command(command)
+    elapsed = time.time() - started
+    
+    if actions_data is not None:
+        fast_command_stats['parsed'] += 1
+        fast_command_stats['times'].append(elapsed)
+        if len(fast_command_stats['times']) > LATENCY_WINDOW:
+            del fast_command_stats['times'][0]
+        print("Быстрый разбор: '" + command + "' -> " + ", ".join(action_data['action'] for action_data in actions_data) + " (" + str(round(elapsed * 1000, 2)) + " мс)")
+        return actions_data
+    
+    if FAST_COMMANDS_ENABLED:
+        fast_command_stats['fallbacks'] += 1
+    return get_cached_plan(command, sensor_data)
+
+def print_fast_command_report():
+    """Отчет быстрого разбора: доля команд без нейросети и время разбора"""
+    parsed = fast_command_stats['parsed']
+    total = parsed + fast_command_stats['fallbacks']
+    samples = sorted(fast_command_stats['times'])
+    
+    print("\n" + "="*50)
+    print("БЫСТРЫЕ КОМАНДЫ")
+    print("="*50)
+    print("Разобрано без нейросети: " + str(parsed) + " из " + str(total) + " (" + str(int(100.0 * parsed / total) if total else 0) + "%)")
+    if samples:
+        print("Время разбора p50/p95/p99: " + " / ".join(str(round(percentile(samples, percent) * 1000, 2)) for percent in (50, 95, 99)) + " мс")
+
+def get_budget_path():
+    """Путь к журналу расхода лимита"""
+    return os.path.join(SCRIPT_DIR, BUDGET_FILE)
+
+def load_budget_ledger():
+    """Загружает журнал расхода лимита; журнал за прошлый день не учитывается"""
+    path = get_budget_path()
+    if not os.path.exists(path):
+        return
+    
+    try:
+        with open(path, encoding='utf-8') as ledger_file:
+            data = json.load(ledger_file)
+    except (IOError, OSError, ValueError) as e:
+        print("Не удалось загрузить журнал лимита: " + str(e))
+        return
+    
+    with budget_lock:
+        if data.get('date') == budget_ledger['date']:
+            budget_ledger['spent'] = dict(data.get('spent', {}))
+            print("Журнал лимита: сегодня уже потрачено " + str(sum(budget_ledger['spent'].values())) + " запросов")
+
+def save_budget_ledger():
+    """Атомарно сохраняет журнал: запись во временный файл и замена (вызывается под budget_lock)"""
+    path = get_budget_path()
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as ledger_file:
+            json.dump(budget_ledger, ledger_file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except (IOError, OSError) as e:
+        print("Не удалось сохранить журнал лимита: " + str(e))
+
+def roll_budget_day():
+    """Сбрасывает журнал с наступлением нового дня (вызывается под budget_lock)"""
+    today = datetime.now().strftime("%Y-%m-%d")
+    if budget_ledger['date'] != today:
+        budget_ledger['date'] = today
+        budget_ledger['spent'] = {}
+        print("Сброс дневного лимита запросов")
+
+def get_budget_reserve(context_type):
+    """Сколько запросов зарезервировано за типом запросов"""
+    return int(DAILY_REQUEST_LIMIT * BUDGET_SHARES.get(context_type, 0))
+
+def get_protected_budget(context_type):
+    """Неизрасходованный резерв типов, более важных, чем context_type (вызывается под budget_lock)"""
+    if context_type in BUDGET_PRIORITY:
+        higher = BUDGET_PRIORITY[:BUDGET_PRIORITY.index(context_type)]
+    else:
+        higher = BUDGET_PRIORITY
+    
+    spent = budget_ledger['spent']
+    return sum(max(0, get_budget_reserve(other) - spent.get(other, 0)) for other in higher)
+
+def get_budget_available(context_type):
+    """Сколько еще запросов может сделать тип: остаток своей доли или свободная часть лимита"""
+    spent = budget_ledger['spent']
+    remaining = DAILY_REQUEST_LIMIT - sum(spent.values())
+    if context_type is None:
+        return max(0, remaining)
     
+    own = get_budget_reserve(context_type) - spent.get(context_type, 0)
+    borrowed = remaining - get_protected_budget(context_type)
+    return max(0, min(remaining, max(own, borrowed)))
+
+def check_daily_limit(context_type=None):
+    """Проверка дневного лимита облачных запросов (с учетом доли типа запроса, если он указан)"""
     if not ENABLE_REQUEST_LIMIT:
         return True
-        
+    
+    with budget_lock:
+        roll_budget_day()
+        return get_budget_available(context_type) > 0
+
+def spend_budget(context_type):
+    """Записывает успешный запрос в журнал расхода лимита"""
+    with budget_lock:
+        roll_budget_day()
+        spent = budget_ledger['spent']
+        spent[context_type] = spent.get(context_type, 0) + 1
+        budget_last_spent[context_type] = time.time()
+        save_budget_ledger()
+
+def get_seconds_until_reset():
+    """Секунд до сброса дневного лимита (полночь)"""
     now = datetime.now()
-    if now >= daily_reset_time:
-        daily_requests = 0
-        daily_reset_time = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
-        print("Сброс дневного лимита запросов")
+    reset_time = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    return (reset_time - now).total_seconds()
+
+def get_budget_status():
+    """Состояние дневного лимита: общий расход и доли по типам запросов"""
+    with budget_lock:
+        roll_budget_day()
+        spent = dict(budget_ledger['spent'])
+        classes = {}
+        for context_type in BUDGET_PRIORITY:
+            classes[context_type] = {
+                'share': BUDGET_SHARES.get(context_type, 0),
+                'reserve': get_budget_reserve(context_type),
+                'spent': spent.get(context_type, 0),
+                'available': get_budget_available(context_type)
+            }
+    
+    total = sum(spent.values())
+    return {
+        'enabled': ENABLE_REQUEST_LIMIT,
+        'limit': DAILY_REQUEST_LIMIT,
+        'spent': total,
+        'remaining': max(0, DAILY_REQUEST_LIMIT - total),
+        'reset_in': get_seconds_until_reset(),
+        'classes': classes
+    }
+
+def get_autonomous_pacing():
+    """Минимальная пауза между автономными запросами, чтобы их доля растянулась до конца дня"""
+    if not ENABLE_REQUEST_LIMIT or not BUDGET_AUTONOMOUS_PACING:
+        return 0
     
-    return daily_requests < DAILY_REQUEST_LIMIT
+    status = get_budget_status()
+    available = status['classes'].get('autonomous', {}).get('available', status['remaining'])
+    if available <= 0:
+        return status['reset_in']
+    return status['reset_in'] / available
 
 def get_remaining_requests():
     """Получение количества оставшихся запросов"""
     if not ENABLE_REQUEST_LIMIT:
         return "не ограничено"
-    remaining = DAILY_REQUEST_LIMIT - daily_requests
-    return str(remaining)
+    return str(get_budget_status()['remaining'])
 
+def print_budget_report():
+    """Отчет о расходе дневного лимита по типам запросов"""
+    status = get_budget_status()
+    
+    print("\n" + "="*50)
+    print("ДНЕВНОЙ ЛИМИТ ЗАПРОСОВ")
+    print("="*50)
+    
+    if status['enabled']:
+        print("Потрачено " + str(status['spent']) + " из " + str(status['limit']) + ", осталось " + str(status['remaining']) +
+              ", сброс через " + str(int(status['reset_in'] // 3600)) + " ч " + str(int(status['reset_in'] % 3600 // 60)) + " мин")
+    else:
+        print("Лимит отключен, потрачено " + str(status['spent']) + " запросов")
+    
+    for context_type in BUDGET_PRIORITY:
+        item = status['classes'][context_type]
+        print("  " + context_type + ": потрачено " + str(item['spent']) + ", доля " + str(int(item['share'] * 100)) + "% (" + str(item['reserve']) + "), доступно " + str(item['available']))
+    
+    if status['enabled'] and BUDGET_AUTONOMOUS_PACING:
+        print("Автономные запросы не чаще раза в " + str(int(get_autonomous_pacing())) + " сек")
+
+@traced("motion")
 def move_forward(speed=50, duration=1.0):
     """Движение вперед с проверкой препятствий"""
     global obstacle_detected
@@ -296,10 +1223,16 @@ def move_forward(speed=50, duration=1.0):
     
     start_time = time.time()
     while time.time() - start_time < duration:
-        # Проверяем препятствие каждые 0.1 секунды
-        if check_obstacle():
+        # Каждые 0.1 секунды - безопасная точка: препятствие или более важный план останавливают движение
+        if safe_get_ir_distance() < OBSTACLE_DISTANCE:
             print("Прервано из-за препятствия")
-            return
+            # Реакция на препятствие начинается отсюда же, в своем потоке: движение идет на дорожке
+            # плана, и план уступит реакции, когда эта дорожка освободится
+            threading.Thread(target=check_obstacle, daemon=True).start()
+            break
+        if plan_should_yield():
+            print("Движение прервано более важным планом")
+            break
         
         left_motor.on(speed)
         right_motor.on(speed)
@@ -308,6 +1241,7 @@ def move_forward(speed=50, duration=1.0):
     left_motor.off()
     right_motor.off()
 
+@traced("motion")
 def move_backward(speed=50, duration=1.0):
     """Движение назад с ограничением времени"""
     duration = min(duration, MAX_MOVE_DURATION)
@@ -317,10 +1251,11 @@ def move_backward(speed=50, duration=1.0):
     
     left_motor.on(-speed)
     right_motor.on(-speed)
-    time.sleep(duration)
+    preemptible_sleep(duration)
     left_motor.off()
     right_motor.off()
 
+@traced("motion")
 def turn_left(speed=30, angle=90):
     """Поворот налево с ограничением угла и времени"""
     angle = min(angle, MAX_TURN_ANGLE)
@@ -345,21 +1280,25 @@ def turn_left(speed=30, angle=90):
                 if time.time() - start_time > MAX_TURN_DURATION:
                     print("Превышено максимальное время поворота")
                     break
+                if plan_should_yield():
+                    print("Поворот прерван более важным планом")
+                    break
                 time.sleep(0.01)
         except Exception as e:
             print("Ошибка при повороте с гироскопом: " + str(e))
             # Резервный вариант без гироскопа
             left_motor.on(-speed)
             right_motor.on(speed)
-            time.sleep(angle / 90 * 0.8)
+            preemptible_sleep(angle / 90 * 0.8)
     else:
         left_motor.on(-speed)
         right_motor.on(speed)
-        time.sleep(angle / 90 * 0.8)
+        preemptible_sleep(angle / 90 * 0.8)
     
     left_motor.off()
     right_motor.off()
 
+@traced("motion")
 def turn_right(speed=30, angle=90):
     """Поворот направо с ограничением угла и времени"""
     angle = min(angle, MAX_TURN_ANGLE)
@@ -384,21 +1323,25 @@ def turn_right(speed=30, angle=90):
                 if time.time() - start_time > MAX_TURN_DURATION:
                     print("Превышено максимальное время поворота")
                     break
+                if plan_should_yield():
+                    print("Поворот прерван более важным планом")
+                    break
                 time.sleep(0.01)
         except Exception as e:
             print("Ошибка при повороте с гироскопом: " + str(e))
             # Резервный вариант без гироскопа
             left_motor.on(speed)
             right_motor.on(-speed)
-            time.sleep(angle / 90 * 0.8)
+            preemptible_sleep(angle / 90 * 0.8)
     else:
         left_motor.on(speed)
         right_motor.on(-speed)
-        time.sleep(angle / 90 * 0.8)
+        preemptible_sleep(angle / 90 * 0.8)
     
     left_motor.off()
     right_motor.off()
 
+@traced("motion")
 def attack_with_blade(speed=100, duration=1.0):
     """Атака лезвием с ограничением времени"""
     leds.set_color('LEFT', 'RED')
@@ -410,11 +1353,18 @@ def attack_with_blade(speed=100, duration=1.0):
     print("Атака лезвием: скорость " + str(speed) + ", время " + str(duration) + " сек")
     
     blade_motor.on(speed)
-    time.sleep(duration)
+    preemptible_sleep(duration)
     blade_motor.off()
     leds.set_color('LEFT', 'AMBER')
     leds.set_color('RIGHT', 'AMBER')
 
+@traced("motion")
+def set_leds(color):
+    """Подсветка обеих сторон одним цветом"""
+    leds.set_color('LEFT', color)
+    leds.set_color('RIGHT', color)
+
+@traced("motion")
 def stop_all():
     """Остановка всех моторов"""
     print("Остановка всех моторов")
@@ -436,6 +1386,7 @@ def get_random_mood():
     ]
     return random.choice(moods)
 
+@traced("prompt")
 def get_situation_description(sensor_data):
     """Генерирует описание ситуации на основе данных датчиков"""
     distance = sensor_data['ir_distance']
@@ -462,6 +1413,7 @@ def get_situation_description(sensor_data):
     else:
         return "Объект " + distance_desc + " (" + str(distance) + " единиц), " + color_desc_text + "."
 
+@traced("prompt")
 def get_context_prompt():
     """Создает контекстный промпт с разнообразными вариантами"""
     moods = [
@@ -490,21 +1442,152 @@ def get_context_prompt():
     result = mood_template.replace("{mood}", mood).replace("{action}", action)
     return result
 
+# Специальные символы JSON: все остальное сканер пропускает одним шагом регулярного выражения
+JSON_SPECIAL_CHARS = re.compile(r'[{}\[\]"\\]')
+
+class JsonScanner:
+    """Однопроходный поиск JSON-значений в тексте ответа.
+    
+    Отслеживает вложенность фигурных и квадратных скобок и строки JSON,
+    пропускает текст вокруг JSON и markdown-ограждения и запоминает висячие
+    запятые перед закрывающими скобками. Текст можно передать целиком или
+    по фрагментам потока: состояние сохраняется между вызовами feed.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.in_string = False
+        self.skip = 0
+        self.starts = []
+        self.commas = []
+
+    def feed(self, chunk):
+        """Добавляет фрагмент текста и возвращает закрытые в нем значения: (начало, конец, глубина)"""
+        self.buffer += chunk
+        buffer = self.buffer
+        closed = []
+        
+        for match in JSON_SPECIAL_CHARS.finditer(buffer, self.position):
+            index = match.start()
+            if index < self.skip:
+                # Символ после обратной косой черты внутри строки
+                continue
+            char = buffer[index]
+            
+            if self.in_string:
+                if char == '\\':
+                    self.skip = index + 2
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                # Кавычки учитываются только внутри скобок, текст вокруг JSON пропускается
+                if self.starts:
+                    self.in_string = True
+            elif char == '{' or char == '[':
+                # Скобка сразу после кавычки вне JSON - пример в тексте ("[" или "{"): в JSON значение не начинается сразу после строки
+                if not self.starts and index > 0 and buffer[index - 1] == '"':
+                    continue
+                self.starts.append(index)
+            elif char != '\\' and self.starts:
+                start = self.starts[-1]
+                if (buffer[start] == '{') != (char == '}'):
+                    # Непарная скобка в тексте вокруг JSON
+                    continue
+                self.starts.pop()
+                
+                before = index - 1
+                while before > start and buffer[before] in ' \t\r\n':
+                    before -= 1
+                if buffer[before] == ',':
+                    self.commas.append(before)
+                
+                closed.append((start, index + 1, len(self.starts)))
+        
+        self.position = len(buffer)
+        return closed
+
+    def value(self, start, end):
+        """Разбирает закрытое значение без висячих запятых; None, если это не JSON"""
+        text = self.buffer[start:end]
+        commas = [comma - start for comma in self.commas if start < comma < end]
+        if commas:
+            parts = []
+            previous = 0
+            for comma in commas:
+                parts.append(text[previous:comma])
+                previous = comma + 1
+            parts.append(text[previous:])
+            text = "".join(parts)
+        
+        try:
+            # strict=False пропускает переносы строк внутри строк JSON, которые иногда пишут модели
+            return json.loads(text, strict=False)
+        except ValueError:
+            return None
+
+def is_action_object(value):
+    """Похоже ли значение на действие: объект с полем action или speech"""
+    return isinstance(value, dict) and ("action" in value or "speech" in value)
+
+def get_value_actions(value):
+    """Список действий из JSON-значения: массив, обертка {"actions": [...]} или одно действие"""
+    if isinstance(value, dict) and isinstance(value.get("actions"), list):
+        value = value["actions"]
+    if isinstance(value, list):
+        actions = [item for item in value if is_action_object(item)]
+        return actions or None
+    if is_action_object(value):
+        return [value]
+    return None
+
+@traced("parse")
 def extract_json_from_text(text):
-    """Извлекает JSON из текста, поддерживает массивы и одиночные объекты"""
+    """Извлекает список действий из текста ответа.
+    
+    Первый массив действий (или обертка {"actions": [...]}) верхнего уровня
+    возвращается целиком, отдельные объекты действий собираются по порядку.
+    Если ответ оборван, возвращаются действия, которые успели закрыться.
+    """
+    scanner = JsonScanner()
+    closed = scanner.feed(text)
+    
+    single_actions = []
+    for start, end, depth in closed:
+        if depth:
+            continue
+        value = scanner.value(start, end)
+        actions = get_value_actions(value)
+        if actions is None:
+            continue
+        if isinstance(value, dict) and "actions" not in value:
+            single_actions.extend(actions)
+        else:
+            return actions
+    
+    if single_actions:
+        return single_actions
+    
+    # Массив не закрылся: берем вложенные объекты действий, которые закрылись полностью
+    nested_actions = []
+    for start, end, depth in sorted(closed):
+        if depth and scanner.buffer[start] == '{' and (not nested_actions or start >= nested_actions[-1][0]):
+            value = scanner.value(start, end)
+            if is_action_object(value):
+                nested_actions.append((end, value))
+    
+    return [value for end, value in nested_actions] or None
+
+def extract_json_from_text_legacy(text):
+    """Прежний поиск JSON регулярными выражениями: оставлен для сравнения в тесте разбора"""
     import re
     
-    # Убираем markdown коды
     text = text.strip()
     text = text.replace('```json', '').replace('```', '')
     
-    # Ищем JSON (массив или объект)
-    # Паттерн для массива JSON объектов
     array_pattern = r'\[\s*\{[^{}]*\}\s*(?:,\s*\{[^{}]*\}\s*)*\]'
-    # Паттерн для одиночного JSON объекта
     object_pattern = r'\{[^{}]*\}'
     
-    # Сначала пробуем найти массив
     array_match = re.search(array_pattern, text, re.DOTALL)
     if array_match:
         try:
@@ -512,11 +1595,9 @@ def extract_json_from_text(text):
         except json.JSONDecodeError:
             pass
     
-    # Если массив не найден или не распарсился, ищем одиночный объект
     object_match = re.search(object_pattern, text, re.DOTALL)
     if object_match:
         try:
-            # Возвращаем как массив с одним элементом
             single_obj = json.loads(object_match.group())
             return [single_obj]
         except json.JSONDecodeError:
@@ -524,25 +1605,1803 @@ def extract_json_from_text(text):
     
     return None
 
-def query_openrouter_obstacle(sensor_data):
-    """Специальный запрос к нейросети при обнаружении препятствия"""
-    global daily_requests
-    
-    if not check_daily_limit():
-        return None
-    
-    distance = sensor_data['ir_distance']
-    
-    prompt = """Ты - робот EV3RSTORM. Перед тобой препятствие на расстоянии """ + str(distance) + """ сантиметров.
-    
-Ты должен отреагировать на препятствие. Ты можешь отправить ОДИН JSON объект или МАССИВ JSON объектов.
-Каждый JSON объект должен иметь формат:
+# Действия, которые умеет выполнять робот
+ACTION_NAMES = ["move_forward", "move_backward", "turn_left", "turn_right", "attack", "speak", "stop"]
+
+# Дорожки исполнителя: механизмы, которые работают независимо друг от друга
+TRACK_NAMES = ["speech", "drive", "blade", "leds"]
+LED_COLORS = ["BLACK", "RED", "GREEN", "AMBER", "ORANGE", "YELLOW"]
+
+# Какие дорожки занимает движение действия (речь - отдельно, если она есть)
+ACTION_TRACKS = {
+    "move_forward": ("drive",),
+    "move_backward": ("drive",),
+    "turn_left": ("drive",),
+    "turn_right": ("drive",),
+    "attack": ("blade", "leds"),
+    "stop": ("drive", "blade"),
+    "speak": ()
+}
+
+def build_action_schema():
+    """JSON-схема одного действия по словарю действий и ограничениям из конфигурации"""
+    return {
+        "type": "object",
+        "properties": {
+            "action": {"type": "string", "enum": ACTION_NAMES},
+            "speed": {"type": "integer", "minimum": 0, "maximum": 100},
+            "duration": {"type": "number", "minimum": 0, "maximum": MAX_MOVE_DURATION},
+            "angle": {"type": "integer", "minimum": 0, "maximum": MAX_TURN_ANGLE},
+            "speech": {"type": "string"},
+            "parallel": {"type": "boolean"},
+            "after": {"type": "string", "enum": ["none"] + TRACK_NAMES},
+            "leds": {"type": "string", "enum": ["none"] + LED_COLORS}
+        },
+        "required": ["action", "speed", "duration", "angle", "speech", "parallel", "after", "leds"],
+        "additionalProperties": False
+    }
+
+def build_plan_schema():
+    """Схема ответа: объект-обертка {"actions": [...]} с последовательностью действий"""
+    return {
+        "type": "object",
+        "properties": {
+            "actions": {
+                "type": "array",
+                "items": build_action_schema(),
+                "maxItems": MAX_SEQUENCE_ACTIONS
+            }
+        },
+        "required": ["actions"],
+        "additionalProperties": False
+    }
+
+def build_batch_schema():
+    """Схема пакетного ответа: {"plans": [[...], [...]]}, по плану на команду"""
+    return {
+        "type": "object",
+        "properties": {
+            "plans": {
+                "type": "array",
+                "items": {
+                    "type": "array",
+                    "items": build_action_schema(),
+                    "maxItems": MAX_SEQUENCE_ACTIONS
+                }
+            }
+        },
+        "required": ["plans"],
+        "additionalProperties": False
+    }
+
+def to_gemini_schema(schema):
+    """Схема в подмножестве OpenAPI, которое принимает Gemini (без additionalProperties)"""
+    if isinstance(schema, dict):
+        return dict((key, to_gemini_schema(value)) for key, value in schema.items() if key != "additionalProperties")
+    if isinstance(schema, list):
+        return [to_gemini_schema(item) for item in schema]
+    return schema
+
+PLAN_SCHEMA = build_plan_schema()
+BATCH_SCHEMA = build_batch_schema()
+
+def extract_actions(text):
+    """Действия из ответа: сначала как структурированный JSON {"actions": [...]}, затем поиском в тексте"""
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict) and isinstance(data.get("actions"), list):
+            return data["actions"]
+    except ValueError:
+        pass
+    
+    return extract_json_from_text(text)
+
+def extract_batch_plans(text, count):
+    """Извлекает из ответа массив планов: по одному массиву действий на каждую команду"""
+    scanner = JsonScanner()
+    
+    for start, end, depth in scanner.feed(text):
+        if depth:
+            continue
+        plans = scanner.value(start, end)
+        if isinstance(plans, dict):
+            plans = plans.get("plans")
+        if not isinstance(plans, list) or len(plans) != count:
+            continue
+        if all(isinstance(plan, (list, dict)) for plan in plans):
+            return plans
+    
+    return None
+
+# Образцы ответов моделей для теста разбора: (текст, число действий)
+PARSER_CORPUS = [
+    ('[{"action": "speak", "speed": 0, "duration": 0, "angle": 0, "speech": "Привет!"}]', 1),
+    ('```json\n[\n  {"action": "move_forward", "speed": 50, "duration": 2, "angle": 0, "speech": "Еду!"},\n'
+     '  {"action": "turn_left", "speed": 30, "duration": 0, "angle": 90, "speech": ""}\n]\n```', 2),
+    ('Конечно! Вот что я сделаю:\n[{"action": "attack", "speed": 80, "duration": 1, "angle": 0, "speech": "В атаку!"}]\n'
+     'Надеюсь, это весело.', 1),
+    ('{"action": "speak", "speed": 0, "duration": 0, "angle": 0, "speech": "Я робот {EV3RSTORM}, у меня есть [лезвие]"}', 1),
+    ('{"actions": [{"action": "turn_right", "speed": 30, "duration": 0, "angle": 45, "speech": "Смотрю направо"}, '
+     '{"action": "stop", "speed": 0, "duration": 0, "angle": 0, "speech": ""}]}', 2),
+    ('[{"action": "move_backward", "speed": 40, "duration": 1.5, "angle": 0, "speech": "Отъезжаю",},\n'
+     ' {"action": "turn_left", "speed": 30, "duration": 0, "angle": 90, "speech": "",},]', 2),
+    ('{"action": "speak", "speed": 0, "duration": 0, "angle": 0, "speech": "Раз"}\n'
+     '{"action": "speak", "speed": 0, "duration": 0, "angle": 0, "speech": "Два"}', 2),
+    ('[{"action": "speak", "speed": 0, "duration": 0, "angle": 0, "speech": "Он сказал: \\"стой\\"", '
+     '"params": {"mood": "веселый"}}]', 1),
+    ('Думаю... [пауза] Вот план: [{"action": "move_forward", "speed": 50, "duration": 1, "angle": 0, "speech": ""}]', 1),
+    ('[{"action": "move_forward", "speed": 50, "duration": 1, "angle": 0, "speech": "Вперед"}, '
+     '{"action": "turn_le', 1),
+    ('Использую "[" как пример: [{"action": "stop", "speed": 0, "duration": 0, "angle": 0, "speech": ""}]', 1),
+    ('Скобка "{" в кавычках, а вот ответ: {"action": "speak", "speed": 0, "duration": 0, "angle": 0, "speech": "Готов"}', 1)
+]
+
+# Текст, который модели добавляют вокруг JSON
+PARSER_FUZZ_PROSE = ["Хорошо!", "Вот план действий:", "Понял :)", "Ответ (в формате JSON):", "[Робот думает]", "Готово."]
+
+def mutate_parser_sample(text, generator):
+    """Случайно искажает образец так, как это делают модели: текст вокруг, ограждения, переносы, запятые"""
+    if generator.random() < 0.5:
+        text = generator.choice(PARSER_FUZZ_PROSE) + "\n" + text
+    if generator.random() < 0.5:
+        text = text + "\n" + generator.choice(PARSER_FUZZ_PROSE)
+    if generator.random() < 0.3:
+        text = "```json\n" + text + "\n```"
+    if generator.random() < 0.3:
+        text = text.replace(", ", ",\n    ")
+    if generator.random() < 0.3:
+        text = text.replace('""}', '"", }')
+    return text
+
+def build_parser_corpus(count=PARSER_FUZZ_SAMPLES, seed=44):
+    """Образцы ответов и их случайные искажения; генератор с фиксированным зерном дает одинаковый набор"""
+    generator = random.Random(seed)
+    samples = list(PARSER_CORPUS)
+    for _ in range(count):
+        text, expected = generator.choice(PARSER_CORPUS)
+        samples.append((mutate_parser_sample(text, generator), expected))
+    return samples
+
+def check_parser(parse, samples):
+    """Доля разобранных ответов и ответов с верным числом действий"""
+    parsed = 0
+    correct = 0
+    for text, expected in samples:
+        try:
+            actions = parse(text)
+        except Exception:
+            actions = None
+        if not actions or not all(isinstance(action, dict) for action in actions):
+            continue
+        parsed += 1
+        if len(actions) == expected and all("action" in action for action in actions):
+            correct += 1
+    return parsed, correct
+
+def measure_parser(parse, samples, rounds=PARSER_BENCHMARK_ROUNDS):
+    """Пропускная способность разбора: ответов в секунду и килобайт в секунду"""
+    size = sum(len(text.encode("utf-8")) for text, expected in samples)
+    started = time.time()
+    for _ in range(rounds):
+        for text, expected in samples:
+            try:
+                parse(text)
+            except Exception:
+                pass
+    elapsed = max(time.time() - started, 1e-6)
+    return len(samples) * rounds / elapsed, size * rounds / 1024.0 / elapsed
+
+def parse_streamed(text, chunk_size=16):
+    """Разбор того же текста фрагментами, как при потоковом ответе"""
+    parser = ActionStreamParser()
+    actions = []
+    for start in range(0, len(text), chunk_size):
+        actions.extend(parser.feed(text[start:start + chunk_size]))
+    return actions
+
+def print_parser_report():
+    """Тест разбора: прежний поиск регулярными выражениями против однопроходного сканера"""
+    samples = build_parser_corpus()
+    parsers = [
+        ("регулярные выражения", extract_json_from_text_legacy),
+        ("сканер", extract_json_from_text),
+        ("сканер, поток", parse_streamed)
+    ]
+    
+    print("Тест разбора JSON: " + str(len(samples)) + " ответов (" + str(len(PARSER_CORPUS)) + " образцов и искажения)")
+    for name, parse in parsers:
+        parsed, correct = check_parser(parse, samples)
+        per_second, kilobytes = measure_parser(parse, samples)
+        print("  " + name + ": разобрано " + str(round(100.0 * parsed / len(samples), 1)) + "%, верно "
+              + str(round(100.0 * correct / len(samples), 1)) + "%, " + str(int(per_second)) + " отв/с, "
+              + str(round(kilobytes, 1)) + " КБ/с")
+
+class Action:
+    """Проверенное действие робота.
+    
+    Поля хранятся в слотах, без словаря на каждый объект. Код, который читает
+    действия как словари (память разговора, журналы), по-прежнему может
+    писать action_data["speed"], action_data.get(...) и dict(action_data).
+    """
+
+    __slots__ = ("action", "speed", "duration", "angle", "speech", "parallel", "after", "leds")
+
+    def __init__(self, action, speed, duration, angle, speech, parallel=False, after="", leds=""):
+        self.action = action
+        self.speed = speed
+        self.duration = duration
+        self.angle = angle
+        self.speech = speech
+        self.parallel = parallel
+        self.after = after
+        self.leds = leds
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __repr__(self):
+        return "Action(" + repr(self.to_dict()) + ")"
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def keys(self):
+        return self.__slots__
+
+    def copy(self):
+        return Action(self.action, self.speed, self.duration, self.angle, self.speech, self.parallel, self.after, self.leds)
+
+    def to_dict(self):
+        """Словарь для сохранения в JSON"""
+        return {"action": self.action, "speed": self.speed, "duration": self.duration, "angle": self.angle, "speech": self.speech,
+                "parallel": self.parallel, "after": self.after, "leds": self.leds}
+
+def build_action_validator():
+    """Собирает проверку действий по ограничениям из конфигурации.
+    
+    Пределы скорости и длительности для каждого действия вычисляются один раз
+    при запуске. Проверка не меняет исходный словарь и возвращает новый Action.
+    """
+    limits = {}
+    for name in ACTION_NAMES:
+        if name == "attack":
+            limits[name] = (MAX_BLADE_SPEED, MAX_ATTACK_DURATION)
+        else:
+            limits[name] = (MAX_MOTOR_SPEED, MAX_MOVE_DURATION)
+    unknown_limits = limits["speak"]
+    max_angle = MAX_TURN_ANGLE
+    track_names = set(TRACK_NAMES)
+    led_colors = set(LED_COLORS)
+    
+    def validate(action_data, default_speed=ACTION_DEFAULT_SPEED):
+        """Дополняет действие значениями по умолчанию и ограничивает их для безопасности"""
+        get = action_data.get
+        name = get("action") or "speak"
+        speed = get("speed")
+        duration = get("duration")
+        angle = get("angle")
+        speech = get("speech")
+        after = get("after")
+        color = str(get("leds") or "").upper()
+        max_speed, max_duration = limits.get(name, unknown_limits)
+        
+        return Action(
+            str(name),
+            min(max(int(default_speed if speed is None else speed), 0), max_speed),
+            # Предел идет первым аргументом: NaN не проходит сравнения и заменяется им
+            min(max_duration, max(0.1, float(1.0 if duration is None else duration))),
+            min(max(int(90 if angle is None else angle), 0), max_angle),
+            "" if speech is None else str(speech),
+            str(get("parallel")).lower() == "true",
+            after if after in track_names else "",
+            color if color in led_colors else ""
+        )
+    
+    return validate
+
+validate_action = build_action_validator()
+
+def validate_plan(actions_data, default_speed=ACTION_DEFAULT_SPEED):
+    """Проверяет план из ответа: не больше MAX_SEQUENCE_ACTIONS действий, некорректные пропускаются"""
+    if not isinstance(actions_data, list):
+        actions_data = [actions_data]
+    
+    if len(actions_data) > MAX_SEQUENCE_ACTIONS:
+        actions_data = actions_data[:MAX_SEQUENCE_ACTIONS]
+        print("Ограничено количество действий до " + str(MAX_SEQUENCE_ACTIONS))
+    
+    validated_actions = []
+    for action_data in actions_data:
+        if not isinstance(action_data, (dict, Action)):
+            continue
+        try:
+            validated_actions.append(validate_action(action_data, default_speed))
+        except (TypeError, ValueError):
+            print("Пропущено некорректное действие: " + str(action_data)[:100])
+    
+    return validated_actions
+
+# Типичный сырой план из ответа нейросети для теста действий
+ACTION_BENCHMARK_PLAN = [
+    {"action": "move_forward", "speed": 50, "duration": 2, "angle": 0, "speech": "Еду вперед!"},
+    {"action": "turn_left", "speed": "30", "duration": 0, "angle": 270, "speech": ""},
+    {"action": "attack", "speed": 120, "duration": 5},
+    {"action": "speak", "speech": "Готово"},
+    {"action": "stop"}
+]
+
+def measure_per_call(function, rounds):
+    """Среднее время одного вызова в микросекундах"""
+    started = time.time()
+    for _ in range(rounds):
+        function()
+    return (time.time() - started) * 1000000.0 / rounds
+
+def print_action_report():
+    """Тест действий: проверка плана, создание действия и его размер в памяти по сравнению со словарем"""
+    plan = validate_plan(ACTION_BENCHMARK_PLAN)
+    sample = plan[0]
+    sample_dict = sample.to_dict()
+    rounds = ACTION_BENCHMARK_ROUNDS
+    
+    plan_time = measure_per_call(lambda: validate_plan(ACTION_BENCHMARK_PLAN), rounds)
+    action_time = measure_per_call(sample.copy, rounds)
+    dict_time = measure_per_call(sample_dict.copy, rounds)
+    dispatch_time = measure_per_call(lambda: ACTION_HANDLERS.get(sample.action), rounds)
+    
+    print("Тест действий (" + str(rounds) + " повторов):")
+    print("  Проверка плана из " + str(len(plan)) + " действий: " + str(round(plan_time, 1)) + " мкс")
+    print("  Создание действия: Action " + str(round(action_time, 2)) + " мкс, словарь " + str(round(dict_time, 2)) + " мкс")
+    print("  Память: Action " + str(sys.getsizeof(sample)) + " байт, словарь " + str(sys.getsizeof(sample_dict)) + " байт")
+    print("  Выбор исполнителя по таблице: " + str(round(dispatch_time, 2)) + " мкс")
+
+class ActionStreamParser(JsonScanner):
+    """Инкрементальный разбор потока текста ответа.
+    
+    Каждый объект действия отдается сразу после его закрывающей скобки,
+    не дожидаясь конца ответа.
+    """
+
+    def feed(self, chunk):
+        """Добавляет фрагмент текста и возвращает список завершенных действий"""
+        actions = []
+        
+        for start, end, depth in JsonScanner.feed(self, chunk):
+            if self.buffer[start] != '{':
+                continue
+            candidate = self.value(start, end)
+            if isinstance(candidate, dict) and "action" in candidate:
+                actions.append(candidate)
+        
+        return actions
+
+def create_action_stream(on_action, default_speed=ACTION_DEFAULT_SPEED):
+    """Готовит обработчик потока: каждое завершенное действие проверяется и сразу уходит исполнителю.
+    
+    Возвращает функцию для фрагментов текста (или None, если поток не нужен)
+    и список уже переданных действий.
+    """
+    streamed_actions = []
+    
+    if on_action is None or not STREAM_RESPONSES:
+        return None, streamed_actions
+    
+    parser = ActionStreamParser()
+    
+    def on_text(chunk):
+        for action_data in parser.feed(chunk):
+            if len(streamed_actions) >= MAX_SEQUENCE_ACTIONS:
+                break
+            try:
+                action_data = validate_action(action_data, default_speed)
+            except (TypeError, ValueError):
+                print("Пропущено некорректное действие из потока")
+                continue
+            streamed_actions.append(action_data)
+            on_action(action_data)
+    
+    return on_text, streamed_actions
+
+# Общий HTTP-клиент: пул соединений с keep-alive вместо requests.post на каждый запрос
+http_lock = threading.Lock()
+http_session = None
+http_timing = threading.local()
+http_stats = {
+    'requests': 0,
+    'new_connections': 0,
+    'handshake_total': 0.0,
+    'last_used': 0,
+    'prewarming': False
+}
+
+class TimedHTTPConnection(HTTPConnectionPool.ConnectionCls):
+    """HTTP-соединение с замером времени установки"""
+
+    def connect(self):
+        started = time.time()
+        super().connect()
+        http_timing.handshake = getattr(http_timing, 'handshake', 0.0) + time.time() - started
+
+class TimedHTTPSConnection(HTTPSConnectionPool.ConnectionCls):
+    """HTTPS-соединение с замером времени установки (DNS, TCP и TLS)"""
+
+    def connect(self):
+        started = time.time()
+        super().connect()
+        http_timing.handshake = getattr(http_timing, 'handshake', 0.0) + time.time() - started
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class KeepAliveAdapter(HTTPAdapter):
+    """Адаптер requests с пулом соединений, замеряющих рукопожатие"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool
+        }
+
+def get_http_session():
+    """Возвращает общую HTTP-сессию (создается один раз, потокобезопасно)"""
+    global http_session
+    
+    with http_lock:
+        if http_session is None:
+            session = requests.Session()
+            adapter = KeepAliveAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'Connection': 'keep-alive'})
+            http_session = session
+        return http_session
+
+@traced("http")
+def http_post(url, headers, payload, timeout=30, stream=False):
+    """POST-запрос через общую сессию с отчетом о времени рукопожатия"""
+    http_timing.handshake = 0.0
+    started = time.time()
+    
+    response = get_http_session().post(url, headers=headers, json=payload, timeout=timeout, stream=stream)
+    
+    total = time.time() - started
+    handshake = http_timing.handshake
+    http_timing.total = total
+    http_timing.ttfb = response.elapsed.total_seconds()
+    
+    with http_lock:
+        http_stats['requests'] += 1
+        http_stats['last_used'] = time.time()
+        if handshake > 0:
+            http_stats['new_connections'] += 1
+            http_stats['handshake_total'] += handshake
+    
+    if handshake > 0:
+        print("HTTP: новое соединение, рукопожатие " + str(round(handshake, 3)) + " сек, ответ за " + str(round(total, 2)) + " сек")
+    else:
+        print("HTTP: соединение из пула, рукопожатие 0 сек, ответ за " + str(round(total, 2)) + " сек")
+    
+    return response
+
+def prewarm_worker():
+    """Устанавливает соединения с провайдерами заранее, чтобы они ждали в пуле"""
+    try:
+        for name in get_provider_chain():
+            try:
+                http_timing.handshake = 0.0
+                response = get_http_session().head(PROVIDERS[name]['warmup_url'], timeout=10)
+                response.close()
+                if http_timing.handshake > 0:
+                    print("HTTP: соединение с " + PROVIDERS[name]['title'] + " прогрето (рукопожатие " + str(round(http_timing.handshake, 3)) + " сек)")
+            except Exception as e:
+                print("Ошибка прогрева соединения с " + PROVIDERS[name]['title'] + ": " + str(e))
+        with http_lock:
+            http_stats['last_used'] = time.time()
+    finally:
+        http_stats['prewarming'] = False
+
+def prewarm_connection(force=False):
+    """Фоновый прогрев соединения, если оно простаивало дольше HTTP_KEEPALIVE_IDLE"""
+    if not HTTP_PREWARM and not force:
+        return
+    
+    with http_lock:
+        if http_stats['prewarming']:
+            return
+        if not force and time.time() - http_stats['last_used'] < HTTP_KEEPALIVE_IDLE:
+            return
+        http_stats['prewarming'] = True
+    
+    threading.Thread(target=prewarm_worker, daemon=True).start()
+
+def idle_wait(seconds):
+    """Ожидание в паузе автономного режима с прогревом соединения"""
+    deadline = time.time() + seconds
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        prewarm_connection()
+        time.sleep(min(1.0, remaining))
+
+# Слой провайдеров: OpenRouter, Gemini и Algion с единым интерфейсом
+PROVIDERS = {
+    'openrouter': {
+        'title': 'OpenRouter',
+        'format': 'openai',
+        'url': "https://openrouter.ai/api/v1/chat/completions",
+        'warmup_url': "https://openrouter.ai/api/v1/models",
+        'prompt_cache': 'cache_control',
+        'api_key': OPENROUTER_API_KEY,
+        'model': OPENROUTER_MODEL
+    },
+    'gemini': {
+        'title': 'Gemini',
+        'format': 'gemini',
+        'url': "https://generativelanguage.googleapis.com/v1beta/models/" + GEMINI_MODEL + ":generateContent",
+        'stream_url': "https://generativelanguage.googleapis.com/v1beta/models/" + GEMINI_MODEL + ":streamGenerateContent",
+        'warmup_url': "https://generativelanguage.googleapis.com/v1beta/models",
+        'cache_url': "https://generativelanguage.googleapis.com/v1beta/cachedContents",
+        'prompt_cache': 'cached_contents',
+        'api_key': GEMINI_API_KEY,
+        'model': GEMINI_MODEL
+    },
+    'algion': {
+        'title': 'Algion',
+        'format': 'openai',
+        'url': "https://api.algion.dev/v1/chat/completions",
+        'warmup_url': "https://api.algion.dev/v1/models",
+        'prompt_cache': 'prefix',
+        'api_key': ALGION_API_KEY,
+        'model': ALGION_MODEL
+    },
+    'local': {
+        'title': 'Локальная нейросеть',
+        'format': 'openai',
+        'url': LOCAL_BASE_URL.rstrip('/') + "/chat/completions",
+        'warmup_url': LOCAL_BASE_URL.rstrip('/') + "/models",
+        'prompt_cache': 'prefix',
+        'api_key': LOCAL_API_KEY,
+        'model': LOCAL_MODEL,
+        'timeout': LOCAL_TIMEOUT,
+        'requires_key': False,
+        'metered': False
+    }
+}
+
+# Блокировка для счетчиков запросов и статистики провайдеров
+llm_lock = threading.Lock()
+# Последние задержки успешных ответов каждого провайдера (секунды)
+provider_latencies = dict((name, []) for name in PROVIDERS)
+LATENCY_WINDOW = 50
+# Доступность локального сервера по результатам фоновой проверки
+local_health = {'ok': False, 'checked': 0.0}
+# Журнал последних запросов к нейросети и число строк в его файле
+stats_lock = threading.Lock()
+request_records = []
+stats_file_lines = 0
+# Статистика кэширования промптов по провайдерам (из полей usage ответов)
+prompt_cache_stats = dict((name, {'requests': 0, 'hits': 0, 'prompt_tokens': 0, 'cached_tokens': 0}) for name in PROVIDERS)
+# Автоматы защиты провайдеров: closed — запросы идут, open — провайдер отключен, half_open — пробный запрос
+circuit_breakers = dict((name, {'state': 'closed', 'failures': 0, 'opened_at': 0.0, 'open_time': CIRCUIT_OPEN_TIME, 'probe_at': 0.0}) for name in PROVIDERS)
+# Последние переключения автоматов защиты
+circuit_events = []
+# Провайдеры, отклонившие схему ответа (HTTP 400): им уходит обычный текстовый запрос
+structured_disabled = set()
+# Кэши Gemini для статичных префиксов: текст -> {'name': имя или None, 'expires': время}
+gemini_caches = {}
+
+def provider_configured(name):
+    """Проверяет, что для провайдера указан API-ключ"""
+    if not PROVIDERS[name].get('requires_key', True):
+        return True
+    api_key = PROVIDERS[name]['api_key']
+    return bool(api_key) and not api_key.startswith('your-')
+
+def check_local_health():
+    """Проверяет, отвечает ли локальный сервер (GET /models)"""
+    try:
+        response = get_http_session().get(PROVIDERS['local']['warmup_url'], timeout=TIMEOUT_CONNECT)
+        healthy = response.status_code == 200
+        response.close()
+    except requests.exceptions.RequestException:
+        healthy = False
+    
+    with llm_lock:
+        changed = healthy != local_health['ok']
+        local_health['ok'] = healthy
+        local_health['checked'] = time.time()
+    
+    if changed:
+        if healthy:
+            print("Локальная нейросеть доступна: " + LOCAL_BASE_URL + " (" + LOCAL_MODEL + ")")
+        else:
+            print("Локальная нейросеть недоступна, запросы идут в облако")
+    return healthy
+
+def local_health_worker():
+    """Периодическая проверка локального сервера"""
+    while True:
+        time.sleep(LOCAL_HEALTH_INTERVAL)
+        check_local_health()
+
+def local_llm_ready():
+    """Включена ли локальная нейросеть и отвечал ли сервер при последней проверке"""
+    return LOCAL_LLM_ENABLED and local_health['ok']
+
+def get_provider_chain():
+    """Основной провайдер и настроенные резервные в порядке хеджирования.
+    
+    Доступная локальная нейросеть идет первой, облачные провайдеры
+    остаются в цепочке на случай ее ошибки или медленного ответа.
+    """
+    chain = []
+    if local_llm_ready():
+        chain.append('local')
+    if PRIMARY_PROVIDER not in chain:
+        chain.append(PRIMARY_PROVIDER)
+    for name in HEDGE_PROVIDERS:
+        if name in PROVIDERS and name not in chain and provider_configured(name):
+            chain.append(name)
+    return chain
+
+def provider_within_budget(name, context_type):
+    """Можно ли отправить провайдеру запрос этого типа.
+    
+    Локальная нейросеть лимитом не ограничена, облачный провайдер - долей
+    типа в дневном лимите. Пока работает локальная нейросеть, автономные
+    запросы идут без паузы, поэтому их облачный дубль отправляется не
+    чаще get_autonomous_pacing().
+    """
+    if not PROVIDERS[name].get('metered', True):
+        return True
+    if not check_daily_limit(context_type):
+        return False
+    if context_type == "autonomous" and local_llm_ready():
+        with budget_lock:
+            last_spent = budget_last_spent.get(context_type, 0)
+        return time.time() - last_spent >= get_autonomous_pacing()
+    return True
+
+def llm_request_allowed(context_type=None):
+    """Есть ли провайдер, которому лимит позволяет отправить запрос этого типа"""
+    return any(provider_within_budget(name, context_type) for name in get_provider_chain())
+
+def percentile(samples, percent):
+    """Перцентиль по отсортированному списку значений"""
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+def record_provider_latency(name, latency):
+    """Запоминает задержку успешного ответа провайдера"""
+    with llm_lock:
+        samples = provider_latencies[name]
+        samples.append(latency)
+        if len(samples) > LATENCY_WINDOW:
+            samples.pop(0)
+
+def get_hedge_delay(name):
+    """Через сколько секунд отправлять дублирующий запрос (перцентиль задержки провайдера)"""
+    with llm_lock:
+        samples = sorted(provider_latencies[name])
+    
+    if len(samples) < 5:
+        return HEDGE_DEFAULT_DELAY
+    
+    return percentile(samples, HEDGE_PERCENTILE)
+
+def get_request_timeout(name):
+    """Таймаут ответа провайдера: перцентиль наблюдаемых задержек с запасом"""
+    with llm_lock:
+        samples = sorted(provider_latencies[name])
+    
+    limit = PROVIDERS[name].get('timeout', TIMEOUT_MAX)
+    if len(samples) < 5:
+        return min(limit, TIMEOUT_DEFAULT)
+    
+    return min(limit, max(TIMEOUT_MIN, percentile(samples, TIMEOUT_PERCENTILE) * TIMEOUT_MULTIPLIER))
+
+def set_circuit_state(name, state, reason):
+    """Переключает автомат защиты провайдера и записывает событие (вызывается под llm_lock)"""
+    breaker = circuit_breakers[name]
+    if breaker['state'] == state:
+        return
+    
+    circuit_events.append({
+        'time': time.time(),
+        'provider': name,
+        'from': breaker['state'],
+        'to': state,
+        'reason': reason
+    })
+    if len(circuit_events) > 50:
+        del circuit_events[0]
+    
+    breaker['state'] = state
+    print("Автомат защиты " + PROVIDERS[name]['title'] + ": " + state + " (" + reason + ")")
+
+def circuit_available(name):
+    """Можно ли сейчас обращаться к провайдеру (без изменения состояния автомата)"""
+    with llm_lock:
+        breaker = circuit_breakers[name]
+        now = time.time()
+        if breaker['state'] == 'open':
+            return now - breaker['opened_at'] >= breaker['open_time']
+        if breaker['state'] == 'half_open':
+            # Пробный запрос уже в пути; если он потерялся, разрешаем новый
+            return now - breaker['probe_at'] >= TIMEOUT_MAX
+        return True
+
+def circuit_allows(name):
+    """Разрешает запрос к провайдеру; после паузы открытый автомат пропускает один пробный запрос"""
+    if not circuit_available(name):
+        return False
+    
+    with llm_lock:
+        breaker = circuit_breakers[name]
+        if breaker['state'] == 'open':
+            set_circuit_state(name, 'half_open', "пробный запрос")
+        if breaker['state'] == 'half_open':
+            breaker['probe_at'] = time.time()
+    return True
+
+def record_circuit_result(name, success, reason="", retry_after=None):
+    """Учитывает исход запроса в автомате защиты провайдера"""
+    with llm_lock:
+        breaker = circuit_breakers[name]
+        
+        if success:
+            breaker['failures'] = 0
+            breaker['open_time'] = CIRCUIT_OPEN_TIME
+            set_circuit_state(name, 'closed', "успешный ответ")
+            return
+        
+        breaker['failures'] += 1
+        
+        if retry_after is not None:
+            # Провайдер сам сказал, когда вернуться
+            breaker['open_time'] = min(retry_after, CIRCUIT_OPEN_TIME_MAX)
+        elif breaker['state'] == 'half_open':
+            breaker['open_time'] = min(breaker['open_time'] * 2, CIRCUIT_OPEN_TIME_MAX)
+        
+        if retry_after is not None or breaker['state'] == 'half_open' or breaker['failures'] >= CIRCUIT_FAILURE_THRESHOLD:
+            breaker['opened_at'] = time.time()
+            set_circuit_state(name, 'open', reason + ", пауза " + str(round(breaker['open_time'])) + " сек")
+
+def llm_available():
+    """Есть ли провайдер, к которому сейчас можно обратиться"""
+    return any(circuit_available(name) for name in get_provider_chain())
+
+def parse_retry_after(value):
+    """Пауза из заголовка Retry-After в секундах (число секунд или HTTP-дата)"""
+    if not value:
+        return None
+    
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def get_backoff_delay(attempt):
+    """Экспоненциальная пауза перед повтором со случайной составляющей"""
+    limit = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return limit / 2 + random.uniform(0, limit / 2)
+
+def post_with_retry(name, url, headers, payload, stream=False, cancel_event=None):
+    """POST к провайдеру с адаптивным таймаутом и повторами.
+    
+    Повторяются сетевые ошибки, 429 и ответы 5xx; пауза растет экспоненциально,
+    а Retry-After от сервера соблюдается. Если все попытки исчерпаны,
+    неудача учитывается автоматом защиты и возвращается None.
+    """
+    title = PROVIDERS[name]['title']
+    retry_after = None
+    
+    for attempt in range(RETRY_MAX_ATTEMPTS + 1):
+        retry_after = None
+        try:
+            response = http_post(url, headers, payload, timeout=(TIMEOUT_CONNECT, get_request_timeout(name)), stream=stream)
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+            
+            problem = "HTTP " + str(response.status_code)
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            response.close()
+        except requests.exceptions.RequestException as e:
+            problem = str(e)
+        
+        if attempt == RETRY_MAX_ATTEMPTS:
+            break
+        
+        if retry_after is not None:
+            if retry_after > RETRY_MAX_DELAY:
+                break
+            delay = retry_after
+        else:
+            delay = get_backoff_delay(attempt)
+        
+        print(title + ": " + problem + ", повтор через " + str(round(delay, 1)) + " сек")
+        if cancel_event is not None:
+            if cancel_event.wait(delay):
+                return None
+        else:
+            time.sleep(delay)
+    
+    print("Запрос к " + title + " не удался: " + problem)
+    record_circuit_result(name, False, problem, retry_after)
+    return None
+
+def print_provider_health():
+    """Отчет о состоянии провайдеров: автоматы защиты, таймауты и переключения"""
+    print("\n" + "="*50)
+    print("СОСТОЯНИЕ ПРОВАЙДЕРОВ")
+    print("="*50)
+    
+    for name in get_provider_chain():
+        with llm_lock:
+            breaker = dict(circuit_breakers[name])
+        line = PROVIDERS[name]['title'] + ": " + breaker['state'] + ", неудач подряд " + str(breaker['failures']) + ", таймаут " + str(round(get_request_timeout(name), 1)) + " сек"
+        if breaker['state'] == 'open':
+            line += ", проба через " + str(round(max(0.0, breaker['opened_at'] + breaker['open_time'] - time.time()))) + " сек"
+        print(line)
+    
+    with llm_lock:
+        events = list(circuit_events[-10:])
+    
+    if events:
+        print("Последние переключения:")
+        for event in events:
+            print("  " + datetime.fromtimestamp(event['time']).strftime("%H:%M:%S") + " " + PROVIDERS[event['provider']]['title'] + ": " + event['from'] + " -> " + event['to'] + " (" + event['reason'] + ")")
+
+def get_gemini_cached_content(system_text):
+    """Имя кэша Gemini (cachedContents) для статичного префикса или None, если кэш недоступен.
+    
+    Gemma и слишком короткие префиксы явный кэш не поддерживают: после отказа
+    префикс отправляется в каждом запросе до истечения PROMPT_CACHE_TTL.
+    """
+    now = time.time()
+    with llm_lock:
+        entry = gemini_caches.get(system_text)
+    if entry is not None and now < entry['expires']:
+        return entry['name']
+    
+    provider = PROVIDERS['gemini']
+    payload = {
+        "model": "models/" + provider['model'],
+        "contents": [{
+            "role": "user",
+            "parts": [{
+                "text": system_text
+            }]
+        }],
+        "ttl": str(PROMPT_CACHE_TTL) + "s"
+    }
+    
+    try:
+        response = http_post(provider['cache_url'] + "?key=" + provider['api_key'], {"Content-Type": "application/json"}, payload, timeout=10)
+        response.raise_for_status()
+        entry = {'name': response.json()["name"], 'expires': now + PROMPT_CACHE_TTL - 60}
+        print("Создан кэш промпта Gemini: " + entry['name'])
+    except Exception as e:
+        entry = {'name': None, 'expires': now + PROMPT_CACHE_TTL}
+        print("Кэш промпта Gemini недоступен, префикс отправляется в запросе: " + str(e))
+    
+    with llm_lock:
+        gemini_caches[system_text] = entry
+    return entry['name']
+
+def mark_prompt_cache(messages):
+    """Помечает системные сообщения точкой кэширования cache_control (OpenRouter)"""
+    marked = []
+    for message in messages:
+        if message["role"] == "system":
+            message = {
+                "role": "system",
+                "content": [{
+                    "type": "text",
+                    "text": message["content"],
+                    "cache_control": {
+                        "type": "ephemeral"
+                    }
+                }]
+            }
+        marked.append(message)
+    return marked
+
+def structured_output_enabled(name):
+    """Просить ли у провайдера ответ по JSON-схеме"""
+    with llm_lock:
+        return STRUCTURED_OUTPUT and name not in structured_disabled
+
+def disable_structured_output(name):
+    """Отключает схему ответа для провайдера до перезапуска"""
+    with llm_lock:
+        structured_disabled.add(name)
+    print(PROVIDERS[name]['title'] + " отклонил схему ответа, дальше запросы без нее")
+
+def build_provider_request(name, messages, max_tokens, temperature, stream=False, schema=None):
+    """Формирует URL, заголовки и тело запроса в формате провайдера (с JSON-схемой ответа, если передана)"""
+    provider = PROVIDERS[name]
+    headers = {
+        "Content-Type": "application/json"
+    }
+    
+    if provider['format'] == 'gemini':
+        # Gemma не принимает системные инструкции, поэтому системный текст идет в начало первого сообщения
+        system_text = "\n\n".join(message["content"] for message in messages if message["role"] == "system")
+        cached_content = None
+        if system_text and PROMPT_CACHE_ENABLED and provider.get('prompt_cache') == 'cached_contents':
+            cached_content = get_gemini_cached_content(system_text)
+        if cached_content:
+            system_text = ""
+        contents = []
+        for message in messages:
+            if message["role"] == "system":
+                continue
+            text = message["content"]
+            if system_text and not contents:
+                text = system_text + "\n\n" + text
+            contents.append({
+                "role": "model" if message["role"] == "assistant" else "user",
+                "parts": [{
+                    "text": text
+                }]
+            })
+        
+        payload = {
+            "contents": contents,
+            "generationConfig": {
+                "temperature": temperature,
+                "maxOutputTokens": max_tokens,
+                "topP": 0.9
+            }
+        }
+        if cached_content:
+            payload["cachedContent"] = cached_content
+        if schema is not None:
+            payload["generationConfig"]["responseMimeType"] = "application/json"
+            payload["generationConfig"]["responseSchema"] = to_gemini_schema(schema)
+        if stream:
+            url = provider['stream_url'] + "?alt=sse&key=" + provider['api_key']
+        else:
+            url = provider['url'] + "?key=" + provider['api_key']
+    else:
+        if PROMPT_CACHE_ENABLED and provider.get('prompt_cache') == 'cache_control':
+            messages = mark_prompt_cache(messages)
+        
+        payload = {
+            "model": provider['model'],
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature
+        }
+        if stream:
+            payload["stream"] = True
+            # Последнее событие потока будет содержать usage
+            payload["stream_options"] = {"include_usage": True}
+        if schema is not None:
+            payload["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "robot_actions",
+                    "strict": True,
+                    "schema": schema
+                }
+            }
+        if provider['api_key']:
+            headers["Authorization"] = "Bearer " + provider['api_key']
+        url = provider['url']
+    
+    return url, headers, payload
+
+def parse_provider_response(name, result):
+    """Достает текст ответа из JSON провайдера (None, если ответ пустой)"""
+    if PROVIDERS[name]['format'] == 'gemini':
+        if "candidates" not in result or len(result["candidates"]) == 0:
+            return None
+        return result["candidates"][0]["content"]["parts"][0]["text"]
+    
+    if "choices" not in result or len(result["choices"]) == 0:
+        return None
+    return result["choices"][0]["message"]["content"]
+
+def extract_usage(name, result):
+    """Счетчики токенов из ответа провайдера: prompt, completion и взятые из кэша"""
+    if PROVIDERS[name]['format'] == 'gemini':
+        usage = result.get("usageMetadata") or {}
+        return {
+            'prompt_tokens': usage.get("promptTokenCount") or 0,
+            'completion_tokens': usage.get("candidatesTokenCount") or 0,
+            'cached_tokens': usage.get("cachedContentTokenCount") or 0
+        }
+    
+    usage = result.get("usage") or {}
+    details = usage.get("prompt_tokens_details") or {}
+    return {
+        'prompt_tokens': usage.get("prompt_tokens") or 0,
+        'completion_tokens': usage.get("completion_tokens") or 0,
+        'cached_tokens': details.get("cached_tokens") or 0
+    }
+
+def record_prompt_cache_usage(name, usage):
+    """Учитывает попадание в кэш промпта по счетчикам токенов ответа"""
+    if usage['prompt_tokens'] == 0:
+        return
+    
+    with llm_lock:
+        stats = prompt_cache_stats[name]
+        stats['requests'] += 1
+        stats['prompt_tokens'] += usage['prompt_tokens']
+        stats['cached_tokens'] += usage['cached_tokens']
+        if usage['cached_tokens'] > 0:
+            stats['hits'] += 1
+    
+    if usage['cached_tokens'] > 0:
+        print("Кэш промпта " + PROVIDERS[name]['title'] + ": " + str(usage['cached_tokens']) + " из " + str(usage['prompt_tokens']) + " токенов")
+
+def print_prompt_cache_report():
+    """Отчет о попаданиях в кэш промптов и сэкономленных токенах по провайдерам"""
+    print("\n" + "="*50)
+    print("КЭШ ПРОМПТОВ")
+    print("="*50)
+    
+    with llm_lock:
+        report = [(name, dict(prompt_cache_stats[name])) for name in PROVIDERS]
+    
+    for name, stats in report:
+        if stats['requests'] == 0:
+            continue
+        hit_rate = 100.0 * stats['hits'] / stats['requests']
+        saved = 100.0 * stats['cached_tokens'] / stats['prompt_tokens']
+        print(PROVIDERS[name]['title'] + ": запросов " + str(stats['requests']) +
+              ", попаданий " + str(round(hit_rate)) + "%" +
+              ", из кэша " + str(stats['cached_tokens']) + " из " + str(stats['prompt_tokens']) +
+              " токенов промпта (" + str(round(saved)) + "%)")
+    
+    if all(stats['requests'] == 0 for name, stats in report):
+        print("Нет данных: провайдеры еще не вернули счетчики токенов")
+
+def new_request_record(context_type):
+    """Заготовка записи статистики для одного запроса к нейросети"""
+    return {
+        'time': time.time(),
+        'context': context_type,
+        'provider': None,
+        'model': None,
+        'attempts': 0,
+        'queue_wait': 0.0,
+        'connect': 0.0,
+        'ttfb': 0.0,
+        'total': 0.0,
+        'prompt_tokens': 0,
+        'completion_tokens': 0,
+        'cached_tokens': 0,
+        'parsed': False,
+        'actions': 0,
+        'mode': "text"
+    }
+
+def get_stats_path():
+    """Путь к файлу статистики запросов"""
+    return os.path.join(SCRIPT_DIR, STATS_FILE)
+
+def load_request_stats():
+    """Загружает сохраненную статистику запросов при запуске"""
+    global stats_file_lines
+    
+    path = get_stats_path()
+    if not os.path.exists(path):
+        return
+    
+    records = []
+    try:
+        with open(path, encoding='utf-8') as stats_file:
+            for line in stats_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Недописанная строка после внезапного выключения
+                    continue
+    except (IOError, OSError) as e:
+        print("Не удалось загрузить статистику: " + str(e))
+        return
+    
+    with stats_lock:
+        request_records[:] = records[-STATS_MAX_RECORDS:]
+        stats_file_lines = len(records)
+    
+    print("Загружена статистика: " + str(len(request_records)) + " запросов")
+
+def save_request_record(record):
+    """Добавляет запись в журнал и дописывает ее в файл статистики"""
+    global stats_file_lines
+    
+    prices = TOKEN_PRICES.get(record['provider'])
+    if prices:
+        record['cost'] = round((record['prompt_tokens'] * prices[0] + record['completion_tokens'] * prices[1]) / 1000000.0, 6)
+    
+    path = get_stats_path()
+    with stats_lock:
+        request_records.append(record)
+        if len(request_records) > STATS_MAX_RECORDS:
+            del request_records[0]
+        
+        try:
+            if stats_file_lines >= 2 * STATS_MAX_RECORDS:
+                # Файл разросся: переписываем его последними записями через временный файл
+                tmp_path = path + ".tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as stats_file:
+                    for item in request_records:
+                        stats_file.write(json.dumps(item, ensure_ascii=False, separators=(',', ':')) + "\n")
+                os.replace(tmp_path, path)
+                stats_file_lines = len(request_records)
+            else:
+                with open(path, 'a', encoding='utf-8') as stats_file:
+                    stats_file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+                stats_file_lines += 1
+        except (IOError, OSError) as e:
+            print("Не удалось сохранить статистику: " + str(e))
+
+def finish_request_record(record, actions):
+    """Отмечает результат разбора ответа, сохраняет запись и возвращает действия без изменений"""
+    record['parsed'] = bool(actions)
+    record['actions'] = len(actions) if actions else 0
+    
+    # Запрос не дошел до провайдера (например, исчерпан лимит) — записывать нечего
+    if record['provider'] is not None:
+        save_request_record(record)
+    
+    return actions
+
+def format_percentiles(values):
+    """Строка p50 / p95 / p99 для списка значений в секундах"""
+    if not values:
+        return "нет данных"
+    samples = sorted(values)
+    return " / ".join(str(round(percentile(samples, percent), 2)) for percent in (50, 95, 99)) + " сек"
+
+def summarize_records(records):
+    """Сводка по группе записей: число запросов, успешный разбор, действия и время ответа"""
+    parsed = sum(1 for record in records if record['parsed'])
+    actions = sum(record['actions'] for record in records)
+    completion_tokens = sum(record['completion_tokens'] for record in records)
+    return (str(len(records)) + " запросов, разобрано " + str(round(100.0 * parsed / len(records))) + "%" +
+            ", действий в среднем " + str(round(float(actions) / len(records), 1)) +
+            ", ответ " + str(int(completion_tokens / len(records))) + " токенов" +
+            ", ответ p50/p95/p99: " + format_percentiles([record['total'] for record in records]))
+
+def get_day_period(timestamp):
+    """Период суток для группировки статистики"""
+    hour = datetime.fromtimestamp(timestamp).hour
+    if hour < 6:
+        return "00-06 ночь"
+    elif hour < 12:
+        return "06-12 утро"
+    elif hour < 18:
+        return "12-18 день"
+    return "18-24 вечер"
+
+def print_group_stats(title, records, key):
+    """Печатает сводку по группам записей, выделенным функцией key"""
+    groups = {}
+    for record in records:
+        groups.setdefault(key(record), []).append(record)
+    
+    print(title + ":")
+    for name in sorted(groups):
+        print("  " + name + ": " + summarize_records(groups[name]))
+
+def print_request_stats():
+    """Отчет по запросам к нейросети: перцентили задержек, токены и разбор по группам"""
+    with stats_lock:
+        records = list(request_records)
+    
+    print("\n" + "="*50)
+    print("СТАТИСТИКА ЗАПРОСОВ")
+    print("="*50)
+    
+    if not records:
+        print("Нет данных: запросов к нейросети еще не было")
+        return
+    
+    print("Всего: " + summarize_records(records))
+    print("Ожидание в очереди p50/p95/p99: " + format_percentiles([record['queue_wait'] for record in records]))
+    print("Установка соединения p50/p95/p99: " + format_percentiles([record['connect'] for record in records]))
+    print("Первый байт p50/p95/p99: " + format_percentiles([record['ttfb'] for record in records]))
+    print("Токены: промпт " + str(sum(record['prompt_tokens'] for record in records)) +
+          ", ответ " + str(sum(record['completion_tokens'] for record in records)) +
+          ", из кэша " + str(sum(record['cached_tokens'] for record in records)))
+    
+    cost = sum(record.get('cost', 0) for record in records)
+    if cost > 0:
+        print("Стоимость: $" + str(round(cost, 4)))
+    
+    print_group_stats("По типу запроса", records, lambda record: record['context'])
+    print_group_stats("По модели", records, lambda record: record['provider'] + " " + record['model'])
+    print_group_stats("По режиму ответа", records, lambda record: record.get('mode', "text"))
+    print_group_stats("По времени суток", records, lambda record: get_day_period(record['time']))
+
+def parse_stream_chunk(name, chunk):
+    """Достает фрагмент текста из события SSE-потока провайдера"""
+    if PROVIDERS[name]['format'] == 'gemini':
+        candidates = chunk.get("candidates") or [{}]
+        parts = candidates[0].get("content", {}).get("parts", [])
+        return "".join(part.get("text", "") for part in parts)
+    
+    choices = chunk.get("choices") or [{}]
+    return choices[0].get("delta", {}).get("content") or ""
+
+def read_provider_stream(name, response, on_text, cancel_event=None):
+    """Читает SSE-поток провайдера и передает каждый фрагмент текста в on_text.
+    
+    Возвращает полный текст (или None) и счетчики токенов из последнего события с usage.
+    """
+    parts = []
+    usage_chunk = {}
+    
+    try:
+        for line in response.iter_lines():
+            if cancel_event is not None and cancel_event.is_set():
+                print("Поток " + PROVIDERS[name]['title'] + " отменен")
+                return None, None
+            
+            # Пропускаем пустые строки и служебные комментарии SSE
+            if not line.startswith(b"data:"):
+                continue
+            
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            
+            chunk = json.loads(data.decode('utf-8'))
+            if chunk.get("usage") or chunk.get("usageMetadata"):
+                usage_chunk = chunk
+            
+            text = parse_stream_chunk(name, chunk)
+            if text:
+                parts.append(text)
+                on_text(text)
+    finally:
+        response.close()
+    
+    usage = extract_usage(name, usage_chunk)
+    if not parts:
+        return None, usage
+    return "".join(parts), usage
+
+@traced("llm")
+def query_provider(name, messages, max_tokens, temperature, cancel_event=None, on_text=None, record=None, schema=None):
+    """Один запрос к провайдеру; возвращает текст ответа или None.
+    
+    Если передан on_text, ответ запрашивается потоком и каждый фрагмент
+    текста передается в on_text сразу после получения. В record
+    (см. new_request_record) записываются задержки и счетчики токенов.
+    Со schema ответ запрашивается в режиме структурированного вывода.
+    """
+    provider = PROVIDERS[name]
+    if not circuit_allows(name):
+        print(provider['title'] + " временно отключен автоматом защиты")
+        return None
+    
+    stream = on_text is not None
+    structured = schema is not None and structured_output_enabled(name)
+    url, headers, payload = build_provider_request(name, messages, max_tokens, temperature, stream, schema if structured else None)
+    started = time.time()
+    
+    if record is not None:
+        record['provider'] = name
+        record['model'] = provider['model']
+        record['attempts'] += 1
+        record['queue_wait'] = round(started - record['time'], 3)
+        record['mode'] = "structured" if structured else "text"
+    
+    try:
+        response = post_with_retry(name, url, headers, payload, stream, cancel_event)
+        if response is None:
+            return None
+        
+        if response.status_code == 400 and structured:
+            # Провайдер или модель не поддерживает схему: повторяем обычным запросом
+            response.close()
+            disable_structured_output(name)
+            if record is not None:
+                record['mode'] = "text"
+            url, headers, payload = build_provider_request(name, messages, max_tokens, temperature, stream)
+            response = post_with_retry(name, url, headers, payload, stream, cancel_event)
+            if response is None:
+                return None
+        
+        if record is not None:
+            record['connect'] = round(http_timing.handshake, 3)
+            record['ttfb'] = round(http_timing.ttfb, 3)
+        
+        response.raise_for_status()
+        
+        if provider.get('metered', True):
+            spend_budget(record['context'] if record is not None else "other")
+        
+        if cancel_event is not None and cancel_event.is_set():
+            response.close()
+            print("Ответ " + provider['title'] + " отброшен: запрос отменен")
+            return None
+        
+        if stream:
+            assistant_message, usage = read_provider_stream(name, response, on_text, cancel_event)
+        else:
+            result = response.json()
+            assistant_message = parse_provider_response(name, result)
+            usage = extract_usage(name, result)
+        
+        if usage is not None:
+            record_prompt_cache_usage(name, usage)
+            if record is not None:
+                record['prompt_tokens'] = usage['prompt_tokens']
+                record['completion_tokens'] = usage['completion_tokens']
+                record['cached_tokens'] = usage['cached_tokens']
+        
+        record_circuit_result(name, True)
+        
+        if assistant_message is None:
+            print("Пустой ответ от " + provider['title'] + " API")
+            return None
+        
+        record_provider_latency(name, time.time() - started)
+        print("Запрос к " + provider['title'] + " (осталось: " + (get_remaining_requests() if provider.get('metered', True) else "не ограничено") + ")")
+        
+        return assistant_message
+        
+    except Exception as e:
+        print("Ошибка запроса к " + provider['title'] + " API: " + str(e))
+        # Ошибки 4xx говорят о запросе, а не о здоровье провайдера
+        if not isinstance(e, requests.exceptions.HTTPError):
+            record_circuit_result(name, False, str(e))
+        return None
+    
+    finally:
+        if record is not None:
+            record['total'] = round(time.time() - started, 3)
+
+def query_hedged(messages, max_tokens, temperature, require_json, on_text, record, schema, cancel_event=None):
+    """Запрос к нейросети с хеджированием.
+    
+    Если основной провайдер не ответил за перцентиль своей задержки или
+    вернул ошибку, тот же запрос уходит следующему провайдеру из цепочки.
+    Побеждает первый валидный ответ, остальные отменяются. При потоковом
+    запросе (on_text) побеждает провайдер, первым приславший текст.
+    В record попадают замеры провайдера, чей ответ был использован,
+    schema передается провайдерам для структурированного вывода,
+    cancel_event отменяет запрос у всех провайдеров.
+    """
+    # Облачные провайдеры, чья доля лимита исчерпана, не запрашиваются и не получают дубль
+    context_type = record['context'] if record is not None else None
+    chain = [name for name in get_provider_chain() if provider_within_budget(name, context_type)]
+    if not chain:
+        return None
+    
+    chain = [name for name in chain if circuit_available(name)]
+    
+    if not chain:
+        print("Все провайдеры отключены автоматом защиты, нейросеть не запрашивается")
+        return None
+    
+    # Отменяемый запрос идет через рабочий поток, чтобы отмена не ждала ответа сервера
+    if len(chain) == 1 and cancel_event is None:
+        return query_provider(chain[0], messages, max_tokens, temperature, on_text=on_text, record=record, schema=schema)
+    
+    results = queue.Queue()
+    cancel_events = dict((name, threading.Event()) for name in chain)
+    winner = []
+    winner_lock = threading.Lock()
+    
+    def claim(name):
+        """Объявляет провайдера победителем (если победителя еще нет) и отменяет остальных"""
+        with winner_lock:
+            if not winner:
+                winner.append(name)
+                for other, event in cancel_events.items():
+                    if other != name:
+                        event.set()
+            return winner[0] == name
+    
+    def worker(name):
+        forward = None
+        if on_text is not None:
+            def forward(chunk):
+                if claim(name):
+                    on_text(chunk)
+        attempt = None
+        if record is not None:
+            attempt = dict(record)
+        text = query_provider(name, messages, max_tokens, temperature, cancel_events[name], forward, attempt, schema)
+        if text is not None and require_json and extract_actions(text) is None:
+            print("Ответ " + PROVIDERS[name]['title'] + " не содержит JSON")
+            text = None
+        results.put((name, text, attempt))
+    
+    def launch(name):
+        threading.Thread(target=worker, args=(name,), daemon=True).start()
+    
+    launch(chain[0])
+    launched = 1
+    pending = 1
+    hedge_at = time.time() + get_hedge_delay(chain[0])
+    
+    while pending > 0:
+        if cancel_event is not None and cancel_event.is_set():
+            for event in cancel_events.values():
+                event.set()
+            return None
+        
+        timeout = None
+        if launched < len(chain) and not winner:
+            timeout = max(0.0, hedge_at - time.time())
+        if cancel_event is not None:
+            # Отмена проверяется не реже раза в 0.1 сек
+            timeout = 0.1 if timeout is None else min(timeout, 0.1)
+        
+        try:
+            name, text, attempt = results.get(timeout=timeout)
+        except queue.Empty:
+            if launched == len(chain) or winner or time.time() < hedge_at:
+                continue
+            # Предыдущий провайдер медлит — дублируем запрос следующему
+            print("Хеджирование: нет ответа, дублирую запрос в " + PROVIDERS[chain[launched]]['title'])
+            launch(chain[launched])
+            launched += 1
+            pending += 1
+            hedge_at = time.time() + get_hedge_delay(chain[launched - 1])
+            continue
+        
+        pending -= 1
+        
+        if record is not None and (not winner or winner[0] == name):
+            record.update(attempt)
+            record['attempts'] = launched
+        
+        if text is not None and claim(name):
+            print("Хеджирование: первым ответил " + PROVIDERS[name]['title'])
+            return text
+        
+        # Поток победителя уже передан исполнителю — другой ответ подмешивать нельзя
+        if winner and winner[0] == name:
+            return None
+        
+        # Ошибка или 429 — следующий провайдер запускается сразу, не дожидаясь перцентиля
+        if launched < len(chain) and not winner:
+            print("Хеджирование: ошибка " + PROVIDERS[name]['title'] + ", запрос уходит в " + PROVIDERS[chain[launched]]['title'])
+            launch(chain[launched])
+            launched += 1
+            pending += 1
+            hedge_at = time.time() + get_hedge_delay(chain[launched - 1])
+    
+    return None
+
+# Диспетчер запросов: приоритеты, отмена устаревших запросов и проверка актуальности ответа
+request_lock = threading.Lock()
+active_requests = []
+user_epoch = 0
+request_stats = {
+    'started': 0,
+    'cancelled': 0,
+    'deferred': 0,
+    'dropped': 0
+}
+
+def get_request_priority(context_type):
+    """Приоритет типа запроса: 0 - самый важный (порядок BUDGET_PRIORITY)"""
+    if context_type in BUDGET_PRIORITY:
+        return BUDGET_PRIORITY.index(context_type)
+    return len(BUDGET_PRIORITY)
+
+def cancel_request(ticket, reason):
+    """Отменяет запрос (вызывается под request_lock)"""
+    ticket['reason'] = reason
+    ticket['cancel'].set()
+    request_stats['cancelled'] += 1
+    print("Запрос '" + ticket['context'] + "' отменен: " + reason)
+
+def begin_request(context_type):
+    """Регистрирует запрос к нейросети и возвращает его описание.
+    
+    Новый запрос отменяет менее важные отменяемые запросы. Отменяемый
+    запрос, начатый во время более важного, сразу получает отказ.
+    """
+    ticket = {
+        'context': context_type,
+        'priority': get_request_priority(context_type),
+        'epoch': user_epoch,
+        'sensor_data': get_sensor_data() if context_type in REQUEST_SITUATION_CHECK else None,
+        'started': time.time(),
+        'cancel': threading.Event(),
+        'reason': ""
+    }
+    
+    with request_lock:
+        request_stats['started'] += 1
+        for other in active_requests:
+            if other['priority'] < ticket['priority'] and context_type in REQUEST_CANCELLABLE and not other['cancel'].is_set():
+                ticket['reason'] = "выполняется более важный запрос '" + other['context'] + "'"
+                ticket['cancel'].set()
+                request_stats['deferred'] += 1
+                return ticket
+        
+        for other in active_requests:
+            if other['priority'] > ticket['priority'] and other['context'] in REQUEST_CANCELLABLE and not other['cancel'].is_set():
+                cancel_request(other, "более важный запрос '" + context_type + "'")
+        active_requests.append(ticket)
+    
+    return ticket
+
+def end_request(ticket):
+    """Убирает запрос из списка выполняющихся"""
+    with request_lock:
+        if ticket in active_requests:
+            active_requests.remove(ticket)
+
+def note_user_input(source):
+    """Новая команда пользователя: отменяемые запросы, начатые до нее, устаревают"""
+    global user_epoch
+    
+    with request_lock:
+        user_epoch += 1
+        for ticket in active_requests:
+            if ticket['context'] in REQUEST_CANCELLABLE and not ticket['cancel'].is_set():
+                cancel_request(ticket, "новая команда пользователя (" + source + ")")
+
+def request_relevant(ticket):
+    """Проверяет, можно ли выполнять ответ: запрос не отменен, пользователь
+    не дал новую команду и обстановка не изменилась (причина - в ticket['reason'])"""
+    if ticket['cancel'].is_set():
+        return False
+    if ticket['context'] in REQUEST_CANCELLABLE and ticket['epoch'] != user_epoch:
+        ticket['reason'] = "пользователь дал новую команду"
+        return False
+    if ticket['sensor_data'] is not None and situation_changed(ticket['sensor_data'], get_sensor_data()):
+        ticket['reason'] = "обстановка изменилась"
+        return False
+    return True
+
+@traced("llm")
+def query_llm(messages, max_tokens=800, temperature=0.8, require_json=True, on_text=None, record=None, schema=None):
+    """Запрос к нейросети через диспетчер запросов.
+    
+    Запрос получает приоритет по своему типу (record['context']) и может быть
+    отменен более важным запросом или новой командой пользователя; после
+    отмены фрагменты потока исполнителю не передаются. Ответ, который
+    перестал быть актуальным, отбрасывается до выполнения.
+    """
+    context_type = record['context'] if record is not None else "other"
+    ticket = begin_request(context_type)
+    
+    if ticket['cancel'].is_set():
+        print("Запрос '" + context_type + "' отложен: " + ticket['reason'])
+        return None
+    
+    forward = None
+    if on_text is not None:
+        def forward(chunk):
+            if not ticket['cancel'].is_set():
+                on_text(chunk)
+    
+    # Неотменяемым запросам событие отмены не нужно
+    cancel_event = ticket['cancel'] if context_type in REQUEST_CANCELLABLE else None
+    try:
+        text = query_hedged(messages, max_tokens, temperature, require_json, forward, record, schema, cancel_event)
+    finally:
+        end_request(ticket)
+    
+    if text is None or request_relevant(ticket):
+        return text
+    
+    with request_lock:
+        request_stats['dropped'] += 1
+    print("Ответ на запрос '" + context_type + "' отброшен: " + ticket['reason'])
+    return None
+
+def print_request_report():
+    """Отчет диспетчера: выполняющиеся запросы, отмены и отброшенные ответы"""
+    now = time.time()
+    with request_lock:
+        stats = dict(request_stats)
+        tickets = list(active_requests)
+    
+    print("\n" + "="*50)
+    print("ДИСПЕТЧЕР ЗАПРОСОВ")
+    print("="*50)
+    print("Запросов: " + str(stats['started']) + ", отменено: " + str(stats['cancelled']) +
+          ", отложено: " + str(stats['deferred']) + ", отброшено ответов: " + str(stats['dropped']))
+    
+    if not tickets:
+        print("Сейчас запросов нет")
+    for ticket in sorted(tickets, key=lambda ticket: ticket['priority']):
+        print("- '" + ticket['context'] + "' (приоритет " + str(ticket['priority']) + "), идет " + str(round(now - ticket['started'], 1)) + " сек" +
+              (", отменяется" if ticket['cancel'].is_set() else ""))
+
+# Память разговора: последние реплики дословно, более старые сворачиваются в сводку.
+# Блок памяти в промпте ограничен MEMORY_TOKEN_BUDGET и не растет с числом реплик
+memory_lock = threading.Lock()
+memory_turns = []
+memory_summary = []
+memory_stats = {
+    'turns': 0,
+    'folds': 0,
+    'llm_folds': 0,
+    'folding': False
+}
+
+MEMORY_SUMMARY_PROMPT = """Ты ведешь краткую память робота EV3RSTORM. Сожми прежнюю сводку и новые реплики в 1-3 коротких предложения на русском: что просил пользователь, что делал робот, важные факты (имена, предпочтения). Ответь только текстом сводки, без JSON."""
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов: около 3 символов русского текста на токен"""
+    return len(text) // 3 + 1
+
+def shorten(text, limit):
+    """Обрезает строку до limit символов с многоточием"""
+    if len(text) <= limit:
+        return text
+    return text[:limit - 3] + "..."
+
+def describe_actions(actions_data):
+    """Ответ робота одной строкой: реплики и движения"""
+    parts = []
+    for action_data in actions_data:
+        if action_data.get("speech"):
+            parts.append("«" + action_data["speech"] + "»")
+        if action_data.get("action", "speak") != "speak":
+            parts.append(action_data["action"])
+    return ", ".join(parts) or "ничего не сделал"
+
+def format_turn(turn):
+    """Строка реплики для промпта"""
+    if turn['user']:
+        return "- Пользователь: " + turn['user'] + " -> Робот: " + turn['robot']
+    return "- Робот: " + turn['robot']
+
+def trim_summary():
+    """Убирает самые старые записи сводки, пока она не уложится в MEMORY_SUMMARY_TOKENS (под memory_lock)"""
+    while len(memory_summary) > 1 and estimate_tokens("; ".join(memory_summary)) > MEMORY_SUMMARY_TOKENS:
+        del memory_summary[0]
+    if memory_summary:
+        memory_summary[0] = shorten(memory_summary[0], MEMORY_SUMMARY_TOKENS * 3)
+
+def fold_turns_locally(turns):
+    """Сворачивает реплики в короткие записи сводки без запроса (под memory_lock)"""
+    for turn in turns:
+        item = shorten(turn['robot'], 40)
+        if turn['user']:
+            item = "пользователь: " + shorten(turn['user'], 40) + " -> " + item
+        memory_summary.append(datetime.fromtimestamp(turn['time']).strftime('%H:%M') + " " + item)
+    trim_summary()
+
+def fold_worker(summary, turns):
+    """Фоновая свертка одним запросом к нейросети; при неудаче реплики сворачиваются локально"""
+    global memory_summary
+    
+    text = None
+    try:
+        messages = [
+            {"role": "system", "content": MEMORY_SUMMARY_PROMPT},
+            {"role": "user", "content": "Прежняя сводка: " + ("; ".join(summary) or "нет") + "\nНовые реплики:\n" + "\n".join(format_turn(turn) for turn in turns)}
+        ]
+        # Запрос списывается с той же доли лимита, по которой проверялся в fold_memory; в статистику ответов он не пишется
+        record = new_request_record("autonomous")
+        text = query_llm(messages, max_tokens=MEMORY_SUMMARY_TOKENS * 2, temperature=0.3, require_json=False, record=record)
+    except Exception as e:
+        print("Ошибка свертки памяти: " + str(e))
+    
+    with memory_lock:
+        if text and text.strip():
+            # Записи, появившиеся во время запроса, остаются после новой сводки
+            memory_summary = [" ".join(text.split())] + memory_summary[len(summary):]
+            memory_stats['llm_folds'] += 1
+            trim_summary()
+        else:
+            fold_turns_locally(turns)
+        memory_stats['folding'] = False
+
+def fold_memory():
+    """Сворачивает самые старые реплики, когда их больше MEMORY_RECENT_TURNS + MEMORY_FOLD_TURNS (под memory_lock)"""
+    if len(memory_turns) <= MEMORY_RECENT_TURNS + MEMORY_FOLD_TURNS:
+        return
+    
+    turns = memory_turns[:MEMORY_FOLD_TURNS]
+    del memory_turns[:MEMORY_FOLD_TURNS]
+    memory_stats['folds'] += 1
+    
+    if MEMORY_SUMMARY_MODE == "llm" and not memory_stats['folding'] and llm_request_allowed("autonomous") and llm_available():
+        memory_stats['folding'] = True
+        threading.Thread(target=fold_worker, args=(list(memory_summary), turns), daemon=True).start()
+    else:
+        fold_turns_locally(turns)
+
+def remember_actions(actions_data, user_text=None):
+    """Записывает в память разговора реплику пользователя (если есть) и ответ робота"""
+    if not actions_data and user_text is None:
+        return
+    
+    with memory_lock:
+        memory_turns.append({
+            'time': time.time(),
+            'user': user_text,
+            'robot': describe_actions(actions_data or [])
+        })
+        memory_stats['turns'] += 1
+        fold_memory()
+
+@traced("prompt")
+def get_memory_context():
+    """Блок памяти для промпта: сводка и самые свежие реплики в пределах MEMORY_TOKEN_BUDGET"""
+    with memory_lock:
+        summary = "; ".join(memory_summary)
+        turns = list(memory_turns)
+    
+    if not summary and not turns:
+        return ""
+    
+    header = "\n\nПамять разговора:"
+    budget = MEMORY_TOKEN_BUDGET - estimate_tokens(header)
+    lines = []
+    if summary:
+        lines.append("Раньше: " + summary)
+        budget -= estimate_tokens(lines[0])
+    
+    recent = []
+    for turn in reversed(turns):
+        line = format_turn(turn)
+        if estimate_tokens(line) > budget:
+            # Даже одна свежая реплика не помещается - берем ее начало
+            if not recent and budget > 10:
+                recent.append(shorten(line, budget * 3))
+            break
+        recent.insert(0, line)
+        budget -= estimate_tokens(line)
+    
+    return header + "\n" + "\n".join(lines + recent)
+
+def print_memory_report():
+    """Отчет памяти разговора: сводка, дословные реплики и размер блока в промпте"""
+    context = get_memory_context()
+    with memory_lock:
+        stats = dict(memory_stats)
+        turns = len(memory_turns)
+        summary = "; ".join(memory_summary)
+    
+    print("\n" + "="*50)
+    print("ПАМЯТЬ РАЗГОВОРА")
+    print("="*50)
+    print("Реплик всего: " + str(stats['turns']) + ", дословно: " + str(turns) + ", сверток: " + str(stats['folds']) +
+          " (нейросетью: " + str(stats['llm_folds']) + ")")
+    print("Блок памяти в промпте: ~" + str(estimate_tokens(context) if context else 0) + " из " + str(MEMORY_TOKEN_BUDGET) + " токенов")
+    print("Сводка: " + (summary or "пока нет"))
+
+# Статичные части промптов: одинаковый префикс каждого запроса кэшируется провайдером
+OBSTACLE_SYSTEM_PROMPT = """Ты - робот EV3RSTORM. Перед тобой препятствие.
+
+Ты должен отреагировать на препятствие. Ты можешь отправить ОДИН JSON объект или МАССИВ JSON объектов.
+Каждый JSON объект должен иметь формат:
 {
     "action": "move_forward|move_backward|turn_left|turn_right|attack|speak|stop",
     "speed": число от 0 до 100,
     "duration": число в секундах,
     "angle": число в градусах,
-    "speech": "текст для озвучивания на русском языке"
+    "speech": "текст для озвучивания на русском языке",
+    "parallel": true или false,
+    "after": "none|speech|drive|blade|leds",
+    "leds": "none|RED|GREEN|AMBER|ORANGE|YELLOW|BLACK"
 }
 
 Пример массива (несколько действий):
@@ -571,345 +3430,1304 @@ def query_openrouter_obstacle(sensor_data):
 ]
 
 Отправь реакцию на препятствие. Не добавляй никаких дополнительных текстов, только JSON."""
+
+ACTION_SYSTEM_PROMPT = """Ты - робот EV3RSTORM. Ты можешь отправить ОДИН JSON объект или МАССИВ JSON объектов для последовательности действий.
+
+Формат одного действия:
+{
+    "action": "move_forward|move_backward|turn_left|turn_right|attack|speak|stop",
+    "speed": число от 0 до 100,
+    "duration": число в секундах,
+    "angle": число в градусах,
+    "speech": "текст для озвучивания на русском языке",
+    "parallel": true или false,
+    "after": "none|speech|drive|blade|leds",
+    "leds": "none|RED|GREEN|AMBER|ORANGE|YELLOW|BLACK"
+}
+
+Формат последовательности действий (массив):
+[
+  {
+    "action": "speak",
+    "speed": 0,
+    "duration": 0,
+    "angle": 0,
+    "speech": "Привет! Я собираюсь выполнить несколько действий.",
+    "parallel": false,
+    "after": "none",
+    "leds": "GREEN"
+  },
+  {
+    "action": "move_forward",
+    "speed": 50,
+    "duration": 2,
+    "angle": 0,
+    "speech": "",
+    "parallel": false,
+    "after": "none",
+    "leds": "none"
+  },
+  {
+    "action": "turn_right",
+    "speed": 30,
+    "duration": 0,
+    "angle": 90,
+    "speech": "Поворачиваю направо.",
+    "parallel": false,
+    "after": "none",
+    "leds": "none"
+  },
+  {
+    "action": "attack",
+    "speed": 60,
+    "duration": 1,
+    "angle": 0,
+    "speech": "",
+    "parallel": true,
+    "after": "none",
+    "leds": "none"
+  }
+]
+
+Речь, ходовые моторы, лезвие и подсветка работают независимо. Речь действия звучит одновременно с его движением.
+Обычно действие начинается после окончания всех предыдущих.
+- "parallel": true - начать действие сразу, вместе с предыдущим (как атака во время поворота в примере)
+- "after": "speech", "drive", "blade" или "leds" - начать, как только освободится эта дорожка, не дожидаясь остальных
+- "leds": цвет подсветки, "none" - не менять
+
+Ограничения:
+- Длительность движения не более 3 секунд
+- Угол поворота не более 180 градусов
+- Скорость моторов от 0 до 100
+- Максимум """ + str(MAX_SEQUENCE_ACTIONS) + """ действий в последовательности
+
+Отправь JSON (объект или массив) без каких-либо дополнительных текстов."""
+
+# Пакетный запрос: ответ - массив планов, поэтому формат ответа описан отдельно от ACTION_SYSTEM_PROMPT
+BATCH_SYSTEM_PROMPT = """Ты - робот EV3RSTORM. Пользователь дал несколько команд подряд, на каждую нужен свой план.
+Отправь ОДИН JSON-массив планов: элемент с номером N - массив действий для команды с номером N.
+Планов должно быть ровно столько, сколько команд, и в том же порядке. План из одного действия - тоже массив.
+
+Формат одного действия:
+{
+    "action": "move_forward|move_backward|turn_left|turn_right|attack|speak|stop",
+    "speed": число от 0 до 100,
+    "duration": число в секундах,
+    "angle": число в градусах,
+    "speech": "текст для озвучивания на русском языке",
+    "parallel": true или false,
+    "after": "none|speech|drive|blade|leds",
+    "leds": "none|RED|GREEN|AMBER|ORANGE|YELLOW|BLACK"
+}
+
+Формат ответа на две команды ("вперед" и "повернись и поздоровайся"):
+[
+  [
+    {"action": "move_forward", "speed": 50, "duration": 2, "angle": 0, "speech": "", "parallel": false, "after": "none", "leds": "none"}
+  ],
+  [
+    {"action": "turn_right", "speed": 30, "duration": 0, "angle": 90, "speech": "", "parallel": false, "after": "none", "leds": "none"},
+    {"action": "speak", "speed": 0, "duration": 0, "angle": 0, "speech": "Привет!", "parallel": false, "after": "none", "leds": "GREEN"}
+  ]
+]
+
+Речь, ходовые моторы, лезвие и подсветка работают независимо. Речь действия звучит одновременно с его движением.
+Обычно действие начинается после окончания всех предыдущих.
+- "parallel": true - начать действие сразу, вместе с предыдущим
+- "after": "speech", "drive", "blade" или "leds" - начать, как только освободится эта дорожка, не дожидаясь остальных
+- "leds": цвет подсветки, "none" - не менять
+
+Ограничения:
+- Длительность движения не более 3 секунд
+- Угол поворота не более 180 градусов
+- Скорость моторов от 0 до 100
+- Максимум """ + str(MAX_SEQUENCE_ACTIONS) + """ действий в плане одной команды
+
+Отправь только JSON-массив планов без каких-либо дополнительных текстов."""
+
+@traced("llm")
+def query_openrouter_obstacle(sensor_data, on_action=None):
+    """Специальный запрос к нейросети при обнаружении препятствия"""
+    if not llm_request_allowed("obstacle"):
+        return None
+    
+    distance = sensor_data['ir_distance']
+    
+    user_message = "Перед тобой препятствие на расстоянии " + str(distance) + " сантиметров."
+    
+    messages = [
+        {
+            "role": "system",
+            "content": OBSTACLE_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": user_message
+        }
+    ]
+    
+    try:
+        record = new_request_record("obstacle")
+        on_text, streamed_actions = create_action_stream(on_action, OBSTACLE_ACTION_SPEED)
+        assistant_message = query_llm(messages, max_tokens=500, temperature=0.7, on_text=on_text, record=record, schema=PLAN_SCHEMA)
+        
+        if assistant_message is None:
+            return finish_request_record(record, streamed_actions or None)
+        
+        # Извлекаем JSON (массив или объект); действия из потока уже переданы исполнителю
+        actions_data = streamed_actions or extract_actions(assistant_message)
+        
+        if actions_data is None:
+            print("Не удалось извлечь JSON из ответа о препятствии")
+            return finish_request_record(record, None)
+        
+        validated_actions = validate_plan(actions_data, OBSTACLE_ACTION_SPEED)
+        
+        # Проверенная реакция нейросети попадает в кэш рефлексов
+        store_reflex(sensor_data, validated_actions)
+        
+        return finish_request_record(record, validated_actions)
+                
+    except Exception as e:
+        print("Ошибка запроса о препятствии: " + str(e))
+        return finish_request_record(record, None)
+
+@traced("llm")
+def query_openrouter(prompt, sensor_data=None, context_type="autonomous", on_action=None, remember=True):
+    """Запрос к OpenRouter API с поддержкой последовательностей действий"""
+    if not llm_request_allowed(context_type):
+        return None
+    
+    if sensor_data is None:
+        sensor_data = get_sensor_data()
+    
+    # Разные системные промпты для разных контекстов
+    if context_type == "autonomous":
+        system_context = get_context_prompt()
+    elif context_type == "button":
+        system_context = "Пользователь нажал кнопку. Реагируй быстро и выразительно!"
+    elif context_type == "terminal":
+        command = prompt
+        system_context = "Пользователь дал команду: " + prompt
+        prompt = "Выполни команду пользователя"
+    else:
+        system_context = "Что мне сделать?"
+    
+    situation = get_situation_description(sensor_data)
+    
+    # Добавляем память разговора: сводку и последние реплики в пределах бюджета токенов
+    history_context = get_memory_context()
+    
+    # Статичные инструкции идут в системном сообщении, меняются только ситуация, история и запрос
+    user_message = """Ситуация: """ + situation + """
+Время: """ + sensor_data['time_of_day'] + history_context + """
+Контекст: """ + system_context + """
+Запрос: """ + prompt
+    
+    messages = [
+        {
+            "role": "system",
+            "content": ACTION_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": user_message
+        }
+    ]
+    
+    try:
+        record = new_request_record(context_type)
+        on_text, streamed_actions = create_action_stream(on_action)
+        assistant_message = query_llm(messages, max_tokens=800, temperature=0.8, on_text=on_text, record=record, schema=PLAN_SCHEMA)
+        
+        if assistant_message is None:
+            return finish_request_record(record, streamed_actions or None)
+        
+        # Извлекаем JSON (массив или объект); действия из потока уже переданы исполнителю
+        actions_data = streamed_actions or extract_actions(assistant_message)
+        
+        if actions_data is None:
+            print("Не удалось извлечь JSON из ответа: " + assistant_message[:100] + "...")
+            return finish_request_record(record, None)
+        
+        validated_actions = validate_plan(actions_data)
+        
+        # Сохраняем реплику и ответ в память разговора (предзапрос записывает план, только когда он выполнен)
+        if remember:
+            remember_actions(validated_actions, command if context_type == "terminal" else None)
+        
+        if context_type == "terminal":
+            store_plan(command, sensor_data, validated_actions, record['total'])
+        
+        return finish_request_record(record, validated_actions)
+                
+    except Exception as e:
+        print("Ошибка запроса к нейросети: " + str(e))
+        return finish_request_record(record, None)
+
+@traced("llm")
+def query_openrouter_batch(commands, sensor_data):
+    """Один запрос для нескольких команд терминала.
+    
+    Возвращает список планов в порядке команд или None, если ответ
+    не удалось сопоставить командам (тогда команды выполняются по одной).
+    """
+    if not llm_request_allowed("terminal"):
+        return None
+    
+    situation = get_situation_description(sensor_data)
+    
+    history_context = get_memory_context()
+    
+    command_list = "\n".join(str(index + 1) + ". " + command for index, command in enumerate(commands))
+    user_message = """Ситуация: """ + situation + """
+Время: """ + sensor_data['time_of_day'] + history_context + """
+Контекст: Пользователь дал несколько команд подряд:
+""" + command_list + """
+Запрос: Выполни каждую команду по порядку. Отправь JSON-массив из """ + str(len(commands)) + """ элементов: каждый элемент - массив действий для команды с тем же номером."""
+    
+    messages = [
+        {
+            "role": "system",
+            "content": BATCH_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": user_message
+        }
+    ]
+    
+    record = new_request_record("terminal")
+    try:
+        assistant_message = query_llm(messages, max_tokens=800 * len(commands), temperature=0.8, record=record, schema=BATCH_SCHEMA)
+        
+        if assistant_message is None:
+            return finish_request_record(record, None)
+        
+        plans = extract_batch_plans(assistant_message, len(commands))
+        if plans is None:
+            print("Не удалось сопоставить ответ командам: " + assistant_message[:100] + "...")
+            return finish_request_record(record, None)
+        
+        validated_plans = []
+        for command, actions_data in zip(commands, plans):
+            validated_actions = validate_plan(actions_data)
+            remember_actions(validated_actions, command)
+            validated_plans.append(validated_actions)
+        
+        finish_request_record(record, [action_data for plan in validated_plans for action_data in plan])
+        for command, actions_data in zip(commands, validated_plans):
+            store_plan(command, sensor_data, actions_data, record['total'] / len(commands))
+        return validated_plans
+        
+    except Exception as e:
+        print("Ошибка пакетного запроса: " + str(e))
+        return finish_request_record(record, None)
+
+# Компилятор планов: соседние совместимые действия объединяются до выполнения
+compile_lock = threading.Lock()
+compile_stats = {
+    'plans': 0,
+    'actions_before': 0,
+    'actions_after': 0,
+    'time_before': 0.0,
+    'time_after': 0.0
+}
+
+# Знак поворота: налево - минус, направо - плюс
+TURN_SIGNS = {"turn_left": -1, "turn_right": 1}
+
+def join_speech(first, second):
+    """Склеивает две реплики в одну"""
+    return (first + " " + second).strip()
+
+def simplify_action(action_data):
+    """Заменяет действие без движения речью или убирает его (None).
+    
+    Стоп внутри плана ничего не меняет: каждое движение само выключает
+    моторы в конце. Нулевые скорость или угол - тоже не движение.
+    """
+    name = action_data.action
+    if name == "speak" or name == "stop":
+        idle = True
+    elif name in TURN_SIGNS:
+        idle = action_data.speed == 0 or action_data.angle == 0
+    elif name in ACTION_NAMES:
+        idle = action_data.speed == 0
+    else:
+        return action_data
+    
+    if not idle:
+        return action_data
+    if not action_data.speech and not action_data.leds:
+        return None
+    return Action("speak", 0, 0.1, 0, action_data.speech, action_data.parallel, action_data.after, action_data.leds)
+
+def merge_actions(first, second):
+    """Объединяет два соседних действия.
+    
+    Возвращает None, если их нельзя объединить, [] - если они взаимно
+    уничтожились, или список из одного действия на замену обоим.
+    """
+    if first.action not in ACTION_NAMES or second.action not in ACTION_NAMES:
+        return None
+    
+    # Действия со связями parallel и after стоят на дорожках так, как задумала нейросеть
+    if first.parallel or first.after or second.parallel or second.after:
+        return None
+    
+    # Реплика перед действием произносится им же: минус шаг и пауза между действиями
+    if first.action == "speak":
+        if first.leds and second.leds:
+            return None
+        merged = second.copy()
+        merged.speech = join_speech(first.speech, second.speech)
+        merged.leds = second.leds or first.leds
+        return [merged]
+    
+    # Реплика и подсветка второго действия начинаются вместе с его движением, поэтому объединять можно только без них
+    if second.speech or second.leds:
+        return None
+    
+    if first.action == second.action and first.speed == second.speed and first.action not in TURN_SIGNS:
+        limit = MAX_ATTACK_DURATION if first.action == "attack" else MAX_MOVE_DURATION
+        if first.duration + second.duration > limit:
+            return None
+        merged = first.copy()
+        merged.duration = round(first.duration + second.duration, 2)
+        return [merged]
+    
+    if first.action in TURN_SIGNS and second.action in TURN_SIGNS:
+        angle = TURN_SIGNS[first.action] * first.angle + TURN_SIGNS[second.action] * second.angle
+        if abs(angle) > MAX_TURN_ANGLE:
+            return None
+        if angle == 0:
+            return [Action("speak", 0, 0.1, 0, first.speech, leds=first.leds)] if first.speech or first.leds else []
+        merged = first.copy()
+        merged.action = "turn_left" if angle < 0 else "turn_right"
+        merged.angle = abs(angle)
+        return [merged]
+    
+    return None
+
+def compile_actions(actions_data):
+    """Один проход оптимизации: без пустых действий, с объединенными соседями"""
+    compiled = []
+    for action_data in actions_data:
+        action_data = simplify_action(action_data)
+        while action_data is not None and compiled:
+            merged = merge_actions(compiled[-1], action_data)
+            if merged is None:
+                break
+            compiled.pop()
+            action_data = merged[0] if merged else None
+        if action_data is not None:
+            compiled.append(action_data)
+    return compiled
+
+def estimate_action_parts(action_data):
+    """Оценка занятости дорожек действием: дорожка -> секунды (поворот - по времени поворота без гироскопа)"""
+    parts = {}
+    if action_data.speech:
+        parts["speech"] = len(action_data.speech) * PLAN_SPEECH_SECONDS_PER_CHAR
+    
+    seconds = 0.0
+    if action_data.action in TURN_SIGNS:
+        seconds = action_data.angle / 90.0 * 0.8
+    elif action_data.action in ("move_forward", "move_backward", "attack"):
+        seconds = action_data.duration
+    for track in ACTION_TRACKS.get(action_data.action, ()):
+        parts[track] = seconds
+    if action_data.leds:
+        parts.setdefault("leds", 0.0)
+    
+    # Без дорожек части действия выполняются по очереди
+    if not PLAN_TRACKS_ENABLED:
+        total = sum(parts.values())
+        parts = dict((track, total) for track in parts)
+    return parts
+
+def estimate_plan_time(actions_data):
+    """Оценка длительности плана по дорожкам.
+    
+    Обычное действие начинается через паузу после окончания всех предыдущих,
+    действие с parallel или after - как только свободны нужные ему дорожки.
+    """
+    free = {}
+    start = end = 0.0
+    for index, action_data in enumerate(actions_data):
+        parts = estimate_action_parts(action_data)
+        if PLAN_TRACKS_ENABLED and (action_data.parallel or action_data.after):
+            start = max([start, free.get(action_data.after, 0.0)] + [free.get(track, 0.0) for track in parts])
+        elif index:
+            start = end + PLAN_ACTION_PAUSE
+        for track, seconds in parts.items():
+            free[track] = start + seconds
+            end = max(end, free[track])
+    return end
+
+def record_compilation(before, after):
+    """Учитывает результат компиляции и печатает его, если план изменился"""
+    time_before = estimate_plan_time(before)
+    time_after = estimate_plan_time(after)
+    
+    with compile_lock:
+        compile_stats['plans'] += 1
+        compile_stats['actions_before'] += len(before)
+        compile_stats['actions_after'] += len(after)
+        compile_stats['time_before'] += time_before
+        compile_stats['time_after'] += time_after
+    
+    if len(after) != len(before):
+        print("Компилятор плана: " + str(len(before)) + " -> " + str(len(after)) + " действий, оценка времени " +
+              str(round(time_before, 1)) + " -> " + str(round(time_after, 1)) + " сек")
+
+def get_empty_plan_fallback(actions_data):
+    """Что выполнить, если от плана ничего не осталось: один стоп, если он был в плане, иначе ничего"""
+    for action_data in actions_data:
+        if action_data.action == "stop":
+            return [action_data]
+    print("Компилятор плана: действия взаимно погасились, выполнять нечего")
+    return []
+
+def compile_plan(actions_data):
+    """Оптимизирует готовый план перед выполнением.
+    
+    Объединяет соседние движения в одну сторону, взаимно гасит повороты,
+    убирает действия без эффекта и отдает реплику следующему за ней движению.
+    Из плана, от которого ничего бы не осталось, остается один стоп, если
+    стоп в нем был (например, [stop, stop]); иначе план не выполняется.
+    """
+    if not PLAN_COMPILER_ENABLED or len(actions_data) < 2:
+        return actions_data
+    
+    compiled = compile_actions(actions_data) or get_empty_plan_fallback(actions_data)
+    record_compilation(actions_data, compiled)
+    return compiled
+
+def compile_stream(action_queue, first_action):
+    """Компиляция плана из потока ответа.
+    
+    Перед каждым действием объединяются все уже пришедшие действия.
+    Реплика ждет следующее действие не дольше PLAN_STREAM_LOOKAHEAD секунд,
+    чтобы прозвучать вместе с ним, и выполняется отдельно, если оно не пришло.
+    """
+    received = [first_action]
+    executed = []
+    ready = [first_action]
+    finished = False
+    
+    while True:
+        while not finished:
+            try:
+                action_data = action_queue.get_nowait()
+            except queue.Empty:
+                break
+            if action_data is None:
+                finished = True
+            else:
+                received.append(action_data)
+                ready.append(action_data)
+        
+        if PLAN_COMPILER_ENABLED:
+            ready = compile_actions(ready)
+        
+        if len(ready) > 1 or (ready and finished):
+            action_data = ready.pop(0)
+            executed.append(action_data)
+            yield action_data
+        elif finished:
+            # От плана ничего не осталось: как и для готового плана, выполняется только стоп
+            if not executed and PLAN_COMPILER_ENABLED:
+                for action_data in get_empty_plan_fallback(received):
+                    executed.append(action_data)
+                    yield action_data
+            break
+        else:
+            # Реплика всегда сливается со следующим действием: ждем его недолго, движение не ждет
+            try:
+                if ready and ready[0].action != "speak":
+                    raise queue.Empty
+                action_data = action_queue.get(timeout=PLAN_STREAM_LOOKAHEAD if ready else None)
+            except queue.Empty:
+                action_data = ready.pop(0)
+                executed.append(action_data)
+                yield action_data
+                continue
+            if action_data is None:
+                finished = True
+            else:
+                received.append(action_data)
+                ready.append(action_data)
+    
+    if PLAN_COMPILER_ENABLED and len(received) > 1:
+        record_compilation(received, executed)
+
+def print_compiler_report():
+    """Отчет компилятора планов: сколько действий и времени сэкономлено"""
+    with compile_lock:
+        stats = dict(compile_stats)
+    
+    print("\n" + "="*50)
+    print("КОМПИЛЯТОР ПЛАНОВ")
+    print("="*50)
+    if not PLAN_COMPILER_ENABLED:
+        print("Компилятор отключен (PLAN_COMPILER_ENABLED = False)")
+    print("Планов: " + str(stats['plans']) + ", действий " + str(stats['actions_before']) + " -> " + str(stats['actions_after']))
+    if stats['time_before'] > 0:
+        saved = stats['time_before'] - stats['time_after']
+        print("Оценка времени: " + str(round(stats['time_before'], 1)) + " -> " + str(round(stats['time_after'], 1)) +
+              " сек (экономия " + str(int(100 * saved / stats['time_before'])) + "%)")
+
+# Симулятор планов: поза робота по счислению пути, замеченные препятствия и проверка плана до движения моторов
+pose_lock = threading.Lock()
+robot_pose = {
+    'x': 0.0,
+    'y': 0.0,
+    'heading': 0.0  # Градусы по часовой стрелке, как у гироскопа
+}
+known_obstacles = []  # Центры замеченных препятствий: (x, y, время)
+sim_lock = threading.Lock()
+sim_stats = {
+    'plans': 0,
+    'steps': 0,
+    'cut': 0,
+    'removed': 0,
+    'seconds': 0.0,
+    'slowest': 0.0
+}
+
+def get_sim_speed(action_data):
+    """Скорость движения в модели (см/с)"""
+    return action_data.speed / 100.0 * SIM_FULL_SPEED_CM
+
+def point_ahead(pose, distance):
+    """Точка на расстоянии distance по направлению робота"""
+    radians = math.radians(pose['heading'])
+    return (pose['x'] + distance * math.cos(radians), pose['y'] + distance * math.sin(radians))
+
+def update_pose(distance, turn):
+    """Сдвигает оценку позы: проезд на distance см (назад - меньше нуля), затем поворот на turn градусов"""
+    with pose_lock:
+        robot_pose['x'], robot_pose['y'] = point_ahead(robot_pose, distance)
+        robot_pose['heading'] = (robot_pose['heading'] + turn) % 360
+
+def remember_obstacle(distance):
+    """Запоминает препятствие, которое ИК датчик видит на расстоянии distance"""
+    with pose_lock:
+        x, y = point_ahead(robot_pose, distance + SIM_OBSTACLE_RADIUS)
+        known_obstacles.append((x, y, time.time()))
+        del known_obstacles[:-SIM_OBSTACLE_MEMORY]
+
+def read_heading():
+    """Угол гироскопа или None, если гироскопа нет"""
+    if not USE_GYRO or gyro_sensor is None:
+        return None
+    try:
+        with sensor_lock:
+            return gyro_sensor.angle
+    except Exception:
+        return None
+
+def run_with_odometry(action_data, handler):
+    """Выполняет движение и переносит его в оценку позы.
+    
+    Поворот измеряется гироскопом, без него и для проезда берется заданное
+    значение, уменьшенное, если движение прервали раньше.
+    """
+    heading = read_heading()
+    started = time.time()
+    try:
+        handler(action_data)
+    finally:
+        elapsed = time.time() - started
+        name = action_data.action
+        if name in TURN_SIGNS:
+            current = read_heading()
+            if heading is not None and current is not None:
+                update_pose(0.0, current - heading)
+            else:
+                share = min(1.0, elapsed / max(0.01, action_data.angle / 90.0 * 0.8))
+                update_pose(0.0, TURN_SIGNS[name] * action_data.angle * share)
+        elif name in ("move_forward", "move_backward"):
+            distance = get_sim_speed(action_data) * min(elapsed, action_data.duration)
+            update_pose(distance if name == "move_forward" else -distance, 0.0)
+
+def get_sim_world(ir_distance=None):
+    """Снимок для симулятора: поза, свежие запомненные препятствия и препятствие перед ИК датчиком"""
+    if ir_distance is None:
+        ir_distance = safe_get_ir_distance()
+    now = time.time()
+    
+    with pose_lock:
+        world = dict(robot_pose)
+        obstacles = [(x, y) for x, y, seen in known_obstacles if now - seen < SIM_OBSTACLE_TTL]
+    if ir_distance < SIM_IR_RANGE:
+        obstacles.append(point_ahead(world, ir_distance + SIM_OBSTACLE_RADIUS))
+    world['obstacles'] = obstacles
+    return world
+
+def get_free_distance(world, dx, dy, limit):
+    """Сколько сантиметров можно проехать в направлении (dx, dy), не подойдя к препятствию ближе OBSTACLE_DISTANCE.
+    
+    Препятствие - круг SIM_OBSTACLE_RADIUS; движение от препятствия разрешено,
+    даже если робот уже слишком близко к нему.
+    """
+    reach = SIM_OBSTACLE_RADIUS + OBSTACLE_DISTANCE
+    reach_squared = reach * reach
+    x = world['x']
+    y = world['y']
+    free = limit
+    for ox, oy in world['obstacles']:
+        cx = ox - x
+        cy = oy - y
+        along = cx * dx + cy * dy
+        if along <= 0:
+            continue
+        aside_squared = cx * cx + cy * cy - along * along
+        if aside_squared >= reach_squared:
+            continue
+        hit = along - math.sqrt(reach_squared - aside_squared)
+        if hit < free:
+            free = max(hit, 0.0)
+    return free
+
+def simulate_step(world, action_data):
+    """Проводит действие по модели и сдвигает в ней позу.
     
-    payload = {
-        "model": OPENROUTER_MODEL,
-        "messages": [
-            {
-                "role": "user",
-                "content": prompt
-            }
-        ],
-        "max_tokens": 500,
-        "temperature": 0.7
-    }
+    Возвращает само действие, укороченную копию, если движение упирается в
+    препятствие, реплику вместо движения, для которого не осталось места,
+    или None, если от действия ничего не осталось.
+    """
+    name = action_data.action
+    if name in TURN_SIGNS:
+        world['heading'] = (world['heading'] + TURN_SIGNS[name] * action_data.angle) % 360
+        return action_data
+    if name not in ("move_forward", "move_backward") or action_data.speed <= 0:
+        return action_data
     
-    headers = {
-        "Authorization": "Bearer " + OPENROUTER_API_KEY,
-        "Content-Type": "application/json"
-    }
+    speed = get_sim_speed(action_data)
+    distance = speed * action_data.duration
+    direction = 1 if name == "move_forward" else -1
+    radians = math.radians(world['heading'])
+    free = get_free_distance(world, direction * math.cos(radians), direction * math.sin(radians), distance)
     
-    url = "https://openrouter.ai/api/v1/chat/completions"
+    if free < distance:
+        # Длительность округляется вниз до 0.1 сек: остановка с запасом
+        duration = math.floor(free / speed * 10) / 10.0
+        if duration < 0.1:
+            if not action_data.speech and not action_data.leds:
+                return None
+            return Action("speak", 0, 0.1, 0, action_data.speech, action_data.parallel, action_data.after, action_data.leds)
+        action_data = action_data.copy()
+        action_data.duration = duration
+        distance = speed * duration
     
-    try:
-        response = requests.post(
-            url,
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
-        
-        if response.status_code == 429:
-            print("Слишком много запросов к OpenRouter API. Пропускаю.")
-            return None
-        
-        response.raise_for_status()
-        
-        result = response.json()
-        
-        if "choices" not in result or len(result["choices"]) == 0:
-            print("Пустой ответ от OpenRouter API")
-            return None
-            
-        assistant_message = result["choices"][0]["message"]["content"]
-        
-        daily_requests += 1
-        print("Запрос о препятствии (осталось: " + get_remaining_requests() + ")")
-        
-        # Извлекаем JSON (массив или объект)
-        actions_data = extract_json_from_text(assistant_message)
-        
-        if actions_data is None:
-            print("Не удалось извлечь JSON из ответа о препятствии")
-            # Стандартная реакция на препятствие
-            return [{
-                "action": "move_backward",
-                "speed": 40,
-                "duration": 1.5,
-                "angle": 0,
-                "speech": "Обнаружено препятствие! Отступаю."
-            }]
+    world['x'], world['y'] = point_ahead(world, direction * distance)
+    return action_data
+
+def simulate_actions(actions_data, world):
+    """Проводит план по копии снимка world; возвращает проверенный план и список замен (было, стало)"""
+    world = dict(world)
+    checked = []
+    changes = []
+    for action_data in actions_data:
+        result = simulate_step(world, action_data)
+        if result is not action_data:
+            changes.append((action_data, result))
+        if result is not None:
+            checked.append(result)
+    return checked, changes
+
+def record_simulation(steps, changes, seconds):
+    """Учитывает проверку и печатает укороченные и убранные движения"""
+    with sim_lock:
+        sim_stats['plans'] += 1
+        sim_stats['steps'] += steps
+        sim_stats['seconds'] += seconds
+        sim_stats['slowest'] = max(sim_stats['slowest'], seconds)
+        for before, after in changes:
+            sim_stats['cut' if after is not None and after.action == before.action else 'removed'] += 1
+    
+    for before, after in changes:
+        if after is not None and after.action == before.action:
+            print("Симулятор: " + before.action + " укорочено " + str(before.duration) + " -> " + str(after.duration) + " сек, впереди препятствие")
+        else:
+            print("Симулятор: " + before.action + " на " + str(before.duration) + " сек убрано, места для движения нет")
+
+def simulate_plan(actions_data):
+    """Проверяет готовый план на столкновения до того, как двинется хоть один мотор"""
+    if not SIM_ENABLED:
+        return actions_data
+    
+    started = time.perf_counter()
+    checked, changes = simulate_actions(actions_data, get_sim_world())
+    record_simulation(len(actions_data), changes, time.perf_counter() - started)
+    return checked
+
+def simulate_stream(actions):
+    """Проверка плана из потока: каждое действие проводится по модели от позы, предсказанной для предыдущих"""
+    world = None
+    for action_data in actions:
+        if not SIM_ENABLED:
+            yield action_data
+            continue
         
-        # Если это не список, делаем его списком
-        if not isinstance(actions_data, list):
-            actions_data = [actions_data]
-        
-        # Ограничиваем количество действий
-        if len(actions_data) > MAX_SEQUENCE_ACTIONS:
-            actions_data = actions_data[:MAX_SEQUENCE_ACTIONS]
-            print("Ограничено количество действий до " + str(MAX_SEQUENCE_ACTIONS))
-        
-        # Валидация каждого действия
-        validated_actions = []
-        for action_data in actions_data:
-            # Валидация полученного JSON
-            if "action" not in action_data:
-                action_data["action"] = "speak"
-            if "speed" not in action_data:
-                action_data["speed"] = 40
-            if "duration" not in action_data:
-                action_data["duration"] = 1.0
-            if "angle" not in action_data:
-                action_data["angle"] = 90
-            if "speech" not in action_data:
-                action_data["speech"] = ""
-            
-            # Ограничиваем значения для безопасности
-            action_data["speed"] = min(max(int(action_data["speed"]), 0), 100)
-            action_data["duration"] = min(max(float(action_data["duration"]), 0.1), MAX_MOVE_DURATION)
-            action_data["angle"] = min(max(int(action_data["angle"]), 0), MAX_TURN_ANGLE)
-            
-            validated_actions.append(action_data)
+        started = time.perf_counter()
+        if world is None:
+            world = get_sim_world()
+        result = simulate_step(world, action_data)
+        record_simulation(1, [(action_data, result)] if result is not action_data else [], time.perf_counter() - started)
+        if result is not None:
+            yield result
+
+def print_simulator_report():
+    """Отчет симулятора: поза, препятствия, исправленные шаги и скорость проверки"""
+    with sim_lock:
+        stats = dict(sim_stats)
+    world = get_sim_world()
+    
+    print("\n" + "="*50)
+    print("СИМУЛЯТОР ПЛАНОВ")
+    print("="*50)
+    if not SIM_ENABLED:
+        print("Симулятор отключен (SIM_ENABLED = False)")
+    print("Поза: x " + str(round(world['x'], 1)) + " см, y " + str(round(world['y'], 1)) + " см, курс " + str(int(world['heading'])) +
+          " град; препятствий в модели: " + str(len(world['obstacles'])))
+    print("Проверок: " + str(stats['plans']) + ", шагов " + str(stats['steps']) + ", укорочено " + str(stats['cut']) +
+          ", убрано " + str(stats['removed']))
+    if stats['plans']:
+        print("Время проверки: в среднем " + str(int(stats['seconds'] * 1000000 / stats['plans'])) + " мкс, максимум " +
+              str(int(stats['slowest'] * 1000000)) + " мкс")
+    
+    # Замер на тестовом плане: препятствие в 25 см впереди и полный набор запомненных препятствий
+    plan = validate_plan(ACTION_BENCHMARK_PLAN)
+    test_world = get_sim_world(25)
+    test_world['obstacles'] = test_world['obstacles'] + [point_ahead(test_world, -100 - 10 * index) for index in range(SIM_OBSTACLE_MEMORY)]
+    per_plan = measure_per_call(lambda: simulate_actions(plan, test_world), ACTION_BENCHMARK_ROUNDS)
+    print("Тест: план из " + str(len(plan)) + " действий, " + str(len(test_world['obstacles'])) + " препятствий - " +
+          str(round(per_plan, 1)) + " мкс на план")
+
+# Исполнитель планов: моторами владеет один план, более важный прерывает его в безопасной точке
+executor_lock = threading.Condition()
+executor_current = None
+executor_waiting = []
+executor_stats = {
+    'plans': 0,
+    'preempted': 0,
+    'resumed': 0,
+    'dropped': 0,
+    'track_work': 0.0,
+    'track_wall': 0.0
+}
+executor_latencies = {
+    'queue': {},
+    'preempt': {}
+}
+
+def get_plan_priority(source):
+    """Приоритет плана по источнику: меньше - важнее; неизвестные источники наименее важны"""
+    return PLAN_PRIORITIES.get(source, max(PLAN_PRIORITIES.values()) + 1)
+
+def record_executor_latency(kind, source, latency):
+    """Запоминает задержку постановки в очередь или вытеснения (вызывается под executor_lock)"""
+    samples = executor_latencies[kind].setdefault(source, [])
+    samples.append(latency)
+    if len(samples) > PLAN_LATENCY_WINDOW:
+        samples.pop(0)
+
+def preempt_current_plan(source):
+    """Просит выполняемый план уступить более важному источнику (вызывается под executor_lock)"""
+    plan = executor_current
+    if plan is None or get_plan_priority(source) >= plan['priority'] or plan['preempt'].is_set():
+        return
+    plan['preempted_by'] = source
+    plan['preempt_requested'] = time.time()
+    plan['preempt'].set()
+    print("Исполнитель: план '" + plan['source'] + "' уступает плану '" + source + "'")
+
+def request_preemption(source):
+    """Прерывает менее важный план заранее, еще до того, как готова реакция"""
+    with executor_lock:
+        preempt_current_plan(source)
+
+def executor_busy_for(source):
+    """Занят ли исполнитель планом не менее важным, чем план источника"""
+    plan = executor_current
+    return plan is not None and plan['priority'] <= get_plan_priority(source)
+
+def plan_should_yield():
+    """Безопасная точка: True, если выполняемый план должен уступить более важному"""
+    plan = executor_current
+    return plan is not None and plan['preempt'].is_set()
+
+def preemptible_sleep(seconds):
+    """Пауза внутри движения с проверкой вытеснения каждые 0.1 сек; False, если план прерван"""
+    deadline = time.time() + seconds
+    while True:
+        if plan_should_yield():
+            print("Движение прервано более важным планом")
+            return False
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return True
+        time.sleep(min(0.1, remaining))
+
+def acquire_executor(plan):
+    """Ждет, пока исполнитель освободится и план станет первым в очереди по приоритету"""
+    global executor_current, is_performing_action
+    
+    with executor_lock:
+        executor_waiting.append(plan)
+        while True:
+            preempt_current_plan(plan['source'])
+            first = min(executor_waiting, key=lambda item: (item['priority'], item['order']))
+            if executor_current is None and first is plan:
+                break
+            executor_lock.wait(0.1)
         
-        return validated_actions
-                
-    except Exception as e:
-        print("Ошибка запроса о препятствии: " + str(e))
-        # Стандартная реакция при ошибке
-        return [{
-            "action": "move_backward",
-            "speed": 40,
-            "duration": 1.5,
-            "angle": 0,
-            "speech": "Что-то впереди. Лучше отступить."
-        }]
-
-def query_openrouter(prompt, sensor_data=None, context_type="autonomous"):
-    """Запрос к OpenRouter API с поддержкой последовательностей действий"""
-    global daily_requests, action_history
+        executor_waiting.remove(plan)
+        executor_current = plan
+        is_performing_action = True
+        plan['preempt'].clear()
+        if plan['started'] is None:
+            plan['started'] = time.time()
+            record_executor_latency('queue', plan['source'], plan['started'] - plan['submitted'])
+
+def release_executor(plan):
+    """Освобождает исполнитель и будит ждущие планы"""
+    global executor_current, is_performing_action
     
-    if not check_daily_limit():
-        return None
+    with executor_lock:
+        if executor_current is plan:
+            executor_current = None
+            is_performing_action = False
+        if plan['preempt_requested'] is not None:
+            record_executor_latency('preempt', plan['source'], time.time() - plan['preempt_requested'])
+            plan['preempt_requested'] = None
+        executor_lock.notify_all()
+
+def begin_plan(source):
+    """Занимает исполнитель для плана источника.
     
-    if sensor_data is None:
-        sensor_data = get_sensor_data()
+    Если поток уже выполняет план (например, реакция из рефлекса и плана
+    нейросети), вложенный план выполняется в его рамках без новой очереди.
+    """
+    with executor_lock:
+        plan = executor_current
+        if plan is not None and plan['thread'] is threading.current_thread():
+            plan['depth'] += 1
+            return plan
+        executor_stats['plans'] += 1
+        plan = {
+            'source': source,
+            'priority': get_plan_priority(source),
+            'order': executor_stats['plans'],
+            'thread': threading.current_thread(),
+            'depth': 1,
+            'submitted': time.time(),
+            'started': None,
+            'preempt': threading.Event(),
+            'preempted_by': None,
+            'preempt_requested': None
+        }
     
-    # Разные системные промпты для разных контекстов
-    if context_type == "autonomous":
-        system_context = get_context_prompt()
-    elif context_type == "button":
-        system_context = "Пользователь нажал кнопку. Реагируй быстро и выразительно!"
-    elif context_type == "terminal":
-        system_context = "Пользователь дал команду: " + prompt
-        prompt = "Выполни команду пользователя"
-    else:
-        system_context = "Что мне сделать?"
+    acquire_executor(plan)
+    return plan
+
+def end_plan(plan):
+    """Завершает план; исполнитель освобождается, когда закончен самый внешний план потока"""
+    plan['depth'] -= 1
+    if plan['depth'] == 0:
+        release_executor(plan)
+
+def yield_plan(plan, executed):
+    """План вытеснен: продолжает его позже (источники из PLAN_RESUME) или отбрасывает; True, если продолжаем"""
+    # Вложенный план прерывается целиком, решение принимает внешний
+    if plan['depth'] > 1 or plan['source'] not in PLAN_RESUME or plan['preempted_by'] == "emergency":
+        with executor_lock:
+            executor_stats['dropped'] += 1
+        print("Исполнитель: план '" + plan['source'] + "' прерван после " + str(executed) + " действий")
+        return False
     
-    situation = get_situation_description(sensor_data)
+    with executor_lock:
+        executor_stats['preempted'] += 1
+    print("Исполнитель: план '" + plan['source'] + "' приостановлен после " + str(executed) + " действий")
+    release_executor(plan)
+    acquire_executor(plan)
+    with executor_lock:
+        executor_stats['resumed'] += 1
+    print("Исполнитель: продолжаю план '" + plan['source'] + "'")
+    return True
+
+def print_trace_report():
+    """Отчет трассировки: время по категориям и выгрузка буфера в TRACE_FILE"""
+    print("\n" + "="*50)
+    print("ТРАССИРОВКА")
+    print("="*50)
+    if not TRACE_ENABLED:
+        print("Трассировка отключена (TRACE_ENABLED = False): включите ее в конфигурации и перезапустите робота")
+        return
     
-    # Добавляем историю действий для контекста
-    history_context = ""
-    if action_history:
-        recent_actions = action_history[-3:]
-        history_context = "\n\nНедавние действия: " + ", ".join(recent_actions)
+    spans = get_trace_spans()
+    totals = {}
+    for name, category, started, duration, tid, args in spans:
+        count, total, longest = totals.get(category, (0, 0.0, 0.0))
+        totals[category] = (count + 1, total + duration, max(longest, duration))
+    for category, (count, total, longest) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        print("  " + category + ": " + str(count) + " интервалов, всего " + str(round(total, 2)) + " сек, самый долгий " +
+              str(int(longest * 1000)) + " мс")
     
-    # Промпт с поддержкой последовательностей
-    full_prompt = """Ты - робот EV3RSTORM. Ты можешь отправить ОДИН JSON объект или МАССИВ JSON объектов для последовательности действий.
+    print("Интервалов в буфере: " + str(save_trace()) + " из " + str(TRACE_BUFFER_SIZE))
+    print("Файл: " + get_trace_path() + " (открыть в chrome://tracing или ui.perfetto.dev)")
 
-Формат одного действия:
-{
-    "action": "move_forward|move_backward|turn_left|turn_right|attack|speak|stop",
-    "speed": число от 0 до 100,
-    "duration": число в секундах,
-    "angle": число в градусах,
-    "speech": "текст для озвучивания на русском языке"
+def format_latency_ms(values):
+    """Строка p50 / p95 / максимум для списка задержек в секундах, в миллисекундах"""
+    if not values:
+        return "нет данных"
+    samples = sorted(values)
+    return " / ".join(str(int(value * 1000)) for value in (percentile(samples, 50), percentile(samples, 95), samples[-1])) + " мс"
+
+def print_executor_report():
+    """Отчет исполнителя: планы, вытеснения и задержки по источникам"""
+    with executor_lock:
+        stats = dict(executor_stats)
+        latencies = dict((kind, dict((source, list(values)) for source, values in items.items())) for kind, items in executor_latencies.items())
+        current = executor_current
+        waiting = [plan['source'] for plan in executor_waiting]
+    
+    print("\n" + "="*50)
+    print("ИСПОЛНИТЕЛЬ ПЛАНОВ")
+    print("="*50)
+    print("Планов: " + str(stats['plans']) + ", приостановлено: " + str(stats['preempted']) + ", продолжено: " +
+          str(stats['resumed']) + ", прервано: " + str(stats['dropped']))
+    print("Сейчас: " + (current['source'] if current is not None else "свободен") + (", ждут: " + ", ".join(waiting) if waiting else ""))
+    if stats['track_wall'] > 0:
+        print("Дорожки: работа механизмов " + str(round(stats['track_work'], 1)) + " сек за " + str(round(stats['track_wall'], 1)) +
+              " сек выполнения планов (в среднем " + str(round(stats['track_work'] / stats['track_wall'], 2)) + " дорожки одновременно)")
+    
+    for source in sorted(set(latencies['queue']) | set(latencies['preempt']), key=get_plan_priority):
+        print("  " + source + ": ожидание в очереди (p50/p95/макс) " + format_latency_ms(latencies['queue'].get(source)) +
+              ", уступил за " + format_latency_ms(latencies['preempt'].get(source)))
+
+# Исполнители действий: имя действия -> функция от проверенного Action
+ACTION_HANDLERS = {
+    "move_forward": lambda action_data: move_forward(action_data.speed, action_data.duration),
+    "move_backward": lambda action_data: move_backward(action_data.speed, action_data.duration),
+    "turn_left": lambda action_data: turn_left(action_data.speed, action_data.angle),
+    "turn_right": lambda action_data: turn_right(action_data.speed, action_data.angle),
+    "attack": lambda action_data: attack_with_blade(action_data.speed, action_data.duration),
+    "stop": lambda action_data: stop_all(),
+    "speak": lambda action_data: None
 }
 
-Формат последовательности действий (массив):
-[
-  {
-    "action": "speak",
-    "speed": 0,
-    "duration": 0,
-    "angle": 0,
-    "speech": "Привет! Я собираюсь выполнить несколько действий."
-  },
-  {
-    "action": "move_forward",
-    "speed": 50,
-    "duration": 2,
-    "angle": 0,
-    "speech": ""
-  },
-  {
-    "action": "turn_right",
-    "speed": 30,
-    "duration": 0,
-    "angle": 90,
-    "speech": "Поворачиваю направо."
-  }
-]
+def get_action_parts(action_data):
+    """Части действия по дорожкам: список пар (дорожки, функция).
+    
+    Реплика звучит на дорожке речи одновременно с движением, подсветка
+    включается сразу. При PLAN_TRACKS_ENABLED = False части выполняются
+    по очереди как одна, занимая все свои дорожки.
+    """
+    handler = ACTION_HANDLERS.get(action_data.action)
+    tracks = ACTION_TRACKS.get(action_data.action, ())
+    speech = action_data.speech if handler is not None else join_speech(action_data.speech, "Хм, интересная команда...")
+    
+    parts = []
+    if speech:
+        parts.append((("speech",), lambda: speak(speech)))
+    if "drive" in tracks:
+        parts.append((tracks, lambda: run_with_odometry(action_data, handler)))
+    elif tracks:
+        parts.append((tracks, lambda: handler(action_data)))
+    if action_data.leds and "leds" not in tracks:
+        parts.append((("leds",), lambda: set_leds(action_data.leds)))
+    
+    if PLAN_TRACKS_ENABLED or len(parts) < 2:
+        return parts
+    
+    def run_in_order():
+        for part_tracks, function in parts:
+            function()
+    
+    return [(tuple(track for part_tracks, function in parts for track in part_tracks), run_in_order)]
 
-Ситуация: """ + situation + """
-Время: """ + sensor_data['time_of_day'] + history_context + """
-Контекст: """ + system_context + """
-Запрос: """ + prompt + """
+def new_timeline():
+    """Дорожки одного плана: какие заняты, сколько частей действий еще идет и сколько они работали"""
+    return {
+        'changed': threading.Condition(),
+        'busy': {},
+        'running': 0,
+        'work': 0.0
+    }
 
-Ограничения:
-- Длительность движения не более 3 секунд
-- Угол поворота не более 180 градусов
-- Скорость моторов от 0 до 100
-- Максимум """ + str(MAX_SEQUENCE_ACTIONS) + """ действий в последовательности
+def run_track_part(timeline, tracks, function):
+    """Выполняет часть действия в своем потоке и освобождает ее дорожки"""
+    started = time.time()
+    try:
+        function()
+    except Exception as e:
+        print("Ошибка выполнения: " + str(e))
+    finally:
+        with timeline['changed']:
+            for track in tracks:
+                timeline['busy'].pop(track, None)
+            timeline['running'] -= 1
+            timeline['work'] += time.time() - started
+            timeline['changed'].notify_all()
 
-Отправь JSON (объект или массив) без каких-либо дополнительных текстов."""
+def start_action(timeline, action_data, parts):
+    """Занимает дорожки действия и запускает его части, не дожидаясь их окончания"""
+    with timeline['changed']:
+        for tracks, function in parts:
+            for track in tracks:
+                timeline['busy'][track] = action_data.action
+            timeline['running'] += 1
     
-    payload = {
-        "model": OPENROUTER_MODEL,
-        "messages": [
-            {
-                "role": "user",
-                "content": full_prompt
-            }
-        ],
-        "max_tokens": 800,
-        "temperature": 0.8
-    }
+    for tracks, function in parts:
+        threading.Thread(target=run_track_part, args=(timeline, tracks, function), name="+".join(tracks), daemon=True).start()
+
+def action_can_start(timeline, action_data, parts):
+    """Свободны ли дорожки действия и дорожка из after (вызывается под timeline['changed'])"""
+    busy = timeline['busy']
+    if action_data.after in busy:
+        return False
+    return not any(track in busy for tracks, function in parts for track in tracks)
+
+def wait_timeline(timeline, ready, plan=None):
+    """Ждет, пока ready() станет истинным; False, если план вытеснили раньше"""
+    with timeline['changed']:
+        while not ready():
+            if plan is not None and plan['preempt'].is_set():
+                return False
+            timeline['changed'].wait(0.05)
+    return True
+
+@traced("plan")
+def execute_action_sequence(actions_data, should_stop=None, source="autonomous"):
+    """Выполнение плана через исполнитель с приоритетами.
     
-    headers = {
-        "Authorization": "Bearer " + OPENROUTER_API_KEY,
-        "Content-Type": "application/json"
-    }
+    actions_data - список действий или итератор действий из потока ответа.
+    Части действий идут на дорожках речи, ходовых моторов, лезвия и
+    подсветки: обычное действие ждет окончания предыдущих, действие с
+    parallel или after - только своих дорожек.
+    План более важного источника (PLAN_PRIORITIES) прерывает этот план в
+    ближайшей безопасной точке: между действиями или внутри движения.
+    Перед движением план проверяется симулятором: шаги, ведущие в препятствие,
+    укорачиваются или убираются; продолженный после вытеснения план
+    проверяется заново.
+    should_stop позволяет прервать план между действиями. Возвращает число
+    выполненных действий.
+    """
+    global last_action_time
     
-    url = "https://openrouter.ai/api/v1/chat/completions"
+    streamed = not isinstance(actions_data, list)
+    if streamed:
+        actions = simulate_stream(actions_data)
+    else:
+        actions_data = simulate_plan(compile_plan(actions_data))
+        # От плана ничего не осталось: исполнитель не занимается, чужие планы не прерываются
+        if not actions_data:
+            return 0
+        actions = iter(actions_data)
+    executed = 0
+    timeline = new_timeline()
+    plan = begin_plan(source)
+    started = time.time()
     
     try:
-        response = requests.post(
-            url,
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
-        
-        if response.status_code == 429:
-            print("Слишком много запросов к OpenRouter API. Пропускаю.")
-            return None
-        
-        response.raise_for_status()
-        
-        result = response.json()
-        
-        if "choices" not in result or len(result["choices"]) == 0:
-            print("Пустой ответ от OpenRouter API")
-            return None
-            
-        assistant_message = result["choices"][0]["message"]["content"]
-        
-        daily_requests += 1
-        print("Запрос к OpenRouter (осталось: " + get_remaining_requests() + ")")
-        
-        # Извлекаем JSON (массив или объект)
-        actions_data = extract_json_from_text(assistant_message)
-        
-        if actions_data is None:
-            print("Не удалось извлечь JSON из ответа: " + assistant_message[:100] + "...")
-            return None
+        print("\n" + "="*50)
+        if streamed:
+            print("ПОТОКОВОЕ ВЫПОЛНЕНИЕ ДЕЙСТВИЙ")
+        else:
+            print("ВЫПОЛНЕНИЕ ПОСЛЕДОВАТЕЛЬНОСТИ ИЗ " + str(len(actions_data)) + " ДЕЙСТВИЙ")
+        print("="*50)
         
-        # Если это не список, делаем его списком
-        if not isinstance(actions_data, list):
-            actions_data = [actions_data]
-        
-        # Ограничиваем количество действий
-        if len(actions_data) > MAX_SEQUENCE_ACTIONS:
-            actions_data = actions_data[:MAX_SEQUENCE_ACTIONS]
-            print("Ограничено количество действий до " + str(MAX_SEQUENCE_ACTIONS))
-        
-        # Валидация каждого действия
-        validated_actions = []
-        for action_data in actions_data:
-            # Валидация полученного JSON
-            if "action" not in action_data:
-                action_data["action"] = "speak"
-            if "speed" not in action_data:
-                action_data["speed"] = 50
-            if "duration" not in action_data:
-                action_data["duration"] = 1.0
-            if "angle" not in action_data:
-                action_data["angle"] = 90
-            if "speech" not in action_data:
-                action_data["speech"] = ""
+        action_data = None
+        while True:
+            if should_stop is not None and should_stop():
+                print("Последовательность прервана после " + str(executed) + " действий")
+                break
             
-            # Ограничиваем значения для безопасности
-            action_data["speed"] = min(max(int(action_data["speed"]), 0), 100)
-            action_data["duration"] = min(max(float(action_data["duration"]), 0.1), MAX_MOVE_DURATION)
-            action_data["angle"] = min(max(int(action_data["angle"]), 0), MAX_TURN_ANGLE)
+            if plan['preempt'].is_set():
+                # Уступаем, когда все дорожки остановились в своих безопасных точках
+                wait_timeline(timeline, lambda: timeline['running'] == 0)
+                if not yield_plan(plan, executed):
+                    break
+                if SIM_ENABLED:
+                    # Реакция, из-за которой план уступил, сдвинула робота и могла найти препятствия: остаток проверяется от новой позы
+                    pending = [action_data] if action_data is not None else []
+                    if streamed:
+                        actions = simulate_stream(itertools.chain(pending, actions_data))
+                    else:
+                        rest = simulate_plan(pending + list(actions))
+                        actions_data = actions_data[:executed] + rest
+                        actions = iter(rest)
+                    action_data = None
+                continue
             
-            validated_actions.append(action_data)
-        
-        # Сохраняем действия в историю
-        for action_data in validated_actions:
-            action_text = action_data.get("speech", action_data.get("action", "действие"))
-            if len(action_text) > 20:
-                action_text = action_text[:20] + "..."
-            action_history.append(action_text)
-            if len(action_history) > 15:
-                action_history.pop(0)
-        
-        return validated_actions
+            if action_data is None:
+                action_data = next(actions, None)
+                if action_data is None:
+                    break
+                if not isinstance(action_data, Action):
+                    action_data = validate_action(action_data)
+                parts = get_action_parts(action_data)
                 
-    except Exception as e:
-        print("Ошибка запроса к OpenRouter API: " + str(e))
-        return None
+                # Обычное действие ждет окончания предыдущих и небольшую паузу; более важный план ее прерывает
+                if executed and not (PLAN_TRACKS_ENABLED and (action_data.parallel or action_data.after)):
+                    if not wait_timeline(timeline, lambda: timeline['running'] == 0, plan):
+                        continue
+                    with trace_span("pause", "plan"):
+                        paused = plan['preempt'].wait(PLAN_ACTION_PAUSE)
+                    if paused:
+                        continue
+            
+            if not wait_timeline(timeline, lambda: action_can_start(timeline, action_data, parts), plan):
+                continue
+            
+            executed += 1
+            if streamed:
+                print("\n--- Действие " + str(executed) + " (из потока) ---")
+            else:
+                print("\n--- Действие " + str(executed) + " из " + str(len(actions_data)) + " ---")
+            print("Действие: " + action_data.action)
+            if PLAN_TRACKS_ENABLED and action_data.after:
+                print("Запуск: как только освободится дорожка " + action_data.after)
+            elif PLAN_TRACKS_ENABLED and action_data.parallel:
+                print("Запуск: вместе с предыдущим действием")
+            if action_data.speech:
+                print("Речь: " + action_data.speech)
+            start_action(timeline, action_data, parts)
+            action_data = None
+        
+        wait_timeline(timeline, lambda: timeline['running'] == 0)
+        wall = time.time() - started
+        with executor_lock:
+            executor_stats['track_work'] += timeline['work']
+            executor_stats['track_wall'] += wall
+        
+        print("\n" + "="*50)
+        print("ПОСЛЕДОВАТЕЛЬНОСТЬ ЗАВЕРШЕНА за " + str(round(wall, 1)) + " сек")
+        print("="*50)
+    finally:
+        # Исполнитель не освобождается, пока на дорожках что-то выполняется
+        wait_timeline(timeline, lambda: timeline['running'] == 0)
+        end_plan(plan)
+    
+    last_action_time = time.time()
+    return executed
 
-def execute_single_action(action_data):
-    """Выполнение одного действия"""
-    action = action_data.get("action", "")
-    speech_text = action_data.get("speech", "")
-    speed = action_data.get("speed", 50)
-    duration = action_data.get("duration", 1.0)
-    angle = action_data.get("angle", 90)
+def execute_streamed_query(query_function, *args, source="autonomous"):
+    """Запрашивает план у нейросети и выполняет действия по мере их поступления.
     
-    print("Действие: " + action)
-    if speech_text:
-        print("Речь: " + speech_text)
+    Первое действие начинает выполняться, пока следующие еще генерируются.
+    Исполнитель занимается только с приходом первого действия: пока нейросеть
+    думает, моторы свободны для других планов. Возвращает список действий из ответа.
+    """
+    if not llm_available():
+        print("Нейросеть недоступна, выполняю локальную реакцию")
+        actions_data = get_reflex_actions("offline")
+        if actions_data:
+            execute_action_sequence(actions_data, source=source)
+        return actions_data
     
-    if speech_text:
-        speak(speech_text)
+    if not STREAM_RESPONSES:
+        actions_data = query_function(*args)
+        if actions_data:
+            execute_action_sequence(actions_data, source=source)
+        return actions_data
     
-    try:
-        if action == "move_forward":
-            move_forward(speed, duration)
-        elif action == "move_backward":
-            move_backward(speed, duration)
-        elif action == "turn_left":
-            turn_left(speed, angle)
-        elif action == "turn_right":
-            turn_right(speed, angle)
-        elif action == "attack":
-            attack_with_blade(speed, duration)
-        elif action == "stop":
-            stop_all()
-        elif action == "speak":
-            pass
-        else:
-            speak("Хм, интересная команда...")
-            
-    except Exception as e:
-        print("Ошибка выполнения: " + str(e))
+    action_queue = queue.Queue()
+    outcome = {}
+    
+    def producer():
+        try:
+            outcome['actions'] = query_function(*args, on_action=action_queue.put)
+        except Exception as e:
+            print("Ошибка потокового запроса: " + str(e))
+        finally:
+            action_queue.put(None)
+    
+    threading.Thread(target=producer, daemon=True).start()
+    
+    first_action = action_queue.get()
+    
+    # Ответ не удалось разобрать на лету (или это резервная реакция) — выполняем целиком
+    if first_action is None:
+        actions_data = outcome.get('actions')
+        if actions_data:
+            execute_action_sequence(actions_data, source=source)
+        return actions_data
+    
+    execute_action_sequence(compile_stream(action_queue, first_action), source=source)
+    return outcome.get('actions')
 
-def execute_action_sequence(actions_data):
-    """Выполнение последовательности действий"""
-    global is_performing_action, last_action_time
+def get_prefetch_lead():
+    """За сколько секунд до конца паузы запрашивать план: 90-й перцентиль задержки основного провайдера"""
+    with llm_lock:
+        samples = sorted(provider_latencies[PRIMARY_PROVIDER])
     
-    is_performing_action = True
+    if len(samples) < 5:
+        return PREFETCH_LEAD_DEFAULT
     
-    print("\n" + "="*50)
-    print("ВЫПОЛНЕНИЕ ПОСЛЕДОВАТЕЛЬНОСТИ ИЗ " + str(len(actions_data)) + " ДЕЙСТВИЙ")
-    print("="*50)
+    return percentile(samples, 90) + 1.0
+
+def situation_changed(before, after):
+    """Проверяет, заметно ли изменилась обстановка между двумя снимками датчиков"""
+    if abs(before['ir_distance'] - after['ir_distance']) > PREFETCH_MAX_DISTANCE_CHANGE:
+        return True
+    if before.get('color') != after.get('color'):
+        return True
+    if "gyro_angle" in before and "gyro_angle" in after:
+        if abs(before["gyro_angle"] - after["gyro_angle"]) > PREFETCH_MAX_HEADING_CHANGE:
+            return True
+    return after.get('obstacle_detected', False)
+
+def start_prefetch(prompt, context_type):
+    """Запрашивает план заранее, пока идет пауза автономного режима"""
+    prefetch = {
+        'sensor_data': get_sensor_data(),
+        'started': time.time(),
+        'done': threading.Event(),
+        'actions': None,
+        'epoch': user_epoch
+    }
     
-    for i, action_data in enumerate(actions_data, 1):
-        print("\n--- Действие " + str(i) + " из " + str(len(actions_data)) + " ---")
-        execute_single_action(action_data)
-        
-        # Небольшая пауза между действиями (кроме последнего)
-        if i < len(actions_data):
-            time.sleep(0.5)
+    def worker():
+        try:
+            prefetch['actions'] = query_openrouter(prompt, prefetch['sensor_data'], context_type, remember=False)
+        except Exception as e:
+            print("Ошибка предварительного запроса: " + str(e))
+        finally:
+            prefetch['done'].set()
     
-    print("\n" + "="*50)
-    print("ПОСЛЕДОВАТЕЛЬНОСТЬ ЗАВЕРШЕНА")
-    print("="*50)
+    print("Предзапрос плана для автономного действия")
+    threading.Thread(target=worker, daemon=True).start()
+    return prefetch
+
+def take_prefetch(prefetch, sensor_data):
+    """Возвращает заранее полученный план, если он свежий и обстановка не изменилась, иначе None"""
+    if prefetch['epoch'] != user_epoch:
+        print("Предзапрос отброшен: пользователь дал новую команду")
+        return None
     
-    last_action_time = time.time()
-    is_performing_action = False
+    if situation_changed(prefetch['sensor_data'], sensor_data):
+        print("Предзапрос отброшен: обстановка изменилась")
+        return None
+    
+    # Запрос ушел заранее, поэтому дождаться его быстрее, чем начинать новый, но не дольше, чем план остается свежим
+    if not prefetch['done'].wait(max(0, PREFETCH_MAX_AGE - (time.time() - prefetch['started']))):
+        print("Предзапрос отброшен: нет ответа за " + str(PREFETCH_MAX_AGE) + " сек, запрашиваю заново")
+        return None
+    
+    age = time.time() - prefetch['started']
+    if age > PREFETCH_MAX_AGE:
+        print("Предзапрос отброшен: план устарел (" + str(int(age)) + " сек)")
+        return None
+    
+    if prefetch['actions']:
+        print("Предзапрос: план готов, выполняю без ожидания сети")
+    return prefetch['actions']
 
 def autonomous_behavior():
     """Постоянное автономное поведение"""
@@ -920,17 +4738,43 @@ def autonomous_behavior():
                 time.sleep(2)
                 continue
                 
-            if is_performing_action:
+            if executor_busy_for("autonomous"):
                 time.sleep(0.1)
                 continue
                 
-            if not check_daily_limit():
+            if not llm_request_allowed("autonomous"):
                 time.sleep(10)
                 continue
             
-            # Ждем случайный интервал
+            # Случайный выбор типа автономного поведения
+            behavior_types = [
+                ("autonomous", "Что мне сейчас сделать интересного?"),
+                ("autonomous", "Осмотрись вокруг и придумай что-нибудь"),
+                ("autonomous", "Прояви свою индивидуальность"),
+                ("autonomous", "Покажи, на что ты способен"),
+                ("autonomous", "Сделай что-нибудь неожиданное"),
+                ("autonomous", "Как ты себя чувствуешь?"),
+                ("autonomous", "Что нового вокруг?"),
+                ("autonomous", "Расскажи историю и покажи ее")
+            ]
+            
+            context_type, prompt = random.choice(behavior_types)
+            
+            # Ждем случайный интервал; план запрашивается заранее, чтобы к концу паузы он был готов
             interval = random.randint(AUTONOMOUS_INTERVAL_MIN, AUTONOMOUS_INTERVAL_MAX)
-            time.sleep(interval)
+            # Локальные запросы лимит не тратят; облачный дубль ограничивается в provider_within_budget
+            pacing = 0 if local_llm_ready() else get_autonomous_pacing()
+            if pacing > interval:
+                print("Лимит запросов: автономная пауза увеличена до " + str(int(pacing)) + " сек")
+                interval = int(pacing)
+            prefetch = None
+            if PREFETCH_ENABLED:
+                lead = min(interval, get_prefetch_lead())
+                idle_wait(interval - lead)
+                prefetch = start_prefetch(prompt, context_type)
+                idle_wait(lead)
+            else:
+                idle_wait(interval)
             
             print("\n" + "="*40)
             print("АВТОНОМНОЕ ДЕЙСТВИЕ")
@@ -944,40 +4788,63 @@ def autonomous_behavior():
                 time.sleep(2)
                 continue
             
-            # Случайный выбор типа автономного поведения
-            behavior_types = [
-                ("autonomous", "Что мне сейчас сделать интересного?"),
-                ("autonomous", "Осмотрись вокруг и придумай что-нибудь"),
-                ("autonomous", "Прояви свою индивидуальность"),
-                ("autonomous", "Покажи, на что ты способен"),
-                ("autonomous", "Сделай что-нибудь неожиданное"),
-                ("autonomous", "Как ты себя чувствуешь?"),
-                ("autonomous", "Что нового вокруг?"),
-                ("autonomous", "Расскажи историю и покажи ее")
-            ]
-            
-            context_type, prompt = random.choice(behavior_types)
-            actions_data = query_openrouter(prompt, sensor_data, context_type)
+            actions_data = None
+            if prefetch is not None:
+                actions_data = take_prefetch(prefetch, sensor_data)
             
             if actions_data:
-                execute_action_sequence(actions_data)
+                execute_action_sequence(actions_data, source=context_type)
+                remember_actions(actions_data)
+            else:
+                execute_streamed_query(query_openrouter, prompt, sensor_data, context_type, source=context_type)
                 
         except Exception as e:
             print("Ошибка в автономном поведении: " + str(e))
             time.sleep(5)
 
+# Служебные команды терминала: отчеты без обращения к нейросети
+SERVICE_COMMANDS = {
+    "кэш промптов": print_prompt_cache_report,
+    "статистика": print_request_stats,
+    "провайдеры": print_provider_health,
+    "бюджет": print_budget_report,
+    "кэш планов": print_plan_cache_report,
+    "быстрые команды": print_fast_command_report,
+    "запросы": print_request_report,
+    "препятствия": print_obstacle_report,
+    "память": print_memory_report,
+    "тест разбора": print_parser_report,
+    "тест действий": print_action_report,
+    "исполнитель": print_executor_report,
+    "компилятор": print_compiler_report,
+    "трассировка": print_trace_report,
+    "симулятор": print_simulator_report
+}
+
+def handle_service_command(user_input):
+    """Выполняет служебную команду терминала; возвращает True, если команда распознана"""
+    handler = SERVICE_COMMANDS.get(user_input.lower())
+    if handler is None:
+        return False
+    
+    handler()
+    return True
+
 def terminal_input_handler():
     """Обработчик ввода из терминала"""
+    global terminal_last_input
+    
     print("\n" + "="*60)
     print("КОМАНДЫ ДЛЯ РОБОТА:")
     print("- Напишите любую команду и нажмите Enter")
     print("- Примеры: 'поехали вперед', 'расскажи шутку', 'что видишь?'")
+    print("- Отчеты: " + ", ".join("'" + command + "'" for command in sorted(SERVICE_COMMANDS)))
     print("- Для выхода: 'выход', 'exit' или 'quit'")
     print("="*60)
     
     while True:
-        # Проверяем доступность ввода
-        if sys.stdin in select.select([sys.stdin], [], [], 0)[0]:
+        # Ждем ввода не дольше 0.1 сек: строка читается сразу после Enter
+        if sys.stdin in select.select([sys.stdin], [], [], 0.1)[0]:
             user_input = sys.stdin.readline().strip()
             
             if user_input.lower() in ['выход', 'exit', 'quit']:
@@ -985,45 +4852,95 @@ def terminal_input_handler():
                 print("ЗАВЕРШЕНИЕ РАБОТЫ")
                 print("="*50)
                 stop_all()
+                save_state_on_exit()
                 os._exit(0)
             
+            if handle_service_command(user_input):
+                continue
+            
+            # Команда остановки не ждет очереди: прерывает любой план и отменяет набранные раньше команды
+            stop_plan = parse_fast_command(user_input) if user_input else None
+            if stop_plan and all(action_data.action == "stop" for action_data in stop_plan):
+                note_user_input("терминал")
+                if terminal_input_queue:
+                    print("[Терминал] Отменены команды: " + "; ".join(terminal_input_queue))
+                    del terminal_input_queue[:]
+                remember_actions(stop_plan, user_input)
+                execute_action_sequence(stop_plan, source="emergency")
+                continue
+            
             if user_input:
                 terminal_input_queue.append(user_input)
+                terminal_last_input = time.time()
+                note_user_input("терминал")
+                terminal_event.set()
                 print("\n[Терминал] Команда добавлена: " + user_input)
-        
-        time.sleep(0.1)
 
 def process_terminal_commands():
     """Обработка команд из очереди терминала"""
     while True:
         try:
-            if terminal_input_queue and not is_performing_action:
-                user_input = terminal_input_queue.pop(0)
+            if terminal_input_queue and not executor_busy_for("terminal"):
+                # Команды, набранные подряд, собираются в один запрос: ждем паузы во вводе
+                # (простые команды выполняются сразу, им запрос не нужен)
+                while (time.time() - terminal_last_input < TERMINAL_BATCH_WINDOW and len(terminal_input_queue) < TERMINAL_BATCH_MAX and
+                       not all(parse_fast_command(command) is not None for command in terminal_input_queue)):
+                    time.sleep(0.05)
+                
+                commands = terminal_input_queue[:TERMINAL_BATCH_MAX]
+                del terminal_input_queue[:len(commands)]
+                
                 print("\n" + "="*40)
-                print("ОБРАБОТКА КОМАНДЫ: " + user_input)
+                print("ОБРАБОТКА КОМАНД: " + "; ".join(commands))
                 print("="*40)
                 
                 sensor_data = get_sensor_data()
                 
-                # Проверяем препятствие перед выполнением команды
+                # Проверяем препятствие перед выполнением команд
                 if sensor_data['ir_distance'] < SAFETY_DISTANCE:
                     print("Внимание! Препятствие близко. Сначала нужно его обойти.")
-                    actions_data = query_openrouter_obstacle(sensor_data)
-                    if actions_data:
-                        execute_action_sequence(actions_data)
+                    react_to_obstacle(sensor_data, "safety")
                     continue
                 
-                actions_data = query_openrouter(user_input, sensor_data, "terminal")
+                # Простые команды разбираются на месте, повторяющиеся берутся из кэша планов,
+                # к нейросети уходят только остальные
+                local_plans = [get_local_plan(command, sensor_data) for command in commands]
+                pending = [command for command, local in zip(commands, local_plans) if local is None]
                 
-                if actions_data:
-                    execute_action_sequence(actions_data)
+                plans = None
+                if len(pending) > 1 and llm_available():
+                    plans = query_openrouter_batch(pending, sensor_data)
+                    if plans is None:
+                        print("Пакетный ответ не разобран, выполняю команды по одной")
+                batch_plans = iter(plans or [])
+                
+                for command, local in zip(commands, local_plans):
+                    if local is not None:
+                        print("\n[Команда без нейросети] " + command)
+                        remember_actions(local, command)
+                        execute_action_sequence(local, source="terminal")
+                    elif plans is not None:
+                        actions_data = next(batch_plans)
+                        print("\n[Команда] " + command)
+                        if actions_data:
+                            execute_action_sequence(actions_data, source="terminal")
+                    else:
+                        execute_streamed_query(query_openrouter, command, get_sensor_data(), "terminal", source="terminal")
             
-            time.sleep(0.1)
+            terminal_event.wait(0.1)
+            terminal_event.clear()
             
         except Exception as e:
             print("Ошибка обработки команды: " + str(e))
             time.sleep(1)
 
+def save_state_on_exit():
+    """Записывает отложенные изменения кэша планов и трассировку: при любом способе выхода"""
+    if PLAN_CACHE_ENABLED:
+        flush_plan_cache()
+    if TRACE_ENABLED:
+        print("Трассировка сохранена: " + str(save_trace()) + " интервалов в " + get_trace_path())
+
 def main():
     """Основной цикл работы робота"""
     # Очистка экрана при запуске
@@ -1041,8 +4958,13 @@ def main():
     if USE_GYRO:
         print("- Гироскоп: " + ("OK" if gyro_sensor else "ОШИБКА"))
     
-    print("Используется OpenRouter API: " + OPENROUTER_MODEL)
-    print("Дневной лимит запросов: " + str(DAILY_REQUEST_LIMIT))
+    print("Используется " + PROVIDERS[PRIMARY_PROVIDER]['title'] + " API: " + PROVIDERS[PRIMARY_PROVIDER]['model'])
+    if LOCAL_LLM_ENABLED:
+        print("Локальная нейросеть: " + LOCAL_BASE_URL + " (" + LOCAL_MODEL + "), при недоступности - облако")
+    provider_chain = get_provider_chain()
+    if len(provider_chain) > 1:
+        print("Хеджирование запросов: " + " -> ".join(PROVIDERS[name]['title'] for name in provider_chain))
+    print("Дневной лимит запросов: " + str(DAILY_REQUEST_LIMIT) + " (" + ", ".join(context_type + " " + str(int(BUDGET_SHARES.get(context_type, 0) * 100)) + "%" for context_type in BUDGET_PRIORITY) + ")")
     print("Автономный интервал: " + str(AUTONOMOUS_INTERVAL_MIN) + "-" + str(AUTONOMOUS_INTERVAL_MAX) + " сек")
     print("Расстояние до препятствия: " + str(OBSTACLE_DISTANCE) + " см")
     print("Максимум действий в последовательности: " + str(MAX_SEQUENCE_ACTIONS))
@@ -1053,6 +4975,17 @@ def main():
     leds.set_color('LEFT', 'AMBER')
     leds.set_color('RIGHT', 'AMBER')
     
+    load_request_stats()
+    load_budget_ledger()
+    load_plan_cache()
+    
+    if LOCAL_LLM_ENABLED:
+        check_local_health()
+        threading.Thread(target=local_health_worker, daemon=True).start()
+    
+    # Соединение с API устанавливается заранее, до первого запроса
+    prewarm_connection(force=True)
+    
     # Запуск автономного поведения
     autonomous_thread = threading.Thread(target=autonomous_behavior, daemon=True)
     autonomous_thread.start()
@@ -1072,7 +5005,7 @@ def main():
             
             # Обработка нажатий кнопок (быстрое взаимодействие)
             if touchs.is_pressed:
-                if not is_performing_action:
+                if not executor_busy_for("button"):
                     print("\n" + "="*30)
                     print("НАЖАТИЕ КНОПКИ")
                     print("="*30)
@@ -1082,10 +5015,10 @@ def main():
                         time.sleep(1)
                         continue
                     
-                    sensor_data = get_sensor_data()
-                    actions_data = query_openrouter("Реагируй на нажатие кнопки", sensor_data, "button")
-                    if actions_data:
-                        execute_action_sequence(actions_data)
+                    note_user_input("кнопка")
+                    with trace_span("button", "input"):
+                        sensor_data = get_sensor_data()
+                        react_with_reflex("button", query_openrouter, "Реагируй на нажатие кнопки", sensor_data, "button")
                 time.sleep(0.5)
             
             time.sleep(0.1)
@@ -1096,6 +5029,7 @@ def main():
         print("="*50)
     finally:
         stop_all()
+        save_state_on_exit()
         speak("Завершаю работу. До новых встреч!")
         leds.set_color('LEFT', 'GREEN')
         leds.set_color('RIGHT', 'GREEN')